@@ -1,14 +1,49 @@
+import os
 import sys
 import logging
-from androguard.misc import AnalyzeAPK
-from androguard.core.analysis.analysis import ClassAnalysis
-from crypto_names import match_crypto_name
+import zipfile
+from typing import TYPE_CHECKING
+from crypto_names import match_crypto_name, match_crypto_names
 from analyse_elf import analyse_apk_elf
-from constants import crypto_constants
+from constant_scanner import crypto_constants_scanner
+from dex_index import index_crypto_constants
+from dex_engine import AnalyzeDex, AnalyzeDexStreaming
+from containers import scan_nested
+from stage_metrics import StageMetrics
+from budgets import Deadline, interrupt_after
+
+if TYPE_CHECKING:
+    from androguard.core.analysis.analysis import ClassAnalysis
 
 
 logger = logging.getLogger('AndroidCryptoDetection')
 
+# Strings of the string pool matched at once, between two checks of the deadline of the strings stage
+STRINGS_PER_DEADLINE_CHECK = 4096
+
+
+def analyze_apk(filename, nested_dex=()):
+    """ androguard's AnalyzeAPK. nested_dex (NestedPayloads of scan_nested, see containers.py)
+        are added to the DEX files of the APK before the cross references are created.
+    """
+    # androguard takes a while to import, and re-evaluating extracts doesn't need it
+    from androguard.misc import AnalyzeAPK
+    from androguard.core.bytecodes.apk import APK
+    from androguard.core.bytecodes.dvm import DalvikVMFormat
+    from androguard.core.analysis.analysis import Analysis
+
+    if not nested_dex:
+        return AnalyzeAPK(filename)
+    a = APK(filename)
+    d = []
+    dx = Analysis()
+    for dex in list(a.get_all_dex()) + [payload.data for payload in nested_dex]:
+        df = DalvikVMFormat(dex, using_api=a.get_target_sdk_version())
+        dx.add(df)
+        d.append(df)
+    dx.create_xref()
+    return a, d, dx
+
 
 class MethodCryptoAnalysis:
     """ Analyse a method in a Java class
@@ -28,7 +63,7 @@ class MethodCryptoAnalysis:
             crypto_constants_results: list[str]
                 Names of crypto constants (defined in `constants.py`) that are found in the method
     """
-    def __init__(self, meth):
+    def __init__(self, meth, constants_index=None):
         self.strings = set()
         self.crypto_constants_results = []
 
@@ -40,9 +75,13 @@ class MethodCryptoAnalysis:
         self.name = meth.name
         self.crypto_name_matched = match_crypto_name(self.name)
 
-        for name, constant in crypto_constants.items():
-            if self.search_bytes(meth, constant):
-                self.crypto_constants_results.append(name)
+        if constants_index is not None:
+            # Constants were found by scanning the whole DEX, see dex_index.py
+            self.crypto_constants_results = constants_index.get(meth.get_method(), [])
+            return
+        bytecode = self.get_bytecode(meth)
+        if bytecode:
+            self.crypto_constants_results = crypto_constants_scanner.scan(bytecode)
     
     def add_string(self, s):
         self.strings.add(s)
@@ -62,13 +101,16 @@ class MethodCryptoAnalysis:
         return None
 
     @staticmethod
-    def search_bytes(meth, value: bytes):
+    def get_bytecode(meth):
+        """ Return the raw bytecode of the method, or None if it has no code.
+            androguard rebuilds the buffer from the instructions on every call, so call it once.
+        """
         if meth.is_external():
-            return False
-        code = meth.get_method().get_code()        
+            return None
+        code = meth.get_method().get_code()
         if code:
-            return value in code.get_bc().get_raw()
-        return False
+            return code.get_bc().get_raw()
+        return None
     
     def __repr__(self) -> str:
         ret = (
@@ -98,7 +140,7 @@ class ClassCryptoAnalysis:
                     matches the name or contain strings or contain constants related to crypto.
                 The keys are method names, the values are MethodCryptoAnalysis objects.
     """
-    def __init__(self, class_ana: ClassAnalysis, from_str=False):
+    def __init__(self, class_ana: 'ClassAnalysis', from_str=False, constants_index=None):
         self.name = class_ana.name
         self.method_info = {}
 
@@ -109,7 +151,7 @@ class ClassCryptoAnalysis:
 
         self.crypto_name_matched = match_crypto_name(class_ana.name)
         for meth in class_ana.get_methods():
-            meth_ana = MethodCryptoAnalysis(meth)
+            meth_ana = MethodCryptoAnalysis(meth, constants_index)
             if meth_ana.matched:
                 self.method_info[meth_ana.name] = meth_ana
     
@@ -160,11 +202,77 @@ class AnalyseApkCrypto:
             
             elf_analyse_result: list[ApkElfAnalyseResult]
                 A list of ApkElfAnalyseResult
+
+            metrics: StageMetrics
+                Time and memory consumed by each stage of the analysis.
+
+            a, d, dx:
+                The APK, DEX and Analysis objects of androguard (or dex_engine.py). They are
+                released as soon as the results are extracted, and are None afterwards.
+
+        If dex_index is True, each DEX file is scanned once for crypto constants and the hits
+        are mapped to their methods, instead of searching the bytecode of every method.
+        engine selects how DEX files are parsed: 'androguard' builds androguard's full analysis,
+        'dex' uses the minimal parser in dex_engine.py, which only builds what is needed here.
+        If streaming is True, the DEX files are parsed by dex_engine.py one at a time,
+        whatever the engine, and constants are indexed as with dex_index.
+        Stages are recorded in metrics if given, e.g. to include earlier stages of the caller.
+        elf_results is the result of analyse_apk_elf, if the caller already analysed the ELF files.
+        If known_libraries (a PackageTrie) is given, classes in its packages are skipped: they are
+        still counted in class_cnt, and the number skipped is known_class_cnt.
+        budgets are the seconds allowed to the stages 'dex', 'elf', 'classes' and 'strings' (see budgets.py).
+        A stage over its budget stops and keeps what it found so far, and is listed in metrics.partial.
+        If loading runs out of time, only the ELF files are analysed and the counts are left empty.
+        If features (an ApkFeatures, see extracts.py) are given, they are analysed instead of loading filename,
+        and elf_results must be given too.
+        If nested (a NestedLimits, see containers.py) is given, the DEX and ELF files elsewhere in the APK
+        and in the archives nested in it (e.g. SDKs shipped as assets/*.jar) are analysed with those of the APK.
+        The nested archives are walked once, unless nested_scan (a NestedScan, e.g. of the triage) is given.
+        If abi_priority (a list of ABIs) is given, only one copy of a library shipped for several ABIs
+        is analysed when they are alike, see analyse_apk_elf.
     """
-    def __init__(self, filename):
-        self.a, self.d, self.dx = AnalyzeAPK(filename)
+    def __init__(self, filename, elf_cache=None, dex_index=False, engine='androguard', streaming=False,
+                 metrics=None, elf_results=None, known_libraries=None, budgets=None, features=None, nested=None,
+                 abi_priority=None, nested_scan=None):
+        self.metrics = metrics if metrics is not None else StageMetrics()
+        self._known_libraries = known_libraries
+        self._budgets = budgets or {}
+        self._abi_priority = abi_priority
+        self.known_class_cnt = 0
+        self._constants_index = None
         self.classes_with_crypto = {}
-        self.elf_analyse_result, self.pack_elf = analyse_apk_elf(self.a.zip)
+        self.a = self.d = self.dx = None
+        if nested is not None and nested_scan is None and features is None:
+            # The ELF files are only needed if the caller didn't analyse them
+            with self.metrics.stage('nested'), zipfile.ZipFile(filename) as apk_zip:
+                nested_scan = scan_nested(apk_zip, nested, ('dex', 'elf') if elf_results is None else ('dex',))
+        nested_dex, nested_elf = (nested_scan.dex, nested_scan.elf) if nested_scan is not None else ((), ())
+        alarm = None    # Unbound if the interrupt comes before interrupt_after returns
+        try:
+            # androguard has no loop to check a deadline in, so it's interrupted
+            with self.metrics.stage('dex'), interrupt_after(self._budgets.get('dex')) as alarm:
+                if features is not None:
+                    self.a, self.d, self.dx = features.load()
+                elif streaming:
+                    self.a, self.d, self.dx, self._constants_index = AnalyzeDexStreaming(
+                        filename, nested_dex=nested_dex)
+                elif engine == 'dex':
+                    self.a, self.d, self.dx = AnalyzeDex(filename, nested_dex)
+                else:
+                    self.a, self.d, self.dx = analyze_apk(filename, nested_dex)
+        except KeyboardInterrupt:
+            if alarm is None or not alarm.fired:
+                raise
+            self.metrics.partial.append('dex')
+            logger.warning('Loading {} ran out of its time budget, only analysing ELF files'.format(filename))
+            self._analyse_elf_only(filename, elf_cache, elf_results, nested_elf)
+            return
+
+        if dex_index and not streaming:
+            with self.metrics.stage('dex_index'):
+                self._constants_index = index_crypto_constants(self.d)
+        self._analyse_elf(self.a.zip, elf_cache, elf_results, nested_elf)
+        nested_scan = nested_dex = nested_elf = None   # not held through the Java analysis
         self.package_name = self.a.get_package()
         self.method_cnt = len(list(self.dx.get_methods()))
         self.class_cnt = len(list(self.dx.get_classes()))
@@ -177,8 +285,55 @@ class AnalyseApkCrypto:
             logger.warning('Failed to get app name, using package name instead.')
             self.app_name = self.package_name
         
-        self._get_classes_with_crypto()
-        self._get_classes_with_crypto_strings()
+        with self.metrics.stage('classes'):
+            self._get_classes_with_crypto(self._deadline('classes'))
+        if known_libraries is not None:
+            self.metrics.counts['known_classes'] = self.known_class_cnt
+            logger.debug('Skipped {} of {} classes in known libraries'.format(self.known_class_cnt, self.class_cnt))
+        with self.metrics.stage('strings'):
+            self._get_classes_with_crypto_strings(self._deadline('strings'))
+        self._release()
+
+    @property
+    def partial(self):
+        """ The stages cut short by their time budget. """
+        return self.metrics.partial
+
+    def _deadline(self, stage):
+        return Deadline(self._budgets.get(stage))
+
+    def _check_deadline(self, deadline, stage):
+        if deadline.passed():
+            self.metrics.partial.append(stage)
+            logger.warning('The {} stage ran out of its time budget, keeping the results so far'.format(stage))
+            return True
+        return False
+
+    def _analyse_elf(self, apk_zip, elf_cache, elf_results, nested_elf):
+        if elf_results is None:
+            deadline = self._deadline('elf')
+            with self.metrics.stage('elf'):
+                elf_results = analyse_apk_elf(apk_zip, elf_cache, deadline, nested_elf, self._abi_priority)
+            if deadline.hit:
+                self.metrics.partial.append('elf')
+                logger.warning('The elf stage ran out of its time budget, keeping the results so far')
+        self.elf_analyse_result, self.pack_elf = elf_results
+
+    def _analyse_elf_only(self, filename, elf_cache, elf_results, nested_elf):
+        # Without the manifest, the file name is used as in ELF-only mode
+        with zipfile.ZipFile(filename) as apk_zip:
+            self._analyse_elf(apk_zip, elf_cache, elf_results, nested_elf)
+        self.package_name = os.path.split(filename)[1]
+        self.app_name = ''
+        self.class_cnt = self.method_cnt = ''
+        self.elf_cnt = len(self.elf_analyse_result)
+        self._release()
+
+    def _release(self):
+        # The androguard object graph is by far the largest part of the memory used,
+        # and the results only keep names and strings, so drop it before the results are written.
+        self.a = self.d = self.dx = None
+        self._constants_index = None
     
     def _get_classes_methods(self):
         results = {}
@@ -189,27 +344,49 @@ class AnalyseApkCrypto:
                 results[c.name].append(meth.name)
         return results
 
-    def _get_classes_with_crypto(self):
+    def _is_known_class(self, class_name):
+        return self._known_libraries is not None and self._known_libraries.match(class_name) is not None
+
+    def _get_classes_with_crypto(self, deadline):
         classes = self.dx.get_classes()
         for c in classes:
-            ana = ClassCryptoAnalysis(c)
+            if self._check_deadline(deadline, 'classes'):
+                break
+            if self._is_known_class(c.name):
+                self.known_class_cnt += 1
+                continue
+            ana = ClassCryptoAnalysis(c, constants_index=self._constants_index)
             if ana.matched:
                 self.classes_with_crypto[ana.name] = ana
 
-    def _get_classes_with_crypto_strings(self):
-        for s_ana in self.dx.get_strings():
-            s_value = s_ana.get_orig_value()
-            crypto_name = match_crypto_name(s_value, exclude_cert=True)
-            if crypto_name:
-                for c, meth in s_ana.get_xref_from():
-                    # Type of c is androguard.core.analysis.analysis.ClassAnalysis
-                    # Type of meth is androguard.core.bytecodes.dvm.EncodedMethod
-                    if c.name in self.classes_with_crypto:
-                        self.classes_with_crypto[c.name].add_string(meth.name, s_value)
-                    else:
-                        class_ana = ClassCryptoAnalysis(c, from_str=True)
-                        class_ana.add_string(meth.name, s_value)
-                        self.classes_with_crypto[c.name] = class_ana
+    def _iter_crypto_strings(self, deadline):
+        # The string pool is matched STRINGS_PER_DEADLINE_CHECK strings at a time, only the few strings
+        # containing a crypto name are resolved to the methods using them.
+        s_anas = list(self.dx.get_strings())
+        for start in range(0, len(s_anas), STRINGS_PER_DEADLINE_CHECK):
+            if self._check_deadline(deadline, 'strings'):
+                return
+            chunk = s_anas[start:start + STRINGS_PER_DEADLINE_CHECK]
+            s_values = [s_ana.get_orig_value() for s_ana in chunk]
+            for s_ana, s_value, crypto_name in zip(chunk, s_values, match_crypto_names(s_values, exclude_cert=True)):
+                if crypto_name:
+                    if self._check_deadline(deadline, 'strings'):
+                        return
+                    yield s_ana, s_value
+
+    def _get_classes_with_crypto_strings(self, deadline):
+        for s_ana, s_value in self._iter_crypto_strings(deadline):
+            for c, meth in s_ana.get_xref_from():
+                # Type of c is androguard.core.analysis.analysis.ClassAnalysis
+                # Type of meth is androguard.core.bytecodes.dvm.EncodedMethod
+                if self._is_known_class(c.name):
+                    continue
+                if c.name in self.classes_with_crypto:
+                    self.classes_with_crypto[c.name].add_string(meth.name, s_value)
+                else:
+                    class_ana = ClassCryptoAnalysis(c, from_str=True)
+                    class_ana.add_string(meth.name, s_value)
+                    self.classes_with_crypto[c.name] = class_ana
     
     def __repr__(self) -> str:
         ret = (
@@ -1,7 +1,10 @@
 import os
 import io
 import sys
+import mmap
+import struct
 import zipfile
+import hashlib
 import operator
 import logging
 from typing import NamedTuple
@@ -9,10 +12,52 @@ from elftools.elf.elffile import ELFFile
 from elftools.elf.sections import SymbolTableSection
 from elftools.common.exceptions import ELFError
 from constants import crypto_constants
+from constant_scanner import crypto_constants_scanner
+from containers import scan_nested
 from crypto_names import *
 
 logger = logging.getLogger('AndroidCryptoDetection')
 
+# Sections searched for crypto constants
+constant_sections = ('.rodata', '.data', 'bss')
+
+
+class BufferStream(io.RawIOBase):
+    """ A read-only file object over buffer[offset:offset + size], without copying it.
+        buffer can be bytes or mmap, e.g. a whole APK with an ELF stored at offset.
+    """
+    def __init__(self, buffer, offset=0, size=None):
+        self.buffer = buffer
+        self.offset = offset
+        self.size = len(buffer) - offset if size is None else size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        self._pos = max(pos, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else min(self._pos + n, self.size)
+        if end <= self._pos:
+            return b''
+        data = self.buffer[self.offset + self._pos:self.offset + end]
+        self._pos = end
+        return data
+
+
 class AnalyseElf:
     """ Analyse an ELF file.
 
@@ -27,23 +72,37 @@ class AnalyseElf:
             crypto_constants_result: dict[str, bool]
                 The keys are crypto constants names, e.g., sm4_ck, sm4_sbox.
                 The values are bools indicating whether the constant is found in ELF.
+
+        If analyse is False, the ELF is only parsed, e.g. to read its symbols and sections, see extracts.py.
     """
 
-    def __init__(self, stream, filename=None):
+    def __init__(self, stream, filename=None, analyse=True):
         self._f = stream
         _, self.elf_name = os.path.split(filename)
         self.elffile = ELFFile(stream)
-        self.symbol_table = self._get_symbol_table()
+        self._buffer, self._offset = self._get_buffer(stream)
+        self._section_ranges = self._get_section_ranges(constant_sections)
+        self._symbol_table = None
         self.symbol_table_with_crypto_name = {}
+        self.crypto_constants_result = {}
+        if not analyse:
+            return
         for crypto_name in crypto_names:
             self.symbol_table_with_crypto_name[crypto_name] = []
         self._get_symbol_table_with_crypto_name()
-        self.crypto_constants_result = {}
         self._get_crypto_constants_result()
 
     def get_analyse_result(self):
         return ApkElfAnalyseResult(self.elf_name, self.symbol_table_with_crypto_name, self.crypto_constants_result)
 
+    @property
+    def symbol_table(self):
+        """ The list of symbol names, only built when accessed, since the crypto names are searched without it.
+        """
+        if self._symbol_table is None:
+            self._symbol_table = self._get_symbol_table()
+        return self._symbol_table
+
     def _get_symbol_table(self):
         """ Return a list of symbol names in the ELF file.
         """
@@ -52,28 +111,97 @@ class AnalyseElf:
             if isinstance(sec, SymbolTableSection):
                 result += list(map(operator.attrgetter('name'), sec.iter_symbols()))
         return result
-    
+
     def _get_symbol_table_with_crypto_name(self):
-        for symbol in self.symbol_table:
-            crypto_name = match_crypto_name(symbol)
-            if crypto_name is not None:
-                self.symbol_table_with_crypto_name[crypto_name].append(symbol)
+        matched = {}    # Crypto name of each candidate symbol name, shared by .symtab and .dynsym
+        for sec in self.elffile.iter_sections():
+            if not isinstance(sec, SymbolTableSection):
+                continue
+            names = self._get_candidate_symbol_names(sec)
+            if names is None:
+                names = map(operator.attrgetter('name'), sec.iter_symbols())
+            for symbol in names:
+                if symbol not in matched:
+                    matched[symbol] = match_crypto_name(symbol)
+                crypto_name = matched[symbol]
+                if crypto_name is not None:
+                    self.symbol_table_with_crypto_name[crypto_name].append(symbol)
+
+    def _get_candidate_symbol_names(self, sec):
+        """ Return a list of the names of the symbols in sec that may contain a crypto name, in table order,
+            found in the raw bytes of its string table instead of creating a Symbol for every entry.
+            Names are decoded as pyelftools does. Return None if the tables can't be read in place.
+        """
+        strtab = sec.stringtable
+        file_end = self._offset + self.elffile.stream_len
+        table = self._offset + sec['sh_offset']
+        table_end = table + sec['sh_size']
+        str_start = self._offset + strtab['sh_offset']
+        str_end = min(str_start + strtab['sh_size'], file_end)
+        if table_end > file_end or str_start >= file_end or sec['sh_entsize'] < 4:
+            return None
+        # pyelftools reads a name up to its NUL, even past the end of the string table
+        if str_end > str_start:
+            str_end = self._buffer.find(b'\x00', str_end - 1, file_end)
+            str_end = file_end if str_end == -1 else str_end
+
+        # Offsets in the string table at which a name contains a possible match
+        candidates = set()
+        for pos in iter_crypto_name_positions(self._buffer, str_start, str_end):
+            name_start = self._buffer.rfind(b'\x00', str_start, pos) + 1 or str_start
+            candidates.update(range(name_start - str_start, pos - str_start + 1))
+
+        entry = struct.Struct('{}I{}x'.format('<' if self.elffile.little_endian else '>', sec['sh_entsize'] - 4))
+        result = []
+        for st_name, in entry.iter_unpack(self._buffer[table:table_end]):
+            # Names outside the searched bytes, only in broken files, are decoded anyway
+            if st_name in candidates or str_start + st_name >= str_end:
+                name_end = self._buffer.find(b'\x00', str_start + st_name, file_end)
+                if name_end != -1:     # Else pyelftools returns an empty name
+                    result.append(self._buffer[str_start + st_name:name_end].decode('utf-8', errors='replace'))
+        return result
+
+    @staticmethod
+    def _get_buffer(stream):
+        """ Return (buffer, offset) so that the ELF is buffer[offset:], sharing memory with stream when possible.
+        """
+        if isinstance(stream, BufferStream):
+            return stream.buffer, stream.offset
+        if isinstance(stream, io.BytesIO):
+            return stream.getvalue(), 0     # Shares the bytes the BytesIO was created from
+        stream.seek(0)
+        return stream.read(), 0
+
+    def _get_section_ranges(self, names):
+        """ Return a list of (buffer, start, end) of the named sections, resolved once from the section headers.
+            NOBITS sections have no data in the file and are skipped,
+            compressed sections are decompressed into their own buffer.
+        """
+        result = []
+        for name in names:
+            sec = self.elffile.get_section_by_name(name)
+            if sec is None or sec['sh_type'] == 'SHT_NOBITS':
+                continue
+            if sec.compressed:
+                data = sec.data()
+                result.append((data, 0, len(data)))
+                continue
+            start = self._offset + sec['sh_offset']
+            end = min(start + sec['sh_size'], self._offset + self.elffile.stream_len)
+            result.append((self._buffer, start, end))
+        return result
+
+    def get_constant_sections(self):
+        """ Return the bytes of the sections searched for crypto constants, as a list. """
+        return [bytes(buffer[start:end]) for buffer, start, end in self._section_ranges]
 
     def search_bytes(self, value: bytes):
         """ Search the value in .rodata, .data, .bss sections.
             Return True on success, False on failure.
         """
-        sec = self.elffile.get_section_by_name('.rodata')
-        if sec is not None and value in sec.data():
-            return True
-
-        sec = self.elffile.get_section_by_name('.data')
-        if sec is not None and value in sec.data():
-            return True
-
-        sec = self.elffile.get_section_by_name('bss')
-        if sec is not None and value in sec.data():
-            return True
+        for buffer, start, end in self._section_ranges:
+            if buffer.find(value, start, end) != -1:
+                return True
         return False
 
     def search_bytes_raw(self, value: bytes):
@@ -86,14 +214,18 @@ class AnalyseElf:
         return buffer.find(value)
 
     def _get_crypto_constants_result(self):
-        for name, constant in crypto_constants.items():
-            self.crypto_constants_result[name] = self.search_bytes(constant)
+        found = []
+        for buffer, start, end in self._section_ranges:
+            found += crypto_constants_scanner.scan(buffer, start, end, skip=found)
+        for name in crypto_constants:
+            self.crypto_constants_result[name] = name in found
 
 
 class ApkElfAnalyseResult(NamedTuple):
     elf_name: str
     symbol_table_with_crypto_name: dict
     crypto_constants_results: dict
+    abis: tuple = ()    # ABIs of the copies of the library the result stands for, see analyse_apk_elf
 
 pack_elf_name = {
     "libchaosvmp.so", "libddog.so", "libfdog.so",
@@ -111,26 +243,186 @@ pack_elf_name = {
     "libkwscmm.so", "libkwscr.so", "libkwslinker.so"
 }
 
-def analyse_apk_elf(apk_zip: zipfile.ZipFile):
+
+def is_packer_lib(name):
+    """ Return whether the library at name (a path in the APK) belongs to a known packer. """
+    name = os.path.split(name)[1]
+    return name in pack_elf_name or 'libshellx' in name
+
+
+# ABIs in the order their copy of a library is analysed first when copies are deduplicated,
+# the other ABIs come after them in the order of the APK
+DEFAULT_ABI_PRIORITY = ('arm64-v8a', 'armeabi-v7a', 'armeabi', 'x86_64', 'x86', 'mips64', 'mips')
+
+
+def get_abi(name):
+    """ Return the ABI of the library at name (a path in the APK), e.g. 'arm64-v8a' for lib/arm64-v8a/libfoo.so,
+        or '' if it isn't in an ABI directory.
+    """
+    parts = name.split('/')
+    return parts[1] if len(parts) == 3 and parts[0] == 'lib' else ''
+
+
+def elf_fingerprint(stream):
+    """ Return a fingerprint of the ELF in a BufferStream that the copies of a library built for other ABIs share:
+        a digest of the names of the symbols defined in .dynsym, read from the raw table, or the size of
+        the file if it has no .dynsym. Return None if it isn't an ELF or the table can't be read.
+    """
+    try:
+        elffile = ELFFile(stream)
+        sec = elffile.get_section_by_name('.dynsym')
+        if not isinstance(sec, SymbolTableSection):
+            return 'size:{}'.format(stream.size)
+        strtab = sec.stringtable
+    except ELFError:
+        return None
+    buffer, offset = AnalyseElf._get_buffer(stream)
+    file_end = offset + stream.size
+    table = offset + sec['sh_offset']
+    table_end = table + sec['sh_size']
+    str_start = offset + strtab['sh_offset']
+    if table_end > file_end or str_start >= file_end or sec['sh_entsize'] < 16:
+        return None
+    # st_name and st_shndx of Elf32_Sym and Elf64_Sym
+    endian = '<' if elffile.little_endian else '>'
+    if elffile.elfclass == 32:
+        entry = struct.Struct('{}I10xH{}x'.format(endian, sec['sh_entsize'] - 16))
+    else:
+        entry = struct.Struct('{}I2xH{}x'.format(endian, sec['sh_entsize'] - 8))
+    # st_shndx 0 is SHN_UNDEF: symbols imported from other libraries
+    offsets = {str_start + st_name for st_name, st_shndx in entry.iter_unpack(buffer[table:table_end]) if st_shndx}
+    names = []
+    for start in offsets:
+        end = buffer.find(b'\x00', start, file_end)
+        if end == -1:
+            return None
+        names.append(buffer[start:end])
+    return 'symbols:' + hashlib.sha256(b'\x00'.join(sorted(set(names)))).hexdigest()
+
+
+def _group_copies(infos, abi_priority):
+    """ Return the entries infos grouped by library name, each group in the order of abi_priority,
+        and the groups in the order of the APK.
+    """
+    groups = {}
+    for info in infos:
+        groups.setdefault(os.path.split(info.filename)[1], []).append(info)
+    rank = {abi: index for index, abi in enumerate(abi_priority)}
+    return [sorted(group, key=lambda info: rank.get(get_abi(info.filename), len(rank))) for group in groups.values()]
+
+
+def _map_archive(apk_zip: zipfile.ZipFile):
+    """ Return the raw bytes of the archive without copying them: the bytes behind an in-memory zip
+        (as androguard opens APKs), or a read-only mmap of a zip on disk. Return None if neither works.
+    """
+    fp = apk_zip.fp
+    if isinstance(fp, io.BytesIO):
+        return fp.getvalue()
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _stored_entry_offset(archive, info: zipfile.ZipInfo):
+    """ Return the offset of the data of an uncompressed entry in the archive, or None if it can't be used in place.
+    """
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:    # Encrypted
+        return None
+    header = archive[info.header_offset:info.header_offset + 30]
+    if len(header) < 30 or header[:4] != b'PK\x03\x04':
+        return None
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    offset = info.header_offset + 30 + name_len + extra_len
+    if offset + info.file_size > len(archive):
+        return None
+    return offset
+
+
+def _analyse_elf_entry(elffile, name, elf_cache):
+    """ Return the ApkElfAnalyseResult of the ELF in a BufferStream, or None if it isn't an ELF. """
+    result = key = None
+    if elf_cache is not None:
+        key = elf_cache.key(elffile)
+        result = elf_cache.get(key, name)
+    if result is None:
+        try:
+            result = AnalyseElf(elffile, name).get_analyse_result()
+        except ELFError:
+            logger.warning('Ignoring {}: not an ELF'.format(name))
+            return None
+        if key is not None:
+            elf_cache.put(key, result)
+    return result
+
+
+def analyse_apk_elf(apk_zip: zipfile.ZipFile, elf_cache=None, deadline=None, nested_elf=(), abi_priority=None):
+    """ Analyse the ELF files in an APK, return (list[ApkElfAnalyseResult], list of packer ELF names).
+        If elf_cache (an ElfResultCache) is given, results of ELF files analysed before are reused.
+        If deadline (a Deadline, see budgets.py) passes, the remaining ELF files aren't analysed,
+        but packer libraries are still listed.
+        nested_elf (NestedPayloads of scan_nested, see containers.py) are the ELF files elsewhere in the APK and
+        in the archives nested in it, analysed after the libraries and named by their path in the APK.
+        If abi_priority (a list of ABIs) is given, only one copy of a library shipped for several ABIs
+        is analysed, the first in abi_priority: the result of a copy with the same elf_fingerprint
+        lists its ABI too. Copies with another fingerprint are analysed on their own.
+    """
     ret_val = []
     pack_elf = []
-    for name in filter(lambda s: s.startswith('lib') and s.endswith('.so'), apk_zip.namelist()):
-        with apk_zip.open(name) as elffile:
-            with io.BytesIO(elffile.read()) as elffile:
-                try:
-                    ret_val.append(AnalyseElf(elffile, name).get_analyse_result())
-                except ELFError:
-                    logger.warning('Ignoring {}: not an ELF'.format(name))
+    archive = _map_archive(apk_zip)
+    try:
+        infos = [info for info in apk_zip.infolist() if info.filename.startswith('lib') and info.filename.endswith('.so')]
+        groups = _group_copies(infos, abi_priority) if abi_priority is not None else [[info] for info in infos]
+        for group in groups:
+            representative = None   # (index in ret_val, fingerprint) of the copy analysed first
+            for info in group:
+                name = info.filename
+                if deadline is not None and deadline.passed():
+                    if is_packer_lib(name):
+                        pack_elf.append(os.path.split(name)[1])
                     continue
-        name = os.path.split(name)[1]
-        if name in pack_elf_name or 'libshellx' in name:
-            pack_elf.append(name)
+                offset = _stored_entry_offset(archive, info) if archive is not None else None
+                if offset is not None:
+                    # Stored entry, analysed in place
+                    elffile = BufferStream(archive, offset, info.file_size)
+                else:
+                    elffile = BufferStream(apk_zip.read(info))
+
+                if representative is not None and representative[1] is not None \
+                        and elf_fingerprint(elffile) == representative[1]:
+                    index = representative[0]
+                    ret_val[index] = ret_val[index]._replace(abis=ret_val[index].abis + (get_abi(name),))
+                else:
+                    result = _analyse_elf_entry(elffile, name, elf_cache)
+                    if result is None:
+                        continue
+                    ret_val.append(result._replace(abis=(get_abi(name),)))
+                    if representative is None and len(group) > 1:
+                        representative = (len(ret_val) - 1, elf_fingerprint(elffile))
+
+                if is_packer_lib(name):
+                    pack_elf.append(os.path.split(name)[1])
+    finally:
+        if isinstance(archive, mmap.mmap):
+            archive.close()
+    for payload in nested_elf:
+        if deadline is not None and deadline.passed():
+            break
+        result = _analyse_elf_entry(BufferStream(payload.data), payload.path, elf_cache)
+        if result is not None:
+            ret_val.append(result._replace(elf_name=payload.path))
+    if elf_cache is not None:
+        elf_cache.log_stats()
     return ret_val, pack_elf
 
 
-def analyse_apk_elf_with_filename(filename):
+def analyse_apk_elf_with_filename(filename, elf_cache=None, deadline=None, nested=None, abi_priority=None):
+    """ analyse_apk_elf of the APK filename. If nested (a NestedLimits, see containers.py) is given,
+        the ELF files nested in the APK are analysed too.
+    """
     with zipfile.ZipFile(filename, 'r') as apk_zip:
-        return analyse_apk_elf(apk_zip)
+        nested_elf = scan_nested(apk_zip, nested, ('elf',)).elf if nested is not None else ()
+        return analyse_apk_elf(apk_zip, elf_cache, deadline, nested_elf, abi_priority)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,268 @@
+import io
+import os
+import sys
+import json
+import time
+import zipfile
+import platform
+import argparse
+import tempfile
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from synthetic_apk import SyntheticApkSpec, ABIS, generate_corpus
+from stage_metrics import peak_rss_mb
+from ruleset import ruleset_fingerprint
+
+BASELINE_VERSION = 1
+
+# A benchmark is reported as a regression if its throughput drops, or its peak memory grows, by more than this
+DEFAULT_TOLERANCE = 0.15
+
+# match_crypto_name is fast, the strings of the corpus are matched this many times per repeat, with a cold cache
+MATCH_PASSES = 20
+
+
+def _read_elf_files(apks):
+    elf_files = []
+    for apk in apks:
+        with zipfile.ZipFile(apk) as apk_zip:
+            elf_files += [(name, apk_zip.read(name)) for name in apk_zip.namelist() if name.endswith('.so')]
+    return elf_files
+
+
+def _setup_analyse_apk_crypto(apks):
+    from analyse_apk import AnalyseApkCrypto
+    return apks, len(apks), sum(os.path.getsize(apk) for apk in apks), AnalyseApkCrypto
+
+
+def _run_analyse_apk_crypto(apks, AnalyseApkCrypto):
+    for apk in apks:
+        AnalyseApkCrypto(apk)
+
+
+def _setup_analyse_apk_elf(apks):
+    from analyse_elf import analyse_apk_elf
+    elf_bytes = sum(len(data) for _, data in _read_elf_files(apks))
+    return apks, len(apks), elf_bytes, analyse_apk_elf
+
+
+def _run_analyse_apk_elf(apks, analyse_apk_elf):
+    for apk in apks:
+        with zipfile.ZipFile(apk) as apk_zip:
+            analyse_apk_elf(apk_zip)
+
+
+def _setup_analyse_apk_elf_copies(apks):
+    from analyse_elf import analyse_apk_elf, DEFAULT_ABI_PRIORITY
+    from elf_cache import ElfResultCache
+    _, items, size, _ = _setup_analyse_apk_elf(apks)
+    return apks, items, size, (analyse_apk_elf, DEFAULT_ABI_PRIORITY, ElfResultCache)
+
+
+def _run_analyse_apk_elf_cached(apks, functions):
+    # With a new ELF cache, the copies of a library in an APK, and the libraries seen in earlier APKs, are hits
+    analyse_apk_elf, abi_priority, ElfResultCache = functions
+    with tempfile.TemporaryDirectory() as directory:
+        elf_cache = ElfResultCache(os.path.join(directory, 'elf_cache.db'))
+        for apk in apks:
+            with zipfile.ZipFile(apk) as apk_zip:
+                analyse_apk_elf(apk_zip, elf_cache)
+
+
+def _run_analyse_apk_elf_dedup(apks, functions):
+    analyse_apk_elf, abi_priority, _ = functions
+    for apk in apks:
+        with zipfile.ZipFile(apk) as apk_zip:
+            analyse_apk_elf(apk_zip, abi_priority=abi_priority)
+
+
+def _setup_analyse_elf(apks):
+    from analyse_elf import AnalyseElf
+    elf_files = _read_elf_files(apks)
+    return elf_files, len(elf_files), sum(len(data) for _, data in elf_files), AnalyseElf
+
+
+def _run_analyse_elf(elf_files, AnalyseElf):
+    for name, data in elf_files:
+        AnalyseElf(io.BytesIO(data), name)
+
+
+def _setup_match_crypto_name(apks):
+    from androguard.core.bytecodes.dvm import DalvikVMFormat
+    from analyse_elf import AnalyseElf
+    from crypto_names import match_crypto_name, crypto_name_matcher
+    strings = []
+    for apk in apks:
+        with zipfile.ZipFile(apk) as apk_zip:
+            for name in apk_zip.namelist():
+                if name.endswith('.dex'):
+                    strings += DalvikVMFormat(apk_zip.read(name)).get_strings()
+    for name, data in _read_elf_files(apks):
+        strings += AnalyseElf(io.BytesIO(data), name).symbol_table
+    size = sum(len(s.encode('utf-8', 'surrogatepass')) for s in strings)
+    return strings, len(strings) * MATCH_PASSES, size * MATCH_PASSES, (match_crypto_name, crypto_name_matcher)
+
+
+def _run_match_crypto_name(strings, functions):
+    match_crypto_name, crypto_name_matcher = functions
+    for _ in range(MATCH_PASSES):
+        crypto_name_matcher.match.cache_clear()
+        for s in strings:
+            match_crypto_name(s)
+
+
+# name: (setup, run, unit). setup(apks) returns (payload, items, bytes, function), and run(payload, function)
+# is timed. items and bytes are what one run processes, items are counted in unit.
+BENCHMARKS = {
+    'AnalyseApkCrypto': (_setup_analyse_apk_crypto, _run_analyse_apk_crypto, 'APKs'),
+    'analyse_apk_elf': (_setup_analyse_apk_elf, _run_analyse_apk_elf, 'APKs'),
+    'analyse_apk_elf_cached': (_setup_analyse_apk_elf_copies, _run_analyse_apk_elf_cached, 'APKs'),
+    'analyse_apk_elf_dedup': (_setup_analyse_apk_elf_copies, _run_analyse_apk_elf_dedup, 'APKs'),
+    'AnalyseElf': (_setup_analyse_elf, _run_analyse_elf, 'ELF files'),
+    'match_crypto_name': (_setup_match_crypto_name, _run_match_crypto_name, 'strings'),
+}
+
+
+def run_benchmark(name, apks, repeat):
+    """ Run the benchmark name over the APK files apks repeat times, in the calling process,
+        and return its best time, throughput and the peak memory of the process as a dict.
+    """
+    setup, run, unit = BENCHMARKS[name]
+    payload, items, size, function = setup(apks)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(payload, function)
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    return {
+        'unit': unit,
+        'items': items,
+        'mb': round(size / (1024 * 1024), 3),
+        'seconds': round(seconds, 4),
+        'items_per_sec': round(items / seconds, 2),
+        'mb_per_sec': round(size / (1024 * 1024) / seconds, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def _version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def environment():
+    """ Return what the results depend on besides the code: versions, machine and rules. """
+    return {
+        'python': platform.python_version(),
+        'androguard': _version('androguard'),
+        'pyelftools': _version('pyelftools'),
+        'pyahocorasick': _version('pyahocorasick'),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'ruleset': ruleset_fingerprint(),
+    }
+
+
+def run_benchmarks(apks, names, repeat):
+    """ Run the benchmarks names over apks, each in a new process, so their imports and memory don't
+        add up. Return the results by name.
+    """
+    results = {}
+    for name in names:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            results[name] = executor.submit(run_benchmark, name, apks, repeat).result()
+        result = results[name]
+        print('{:<22} {:>10.1f} {}/s {:>9.2f} MB/s {:>8.1f} MB peak'.format(
+            name, result['items_per_sec'], result['unit'], result['mb_per_sec'], result['peak_rss_mb']), flush=True)
+    return results
+
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE):
+    """ Print the change of each benchmark from baseline (a baseline dict, see __main__),
+        return the names of the benchmarks that regressed by more than tolerance.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        speed = result['items_per_sec'] / before['items_per_sec'] - 1
+        memory = result['peak_rss_mb'] / before['peak_rss_mb'] - 1
+        regressed = speed < -tolerance or memory > tolerance
+        print('{:<22} throughput {:+6.1%}  peak memory {:+6.1%}{}'.format(
+            name, speed, memory, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the analysis on a corpus of synthetic APKs, '
+        'save the results as a baseline or compare them with one')
+    defaults = SyntheticApkSpec()
+    parser.add_argument('--apks', type=int, default=20, help='number of synthetic APKs (default: 20)')
+    parser.add_argument('--classes', type=int, default=defaults.classes, help='classes per APK (default: %(default)s)')
+    parser.add_argument('--methods', type=int, default=defaults.methods, help='methods per class (default: %(default)s)')
+    parser.add_argument('--strings', type=int, default=defaults.strings, help='strings per method (default: %(default)s)')
+    parser.add_argument('--abis', default=','.join(defaults.abis),
+        help='comma separated ABIs with native libraries, among {} (default: %(default)s)'.format(', '.join(ABIS)))
+    parser.add_argument('--native-libs', type=int, default=defaults.native_libs,
+        help='native libraries per ABI (default: %(default)s)')
+    parser.add_argument('--native-lib-kb', type=int, default=defaults.native_lib_kb,
+        help='size of each native library in KB (default: %(default)s)')
+    parser.add_argument('--symbols', type=int, default=defaults.symbols,
+        help='dynamic symbols per native library (default: %(default)s)')
+    parser.add_argument('--planted-constants', type=int, default=defaults.planted_constants,
+        help='methods, and native libraries per ABI, with a crypto constant (default: %(default)s)')
+    parser.add_argument('--planted-names', type=int, default=defaults.planted_names,
+        help='strings, and native libraries per ABI, with a crypto name (default: %(default)s)')
+    parser.add_argument('--distinct-libs', action='store_true',
+        help='give each ABI its own native libraries, by default every ABI ships the same ones, '
+        'so deduplicating them and the ELF cache have copies to find')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='seed of the corpus (default: %(default)s)')
+    parser.add_argument('--corpus', metavar='DIR', help='write the corpus to DIR and keep it, instead of a temporary directory')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS), help='only run this benchmark, can be repeated')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the fastest is kept (default: 3)')
+    parser.add_argument('-o', '--output', metavar='PATH', help='save the results as a baseline in PATH')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with the baseline in PATH')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='relative change of throughput or memory reported as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    abis = tuple(abi for abi in args.abis.split(',') if abi)
+    if any(abi not in ABIS for abi in abis):
+        parser.error('unknown ABI in {}, choose among {}'.format(args.abis, ', '.join(ABIS)))
+    spec = SyntheticApkSpec(args.classes, args.methods, args.strings, abis, args.native_libs, args.native_lib_kb,
+                            args.symbols, args.planted_constants, args.planted_names, args.seed,
+                            shared_libs=not args.distinct_libs)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != BASELINE_VERSION:
+            parser.error('{} is not a baseline this version can read'.format(args.compare))
+
+    corpus = {'apks': args.apks, 'spec': spec._asdict()}
+    if baseline is not None and baseline['corpus'] != json.loads(json.dumps(corpus)):
+        print('Warning: the baseline was measured on another corpus: {}'.format(baseline['corpus']), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as directory:
+        apks = generate_corpus(args.corpus or directory, args.apks, spec)
+        print('{} synthetic APKs, {:.1f} MB'.format(len(apks), sum(map(os.path.getsize, apks)) / (1024 * 1024)))
+        results = run_benchmarks(apks, args.only or list(BENCHMARKS), args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': BASELINE_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'environment': environment(), 'corpus': corpus, 'results': results}, f, indent=2)
+    if baseline is not None:
+        current = environment()
+        changed = {key: (value, current.get(key)) for key, value in baseline['environment'].items()
+                   if current.get(key) != value}
+        if changed:
+            print('Changed since the baseline (before, now): {}'.format(changed))
+        sys.exit(1 if compare(baseline, results, args.tolerance) else 0)
@@ -0,0 +1,102 @@
+import time
+import _thread
+import threading
+from contextlib import contextmanager
+
+# Stages of the analysis that can be given a time budget, named as in StageMetrics:
+# loading the APK and its DEX files, the ELF files, the classes and methods, and the strings
+BUDGET_STAGES = ('dex', 'elf', 'classes', 'strings')
+
+
+def parse_stage_budgets(budgets):
+    """ Return the seconds of each stage of comma separated budgets like 'elf=60,classes=300' as a dict,
+        raise ValueError if a stage is unknown or a budget isn't a positive number.
+    """
+    result = {}
+    for budget in filter(None, (b.strip() for b in budgets.split(','))):
+        stage, _, seconds = budget.partition('=')
+        stage = stage.strip()
+        if stage not in BUDGET_STAGES:
+            raise ValueError('unknown stage {!r} in budgets, choose among {}'.format(stage, ', '.join(BUDGET_STAGES)))
+        try:
+            result[stage] = float(seconds)
+        except ValueError:
+            raise ValueError('budget of {} must be a number of seconds, not {!r}'.format(stage, seconds))
+        if result[stage] <= 0:
+            raise ValueError('budget of {} must be positive'.format(stage))
+    return result
+
+
+class Deadline:
+    """ The end of the time budget of a stage, checked by the loop of the stage between two items,
+        so a stage stops at a consistent point and keeps what it found so far.
+        A Deadline of None seconds never passes.
+
+        Accessible attributes:
+            hit: bool
+                Whether passed() returned True, i.e. the stage was cut short.
+    """
+    def __init__(self, seconds=None):
+        self.end = None if seconds is None else time.monotonic() + seconds
+        self.hit = False
+
+    def passed(self):
+        if not self.hit and self.end is not None and time.monotonic() >= self.end:
+            self.hit = True
+        return self.hit
+
+
+class _Alarm:
+    def __init__(self):
+        self.fired = False
+
+    def fire(self):
+        self.fired = True
+        _thread.interrupt_main()
+
+
+@contextmanager
+def interrupt_after(seconds):
+    """ Raise KeyboardInterrupt in the main thread if the block runs longer than seconds, like @timeout,
+        for code without a loop to check a Deadline in (androguard loading an APK). Yield an object
+        whose fired attribute tells a KeyboardInterrupt of the alarm from one of the user.
+        Outside of the main thread, or with seconds None, the block is never interrupted.
+    """
+    alarm = _Alarm()
+    if seconds is None or threading.current_thread() is not threading.main_thread():
+        yield alarm
+        return
+    timer = threading.Timer(seconds, alarm.fire)
+    timer.start()
+    try:
+        yield alarm
+    finally:
+        timer.cancel()
+        # If the alarm is firing right now, its interrupt is raised here rather than after the block
+        timer.join()
+
+
+# tests: a stage cut short by its deadline, and a block interrupted by its alarm
+if __name__ == '__main__':
+    assert parse_stage_budgets('elf=1.5, classes=300') == {'elf': 1.5, 'classes': 300.0}
+    for bad in ('java=1', 'elf=x', 'elf=0'):
+        try:
+            parse_stage_budgets(bad)
+            assert False, bad
+        except ValueError as e:
+            print(e)
+    deadline = Deadline(0.05)
+    done = 0
+    for _ in range(1000):
+        if deadline.passed():
+            break
+        time.sleep(0.001)
+        done += 1
+    assert deadline.hit and 0 < done < 1000
+    try:
+        with interrupt_after(0.05) as alarm:
+            time.sleep(1)
+        assert False
+    except KeyboardInterrupt:
+        assert alarm.fired
+    print('{} items before the deadline'.format(done))
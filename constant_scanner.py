@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+from constants import crypto_constants
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Below this many anchors, one bytes.find per anchor (a C-speed scan each) beats
+# walking an automaton over the buffer once, see the microbenchmark below: over 16 MB,
+# the 10 anchors of constants.py take about 60 ms naively and 200 ms with the automaton.
+# The two break even between about 190 and 290 anchors, depending on the run, and the
+# automaton is 1.2 to 1.5 times faster from 320 anchors on, 2.3 times at 768.
+AUTOMATON_MIN_ANCHORS = 320
+
+# Constants sharing a prefix at least this long are searched together by that prefix.
+MIN_SHARED_PREFIX = 8
+
+
+def _common_prefix(a: bytes, b: bytes):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return a[:i]
+    return a[:n]
+
+
+class ConstantScanner:
+    """ Find which constants of a table occur in a buffer, built once and shared by
+        the Java (method bytecode) and ELF (data sections) analyses.
+
+        Constants sharing a long prefix (e.g. sm2_p, sm2_a and sm2_order) are grouped
+        behind one anchor, so the buffer is scanned once per anchor rather than once
+        per constant, and a group is only verified where its anchor occurs.
+        If pyahocorasick is installed and the table has at least AUTOMATON_MIN_ANCHORS anchors,
+        all anchors are found in a single pass with an Aho-Corasick automaton.
+
+        Accessible attributes:
+            names: list[str]
+                Names of the constants, in the order of the table.
+
+            anchors: dict[bytes, list[tuple[str, bytes]]]
+                The keys are the anchors searched in the buffer, the values are the
+                (name, constant) pairs that start with the anchor.
+    """
+    def __init__(self, constants: dict, use_automaton=None):
+        self.names = list(constants.keys())
+        self._order = {name: i for i, name in enumerate(self.names)}
+        self.anchors = {}
+
+        group = []
+        prefix = b''
+        for name, value in sorted(constants.items(), key=lambda item: item[1]):
+            if group:
+                shared = _common_prefix(prefix, value)
+                if len(shared) >= min(MIN_SHARED_PREFIX, len(prefix), len(value)):
+                    group.append((name, value))
+                    prefix = shared
+                    continue
+                self.anchors[prefix] = group
+            group = [(name, value)]
+            prefix = value
+        if group:
+            self.anchors[prefix] = group
+
+        if use_automaton is None:
+            use_automaton = len(self.anchors) >= AUTOMATON_MIN_ANCHORS
+        self._automaton = None
+        if use_automaton and ahocorasick is not None and self.anchors:
+            # Bytes are mapped 1:1 to code points, pyahocorasick is usually built for str.
+            self._automaton = ahocorasick.Automaton()
+            for anchor in self.anchors:
+                self._automaton.add_word(anchor.decode('latin-1'), anchor)
+            self._automaton.make_automaton()
+
+    def scan(self, buffer, start=0, end=None, skip=()):
+        """ Return the names of the constants found in buffer[start:end], in the order of the table.
+            buffer can be bytes, bytearray or mmap, it's searched in place without slicing.
+            Names in skip are known to be found already and won't be looked for.
+        """
+        if end is None:
+            end = len(buffer)
+        found = set()
+        if self._automaton is not None:
+            text = str(memoryview(buffer)[start:end], 'latin-1')
+            for last, anchor in self._automaton.iter(text):
+                pos = last - len(anchor) + 1
+                for name, value in self.anchors[anchor]:
+                    if name not in found and name not in skip and text.startswith(value.decode('latin-1'), pos):
+                        found.add(name)
+        else:
+            for anchor, group in self.anchors.items():
+                todo = [(name, value) for name, value in group if name not in skip]
+                if len(todo) == 1 and todo[0][1] == anchor:
+                    if buffer.find(anchor, start, end) != -1:
+                        found.add(todo[0][0])
+                    continue
+                pos = buffer.find(anchor, start, end) if todo else -1
+                while pos != -1 and todo:
+                    for name, value in todo:
+                        if pos + len(value) <= end and buffer[pos:pos + len(value)] == value:
+                            found.add(name)
+                    todo = [(name, value) for name, value in todo if name not in found]
+                    pos = buffer.find(anchor, pos + 1, end)
+        return sorted(found, key=self._order.__getitem__)
+
+    def find_all(self, buffer, start=0, end=None):
+        """ Return a list of (offset, name, length) of every occurrence of the constants in buffer[start:end],
+            sorted by offset. Like scan, but doesn't stop at the first occurrence of each constant.
+        """
+        if end is None:
+            end = len(buffer)
+        hits = []
+        if self._automaton is not None:
+            text = str(memoryview(buffer)[start:end], 'latin-1')
+            for last, anchor in self._automaton.iter(text):
+                pos = last - len(anchor) + 1
+                for name, value in self.anchors[anchor]:
+                    if text.startswith(value.decode('latin-1'), pos):
+                        hits.append((start + pos, name, len(value)))
+        else:
+            for anchor, group in self.anchors.items():
+                pos = buffer.find(anchor, start, end)
+                while pos != -1:
+                    for name, value in group:
+                        if pos + len(value) <= end and buffer[pos:pos + len(value)] == value:
+                            hits.append((pos, name, len(value)))
+                    pos = buffer.find(anchor, pos + 1, end)
+        hits.sort()
+        return hits
+
+
+crypto_constants_scanner = ConstantScanner(crypto_constants)
+
+
+# Microbenchmark: scan time as the constant table grows
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            buffer = f.read()
+    else:
+        buffer = os.urandom(16 * 1024 * 1024)
+    print('Buffer: {:.1f} MB, pyahocorasick: {}'.format(
+        len(buffer) / 1024 / 1024, 'yes' if ahocorasick is not None else 'no'))
+    print('{:>10} {:>12} {:>12} {:>12}'.format('constants', 'naive/ms', 'grouped/ms', 'automaton/ms'))
+
+    for size in (len(crypto_constants), 48, 192, 256, 320, 384, 768):
+        table = dict(crypto_constants)
+        while len(table) < size:
+            table['random_{}'.format(len(table))] = os.urandom(16)
+
+        start = time.perf_counter()
+        naive = [name for name, value in table.items() if value in buffer]
+        naive_time = time.perf_counter() - start
+
+        times = []
+        for use_automaton in (False, True):
+            if use_automaton and ahocorasick is None:
+                times.append(float('nan'))
+                continue
+            scanner = ConstantScanner(table, use_automaton)
+            start = time.perf_counter()
+            result = scanner.scan(buffer)
+            times.append(time.perf_counter() - start)
+            assert result == naive, (result, naive)
+        print('{:>10} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+            size, naive_time * 1000, times[0] * 1000, times[1] * 1000))
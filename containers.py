@@ -0,0 +1,202 @@
+import io
+import re
+import sys
+import zlib
+import zipfile
+import logging
+from operator import attrgetter
+from typing import NamedTuple
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Archives searched for DEX and ELF files, e.g. SDKs shipped as assets/*.jar
+CONTAINER_EXTENSIONS = ('.jar', '.apk', '.zip', '.aar')
+PAYLOAD_EXTENSIONS = {'.dex': 'dex', '.so': 'elf'}
+PAYLOAD_MAGIC = {'dex': b'dex\n', 'elf': b'\x7fELF'}
+
+# Nested archives up to this size are read into memory, larger ones are streamed from their parent,
+# which decompresses them again whenever zipfile seeks backwards
+IN_MEMORY_CONTAINER_SIZE = 16 * 1024 * 1024
+
+# Raised by zipfile for a corrupt, truncated, encrypted or unsupported entry, which is skipped
+_ENTRY_ERRORS = (zipfile.BadZipFile, zlib.error, RuntimeError, EOFError, NotImplementedError)
+
+# DEX files loaded by Android, same as androguard's APK.get_dex_names
+dex_name_regex = re.compile(r'classes(\d*).dex')
+
+
+class NestedLimits(NamedTuple):
+    """ Bounds of the walk of the archives nested in an APK, against zip bombs and archives nesting themselves.
+
+        depth: levels of archives opened below the APK, 0 only searches the APK itself.
+        max_entries: entries of the archives nested in an APK, the walk stops past it.
+        max_entry_size: uncompressed bytes of an archive or DEX or ELF file, larger ones are skipped.
+        max_total_size: uncompressed bytes read in an APK, the walk stops past it.
+        max_ratio: entries compressed more than this many times are skipped.
+    """
+    depth: int = 2
+    max_entries: int = 10000
+    max_entry_size: int = 128 * 1024 * 1024
+    max_total_size: int = 1024 * 1024 * 1024
+    max_ratio: int = 100
+
+
+class NestedPayload(NamedTuple):
+    """ A DEX or ELF file (kind 'dex' or 'elf') found by walk_nested. path is its path in the APK,
+        through the archives containing it, e.g. 'assets/sdk.jar!/classes.dex'.
+    """
+    path: str
+    kind: str
+    data: bytes
+
+
+class _LimitReached(Exception):
+    pass
+
+
+def _extension(name):
+    dot = name.rfind('.')
+    return name[dot:].lower() if dot > name.rfind('/') else ''
+
+
+def _is_loaded_by_android(name):
+    """ Return whether an entry at the top of an APK is analysed anyway: the DEX files androguard loads,
+        and the libraries analyse_apk_elf analyses.
+    """
+    return dex_name_regex.match(name) is not None or (name.startswith('lib') and name.endswith('.so'))
+
+
+class _Walk:
+    def __init__(self, limits, kinds):
+        self.limits = limits
+        self.kinds = kinds
+        self.entries = 0
+        self.total_size = 0
+
+    def check(self, info, path):
+        """ Return whether the entry info at path may be read, raise _LimitReached if the walk must stop. """
+        if info.file_size > self.limits.max_entry_size:
+            logger.warning('Skipping {}: {} bytes uncompressed'.format(path, info.file_size))
+            return False
+        if info.compress_size and info.file_size / info.compress_size > self.limits.max_ratio:
+            logger.warning('Skipping {}: compressed {:.0f} times, probably a zip bomb'.format(
+                path, info.file_size / info.compress_size))
+            return False
+        if self.total_size + info.file_size > self.limits.max_total_size:
+            raise _LimitReached('more than {} bytes uncompressed'.format(self.limits.max_total_size))
+        self.total_size += info.file_size
+        return True
+
+    def walk(self, archive: zipfile.ZipFile, prefix, depth):
+        if depth > 0:
+            self.entries += len(archive.infolist())
+            if self.entries > self.limits.max_entries:
+                raise _LimitReached('more than {} entries'.format(self.limits.max_entries))
+        # Entries in the order of the archive, so a streamed archive is mostly read forwards
+        for info in sorted(archive.infolist(), key=attrgetter('header_offset')):
+            name = info.filename
+            if info.is_dir() or (depth == 0 and _is_loaded_by_android(name)):
+                continue
+            extension = _extension(name)
+            kind = PAYLOAD_EXTENSIONS.get(extension)
+            if kind in self.kinds:
+                path = prefix + name
+                if not self.check(info, path):
+                    continue
+                try:
+                    data = archive.read(info)
+                except _ENTRY_ERRORS as e:
+                    logger.warning('Ignoring {}: {}'.format(path, e))
+                    continue
+                if data[:4] == PAYLOAD_MAGIC[kind]:
+                    yield NestedPayload(path, kind, data)
+            elif extension in CONTAINER_EXTENSIONS and depth < self.limits.depth:
+                path = prefix + name
+                if not self.check(info, path):
+                    continue
+                yield from self.walk_container(archive, info, path, depth + 1)
+
+    def walk_container(self, archive, info, path, depth):
+        try:
+            if info.file_size <= IN_MEMORY_CONTAINER_SIZE:
+                stream = io.BytesIO(archive.read(info))
+            else:
+                stream = archive.open(info)
+            with stream, zipfile.ZipFile(stream) as nested:
+                yield from self.walk(nested, path + '!/', depth)
+        except _ENTRY_ERRORS + (zipfile.LargeZipFile,) as e:
+            logger.warning('Ignoring {}: {}'.format(path, e))
+
+
+def walk_nested(apk_zip: zipfile.ZipFile, limits=NestedLimits(), kinds=('dex', 'elf')):
+    """ Yield a NestedPayload for every DEX and ELF file (of kinds) in the APK outside of the places
+        Android loads them from, e.g. assets/*.dex or assets/*.so, and in the archives (jar, apk, zip, aar)
+        nested in the APK up to limits.depth levels deep. Nested archives are never extracted to disk,
+        those larger than IN_MEMORY_CONTAINER_SIZE are streamed from their parent one entry at a time,
+        and the DEX and ELF files are yielded one at a time.
+    """
+    walk = _Walk(limits, kinds)
+    try:
+        yield from walk.walk(apk_zip, '', 0)
+    except _LimitReached as e:
+        logger.warning('Stopped searching nested archives after {}'.format(e))
+
+
+class NestedScan(NamedTuple):
+    """ The NestedPayloads found by scan_nested, DEX files in dex and ELF files in elf. """
+    dex: list
+    elf: list
+
+
+def scan_nested(apk_zip: zipfile.ZipFile, limits, kinds=('dex', 'elf')):
+    """ Walk the archives nested in the APK once, see walk_nested, and return the DEX and ELF files
+        found as a NestedScan, so the Java and the ELF analysis share one walk and limits apply per APK.
+    """
+    scan = NestedScan([], [])
+    for payload in walk_nested(apk_zip, limits, kinds):
+        getattr(scan, payload.kind).append(payload)
+    if scan.dex or scan.elf:
+        logger.debug('Nested DEX and ELF files: {}'.format(
+            ', '.join(payload.path for payload in scan.dex + scan.elf)))
+    return scan
+
+
+def _corrupt_archive(entries, corrupt=(), encrypted=()):
+    """ Return a stored zip archive of entries (name, bytes), the contents of the corrupt ones altered
+        after their CRC was computed, and the encrypted ones flagged as encrypted.
+    """
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+        offsets = {info.filename: info.header_offset for info in archive.infolist()}
+    data = bytearray(stream.getvalue())
+    for name in corrupt:
+        content = dict(entries)[name]
+        data[data.index(content) + len(content) - 1] ^= 0xff
+    central_directory = data.index(b'PK\x01\x02')
+    for name in encrypted:
+        # flag bits of the local header, and of the central directory header, 46 bytes before the name
+        data[offsets[name] + 6] |= 0x1
+        data[data.index(name.encode(), central_directory) - 46 + 8] |= 0x1
+    return bytes(data)
+
+
+# tests: walk an APK with corrupt and encrypted nested entries,
+# and print the nested DEX and ELF files of the APKs given as arguments
+if __name__ == '__main__':
+    logging.basicConfig()
+    dex = b'dex\n035\0' + b'D' * 64
+    elf = b'\x7fELF' + b'E' * 64
+    inner = _corrupt_archive([('classes.dex', dex + b'1'), ('lib/libinner.so', elf + b'1')], ['classes.dex'])
+    apk = io.BytesIO(_corrupt_archive([('classes.dex', dex), ('assets/bad.so', elf + b'2'),
+                                       ('assets/locked.dex', dex + b'3'), ('assets/good.so', elf + b'4'),
+                                       ('assets/sdk.jar', inner)], ['assets/bad.so'], ['assets/locked.dex']))
+    with zipfile.ZipFile(apk) as apk_zip:
+        paths = [payload.path for payload in walk_nested(apk_zip)]
+    assert paths == ['assets/good.so', 'assets/sdk.jar!/lib/libinner.so'], paths
+
+    for filename in sys.argv[1:]:
+        with zipfile.ZipFile(filename) as apk_zip:
+            for payload in walk_nested(apk_zip):
+                print('{}: {} {} bytes'.format(filename, payload.path, len(payload.data)))
@@ -0,0 +1,118 @@
+import os
+import sys
+import heapq
+import hashlib
+import logging
+from result_cache import file_sha256
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Files found in directories are analysed if their names end with one of these, case-insensitively
+APK_EXTENSIONS = ('.apk',)
+
+# Number of paths looked ahead to schedule the largest APKs first
+SCHEDULE_WINDOW = 1000
+
+
+def iter_paths(paths, from_file=None):
+    """ Yield the paths given, then those listed in the file from_file, one per line ('-' for stdin).
+    """
+    yield from paths
+    if from_file is None:
+        return
+    f = sys.stdin if from_file == '-' else open(from_file)
+    try:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.strip():
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def walk_apk_files(path):
+    """ Yield the APK files (see APK_EXTENSIONS) under the directory path, recursively,
+        as the directories are read, without listing the whole tree first.
+        Symbolic links to directories aren't followed, so they can't make the walk loop.
+    """
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(APK_EXTENSIONS) and entry.is_file():
+                        yield entry.path
+        except OSError as e:
+            logger.warning('Ignoring {}: {}'.format(directory, e))
+        stack.extend(reversed(subdirs))
+
+
+def iter_apk_paths(paths):
+    """ Yield the files among paths, and the APK files under the directories among them.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from walk_apk_files(path)
+        else:
+            yield path
+
+
+def largest_first(paths, window=SCHEDULE_WINDOW):
+    """ Yield paths, the largest files first among the next window paths, so a huge APK near the end
+        doesn't keep one worker busy long after the others are done. Only window paths are held at once.
+    """
+    heap = []
+    for index, path in enumerate(paths):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        heapq.heappush(heap, (-size, index, path))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def parse_shard(text):
+    """ Parse a shard given as 'i/N', the i-th of N shards counting from 1, return (i, N). """
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError('shard must be given as i/N, e.g. 1/4, not {!r}'.format(text))
+    if not 1 <= index <= count:
+        raise ValueError('shard {} is not between 1/{} and {}/{}'.format(text, count, count, count))
+    return index, count
+
+
+def shard_of(path, count, by='path'):
+    """ Return the shard (from 1 to count) of the APK at path, by a hash of the path as given
+        (normalized, but not made absolute, so it's the same on every machine sharing a directory),
+        or of the content of the file (by='content'), so that copies of an APK end up in the same shard.
+    """
+    if by == 'content':
+        try:
+            key = file_sha256(path).encode()
+        except OSError:
+            key = path.encode(errors='surrogateescape')
+    else:
+        key = os.path.normpath(path).encode(errors='surrogateescape')
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big') % count + 1
+
+
+def shard_paths(paths, index, count, by='path'):
+    """ Yield the paths in shard index of count, see shard_of. """
+    for path in paths:
+        if shard_of(path, count, by) == index:
+            yield path
+
+
+# tests: print the APK files found under the arguments, in the order they would be scheduled
+if __name__ == '__main__':
+    for path in largest_first(iter_apk_paths(iter_paths(sys.argv[1:]))):
+        print(os.path.getsize(path), path)
@@ -1,22 +1,181 @@
 import re
+import sys
+import random
+from bisect import bisect_right
+from itertools import accumulate
+from functools import lru_cache
 
 crypto_names = ['sm2', 'sm3', 'sm4', 'sms4']
 regex_base64 = re.compile(r'^([A-Za-z0-9+/]{4})*([A-Za-z0-9+/]{3}=|[A-Za-z0-9+/]{2}==)?$')
 
 
-def match_crypto_name(s: str, exclude_cert=False):
-    """ Check if s contains a crypto name in crypto_names case-insensitively.
-        Return the crypto name that matches, return None if no names match.
+def _match_crypto_name_slow(s: str, names, exclude_cert=False):
+    """ Reference implementation of CryptoNameMatcher.match, used to verify it.
     """
-    if exclude_cert and (len(s) >= 300 or 'CERTIFICATE' in s):  # Exclude certificate strings. 
+    if exclude_cert and (len(s) >= 300 or 'CERTIFICATE' in s):  # Exclude certificate strings.
         return None
-    
+
     s_fold = s.casefold()
     if 'm3u8' in s_fold or 'lambda' in s_fold:
         return None
     if s.isascii() and regex_base64.match(s) and s.endswith('=') and 'sm4=' not in s_fold:
         return None
 
-    for word in crypto_names:
+    for word in names:
         if word in s_fold:
             return word
+
+
+class CryptoNameMatcher:
+    """ Check if strings contain a crypto name case-insensitively, with the crypto names
+        and the exclusions compiled into regexes.
+
+        ASCII strings (nearly all class, method, symbol names and strings) are rejected by
+        one regex search unless they contain a name, other strings are case folded
+        as in the reference implementation, since case folding may expand characters.
+        Results of match() are memoized in a bounded LRU cache, as symbol and method names repeat a lot.
+    """
+    def __init__(self, names, cache_size=1 << 16):
+        self.names = list(names)
+        # Matched against lowercased ASCII, where lower() is the same as casefold()
+        self._names_regex = re.compile('|'.join(re.escape(name.casefold()) for name in self.names))
+        self._exclude_regex = re.compile('m3u8|lambda')
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    def _match_ascii_candidate(self, s: str):
+        # s is ASCII and contains a crypto name, apply the exclusions
+        s_fold = s.lower()
+        if self._exclude_regex.search(s_fold):
+            return None
+        if s.endswith('=') and regex_base64.match(s) and 'sm4=' not in s_fold:
+            return None
+        for word in self.names:
+            if word in s_fold:
+                return word
+
+    def _match(self, s: str, exclude_cert=False):
+        """ Return the crypto name that s contains, return None if no names match.
+        """
+        if exclude_cert and (len(s) >= 300 or 'CERTIFICATE' in s):  # Exclude certificate strings.
+            return None
+        if not s.isascii():
+            return _match_crypto_name_slow(s, self.names)
+        if self._names_regex.search(s.lower()) is None:
+            return None
+        return self._match_ascii_candidate(s)
+
+    def match_many(self, strings, exclude_cert=False):
+        """ Return a list with the crypto name matched for each of strings, or None.
+            The ASCII strings are joined and searched for all crypto names in one pass,
+            only the few candidates found are checked further.
+        """
+        strings = list(strings)
+        result = [None] * len(strings)
+        joined = '\n'.join(strings)
+        if joined.isascii():
+            index = range(len(strings))
+            lengths = list(accumulate(map(len, strings), initial=0))
+        else:
+            index = []
+            for i, s in enumerate(strings):
+                if s.isascii():
+                    index.append(i)
+                else:
+                    result[i] = self._match(s, exclude_cert)
+            joined = '\n'.join(strings[i] for i in index)
+            lengths = list(accumulate((len(strings[i]) for i in index), initial=0))
+        # The k-th string starts at lengths[k] + k in joined
+        starts = [length + k for k, length in enumerate(lengths[:-1])]
+
+        last = -1
+        for m in self._names_regex.finditer(joined.lower()):
+            k = bisect_right(starts, m.start()) - 1
+            if k == last:
+                continue
+            last = k
+            i = index[k]
+            s = strings[i]
+            if exclude_cert and (len(s) >= 300 or 'CERTIFICATE' in s):  # Exclude certificate strings.
+                continue
+            result[i] = self._match_ascii_candidate(s)
+        return result
+
+
+crypto_name_matcher = CryptoNameMatcher(crypto_names)
+
+
+def match_crypto_name(s: str, exclude_cert=False):
+    """ Check if s contains a crypto name in crypto_names case-insensitively.
+        Return the crypto name that matches, return None if no names match.
+    """
+    return crypto_name_matcher.match(s, exclude_cert)
+
+
+def match_crypto_names(strings, exclude_cert=False):
+    """ Like match_crypto_name, for a list of strings at once. Return a list of the results.
+    """
+    return crypto_name_matcher.match_many(strings, exclude_cert)
+
+
+@lru_cache(maxsize=None)
+def _crypto_name_byte_patterns():
+    """ Return (regex, variants, width) to find crypto names in UTF-8 bytes, see iter_crypto_name_positions.
+        regex matches the names in lowercased bytes, variants are the encodings of the non-ASCII characters
+        whose case folding contains a character of a name (like U+017F LATIN SMALL LETTER LONG S or
+        U+00DF LATIN SMALL LETTER SHARP S, no characters outside the BMP do), and width is the most bytes
+        a name decoded from UTF-8 can take on either side of one of them.
+    """
+    chars = set(''.join(name.casefold() for name in crypto_names))
+    variants = [chr(c).encode() for c in range(0x80, 0x10000)
+                if not 0xd800 <= c < 0xe000 and chars.intersection(chr(c).casefold())]
+    regex = re.compile(b'|'.join(re.escape(name.casefold().encode()) for name in crypto_names))
+    return regex, variants, 3 * max(map(len, crypto_names))
+
+
+def iter_crypto_name_positions(buff, start=0, end=None):
+    """ Yield positions in buff[start:end] (bytes or mmap) where the UTF-8 encoding of a string
+        matched by match_crypto_name may contain the crypto name, without decoding buff.
+        Every string in buff containing a crypto name once decoded contains a yielded position
+        no later than the name, but not every position is a match, the exclusions aren't applied.
+    """
+    regex, variants, width = _crypto_name_byte_patterns()
+    end = len(buff) if end is None else end
+    lowered = buff[start:end].lower()   # Only ASCII letters are lowered
+    for m in regex.finditer(lowered):
+        yield start + m.start()
+    # Names spelled with non-ASCII characters are checked by decoding the bytes around those
+    for variant in variants:
+        pos = buff.find(variant, start, end)
+        while pos != -1:
+            around = buff[max(pos - width, start):min(pos + width, end)]
+            around = around.decode('utf-8', errors='replace').casefold()
+            if any(name in around for name in crypto_names):
+                yield pos
+            pos = buff.find(variant, pos + 1, end)
+
+
+# tests: compare with the reference implementation on a golden corpus,
+# plus the lines of any files given as arguments (e.g. dumped DEX strings)
+if __name__ == '__main__':
+    corpus = [
+        '', 'sm2', 'SM3', 'Sm4', 'sMs4', 'sms4', 'xSM4Util', 'Lcom/example/SM2Engine;', 'sm2sm3', 'sm3sm2',
+        'EVP_sm4_cbc', 'SM4=', 'c200=', 'QUJDc200', 'abcdsm4=', 'sm3u8', 'playlist.M3U8?sm4', 'lambda$sm2$0',
+        'LAMBDA_SM3', 'sm', 'm2', 's m2', 'sm_2', 'ßm2', 'ſm3', 'ＳＭ４', 'sm４', 'ﬆsm4', 'SM2 K', 'sm2é',
+        '-----BEGIN CERTIFICATE----- sm2', 'sm2' + 'a' * 300, 'sm2' + 'a' * 296, 'sm2\nsm3', 'a\nsm4', 'sm2\x00',
+    ]
+    rng = random.Random(0)
+    alphabet = 'sSmM234aAb=+/\n\x00ßſKé8ulLdD'
+    corpus += [''.join(rng.choice(alphabet) for _ in range(rng.randrange(12))) for _ in range(200000)]
+    for filename in sys.argv[1:]:
+        with open(filename, encoding='utf-8', errors='surrogateescape') as f:
+            corpus += f.read().split('\n')
+
+    for exclude_cert in (False, True):
+        expected = [_match_crypto_name_slow(s, crypto_names, exclude_cert) for s in corpus]
+        assert match_crypto_names(corpus, exclude_cert) == expected
+        assert [match_crypto_name(s, exclude_cert) for s in corpus] == expected
+    for s in corpus:
+        if _match_crypto_name_slow(s, crypto_names) is not None:
+            b = s.encode('utf-8', errors='surrogateescape')
+            assert any(True for _ in iter_crypto_name_positions(b'\x00' + b + b'\x00')), s
+    print('{} strings OK'.format(len(corpus)))
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import queue
+import signal
+import socket
+import logging
+import argparse
+import importlib
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from worker_pool import WorkerPool
+from write_result import ResultFiles, csv_cell
+from main import TIMEOUT, analyse_apk_rows, add_analysis_arguments, get_analyse_options, setup_logger, write_error
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Latency statistics are computed over this many last APKs
+LATENCY_WINDOW = 1000
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 3),
+        'p50': round(values[len(values) // 2], 3),
+        'p95': round(values[min(len(values) - 1, len(values) * 95 // 100)], 3),
+        'max': round(values[-1], 3),
+    }
+
+
+class AnalysisDaemon:
+    """ Analyse APKs submitted at any time in a pool of warm worker processes.
+        The analysis modules are imported once, before the workers are started, so a job only
+        pays for the analysis itself. Jobs are dispatched by a background thread.
+
+        Accessible attributes:
+            jobs: int
+                Number of worker processes.
+
+            completed, failed: int
+                Number of APKs analysed, and of those that failed (timed out, not an APK, ...).
+
+            error: Exception
+                What stopped the dispatcher, if it stopped. Every job then fails with it.
+    """
+    def __init__(self, jobs, analyse_options, max_rss=None, recycle_rss=None):
+        # Imported before the workers are forked, so they start with androguard loaded.
+        # Only the side effect is wanted, hence import_module rather than an unused name.
+        importlib.import_module('analyse_apk')
+
+        self.jobs = jobs
+        self.elf_only = analyse_options.get('elf_only', False)
+        self.abis = analyse_options.get('abi_priority') is not None
+        self.completed = 0
+        self.failed = 0
+        self.error = None
+        self._outputs = set()     # Output directories of the requests being served
+        self._pool = WorkerPool(partial(analyse_apk_rows, **analyse_options), jobs, TIMEOUT, max_rss, recycle_rss)
+        self._queue = queue.Queue()
+        self._running = {}      # index: (future, submitted, started)
+        self._next_index = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._waits = deque(maxlen=LATENCY_WINDOW)
+        self._started = time.time()
+        self._lock = threading.Lock()
+        # Wakes the dispatcher up when a job is queued while it waits for the workers
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def submit(self, apk_file):
+        """ Queue an APK, return a Future of the (result, error) of the worker, see WorkerPool. """
+        future = Future()
+        with self._lock:
+            if self.error is not None:
+                future.set_exception(self.error)
+                return future
+            index = self._next_index
+            self._next_index += 1
+            self._queue.put((index, apk_file, future, time.monotonic()))
+        self._wake()
+        return future
+
+    def claim_output(self, output):
+        """ Reserve the directory output for one request, return False if another request is writing to it. """
+        with self._lock:
+            if output in self._outputs:
+                return False
+            self._outputs.add(output)
+            return True
+
+    def release_output(self, output):
+        with self._lock:
+            self._outputs.discard(output)
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            pass    # The buffer is full of wake-ups already
+
+    def _dispatch(self):
+        try:
+            self._dispatch_jobs()
+        except Exception as e:
+            logger.critical('The dispatcher stopped, failing every job: {!r}'.format(e))
+            self._fail_jobs(e)
+
+    def _fail_jobs(self, error):
+        with self._lock:
+            self.error = error
+            futures = [future for future, _, _ in self._running.values()]
+            self._running.clear()
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    futures.append(job[2])
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _dispatch_jobs(self):
+        while True:
+            while self._pool.has_idle_worker():
+                try:
+                    # Only block if there is nothing else to wait for
+                    job = self._queue.get(block=not self._pool.busy_count())
+                except queue.Empty:
+                    break
+                if job is None:
+                    return
+                index, apk_file, future, submitted = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                with self._lock:
+                    self._running[index] = (future, submitted, time.monotonic())
+                self._pool.submit(index, apk_file)
+
+            for index, apk_file, result, error in self._pool.poll(wake=[self._wake_r]):
+                now = time.monotonic()
+                with self._lock:
+                    future, submitted, started = self._running.pop(index)
+                    self._latencies.append(now - submitted)
+                    self._waits.append(started - submitted)
+                    self.completed += 1
+                    self.failed += error is not None
+                future.set_result((result, error))
+            try:
+                self._wake_r.recv(4096)
+            except BlockingIOError:
+                pass
+
+    def analyse(self, apk_file, future, results=None):
+        """ Wait for the job of future, write its rows to results (ResultFiles) if given,
+            and return the outcome as a JSON serializable dict.
+        """
+        result, error = future.result()
+        if error is not None:
+            status = write_error(results, apk_file, error)
+            return {'apk': apk_file, 'status': status, 'error': str(error)}
+        rows, time_consumed = result
+        if results is not None:
+            results.write_rows(rows)
+            results.write_metrics(apk_file, 'ok', rows.metrics)
+        logger.debug('Analyse of {} consumed {} seconds'.format(apk_file, time_consumed))
+        return {
+            'apk': apk_file,
+            'status': 'ok',
+            'time_consumed': time_consumed,
+            'java': [[csv_cell(cell) for cell in row] for row in rows.java],
+            'elf': [[csv_cell(cell) for cell in row] for row in rows.elf],
+            'overview': None if rows.overview is None else [csv_cell(cell) for cell in rows.overview],
+            'metrics': rows.metrics,
+        }
+
+    def stats(self):
+        """ Return the queue depth, jobs in flight, counts and latencies (seconds from submission
+            to result, and spent queued) of the last LATENCY_WINDOW APKs.
+        """
+        with self._lock:
+            return {
+                'workers': self.jobs,
+                'queued': self._queue.qsize(),
+                'in_flight': len(self._running),
+                'completed': self.completed,
+                'failed': self.failed,
+                'uptime': round(time.time() - self._started, 1),
+                'latency': _summary(self._latencies),
+                'queue_wait': _summary(self._waits),
+            }
+
+    def close(self):
+        self._queue.put(None)
+        self._wake()
+        self._thread.join()
+        self._pool.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """ POST /analyse with {"apk_files": [...], "output": dir, "metrics": bool} streams back one
+        JSON line per APK, in order, and appends the rows to the result CSV files in output if given.
+        It fails with 409 if another request is writing to output, and 500 if the dispatcher stopped.
+        GET /stats returns AnalysisDaemon.stats().
+    """
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.analysis.stats()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/analyse':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            apk_files = request['apk_files']
+            output = request.get('output')
+            if not isinstance(apk_files, list) or not all(isinstance(f, str) for f in apk_files):
+                raise TypeError('apk_files must be a list of paths')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, explain=str(e))
+            return
+
+        daemon = self.server.analysis
+        if daemon.error is not None:
+            self.send_error(500, 'Dispatcher stopped', 'the dispatcher stopped: {!r}'.format(daemon.error))
+            return
+        if output:
+            output = os.path.abspath(output)
+            if not daemon.claim_output(output):
+                self.send_error(409, 'Output directory in use', 'another request is writing to {}'.format(output))
+                return
+        try:
+            self._analyse(daemon, apk_files, output, request.get('metrics', False))
+        finally:
+            if output:
+                daemon.release_output(output)
+
+    def _analyse(self, daemon, apk_files, output, metrics):
+        futures = [(apk_file, daemon.submit(apk_file)) for apk_file in apk_files]
+        results = None
+        if output:
+            os.makedirs(output, exist_ok=True)
+            # Appended to the files of earlier requests, the headers are only written to new files
+            results = ResultFiles(output, daemon.elf_only, metrics, append=True, abis=daemon.abis)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for apk_file, future in futures:
+                try:
+                    record = daemon.analyse(apk_file, future, results)
+                except Exception as e:      # e.g. the result files can't be written
+                    logger.critical('Failed to return the result of {}: {}'.format(apk_file, e))
+                    record = {'apk': apk_file, 'status': 'error', 'error': str(e)}
+                self.wfile.write(json.dumps(record).encode() + b'\n')
+                self.wfile.flush()
+        finally:
+            if results is not None:
+                results.close()
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}'.format(self.address_string(), format % args))
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(daemon, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """ Serve the HTTP API of daemon (an AnalysisDaemon) on host:port until interrupted or terminated. """
+    signal.signal(signal.SIGTERM, _interrupt)
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.analysis = daemon
+    logger.info('Analysis daemon with {} workers listening on http://{}:{}'.format(daemon.jobs, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the analysis over HTTP with warm worker processes, '
+        'see daemon_client.py')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on (default: {})'.format(DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on (default: {})'.format(DEFAULT_PORT))
+    parser.add_argument('-o', '--output', default='./', help='a directory to save the log and profiles')
+    add_analysis_arguments(parser)
+    args = parser.parse_args()
+
+    path = args.output
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    setup_logger(path)
+    analyse_options = get_analyse_options(parser, args, path)
+    serve(AnalysisDaemon(args.jobs or os.cpu_count(), analyse_options, args.max_rss, args.recycle_rss),
+          args.host, args.port)
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import argparse
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from corpus import iter_paths, iter_apk_paths
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+
+def analyse(apk_files, output=None, metrics=False, url=DEFAULT_URL):
+    """ Send APKs to the analysis daemon at url (see daemon.py), and yield the result of each
+        as a dict, in order, as soon as it's done. Paths are made absolute, since the daemon
+        runs in another directory. If output is given, the daemon writes the result files there.
+    """
+    request = {'apk_files': [os.path.abspath(f) for f in apk_files], 'metrics': metrics}
+    if output:
+        request['output'] = os.path.abspath(output)
+    request = Request(url + '/analyse', json.dumps(request).encode(), {'Content-Type': 'application/json'})
+    with urlopen(request) as response:
+        for line in response:
+            yield json.loads(line)
+
+
+def get_stats(url=DEFAULT_URL):
+    """ Return the queue depth, jobs in flight and latencies of the daemon at url. """
+    with urlopen(url + '/stats') as response:
+        return json.load(response)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyse APKs with a running daemon.py, '
+        'printing the result of each APK as a JSON line')
+    parser.add_argument('apk_file', nargs='*', help='APK files, or directories searched recursively for APK files')
+    parser.add_argument('--from-file', metavar='PATH',
+        help='also analyse the APK files or directories listed in PATH, one per line, - for standard input')
+    parser.add_argument('-o', '--output', help='a directory where the daemon saves the result files')
+    parser.add_argument('--metrics', action='store_true', help='also save metrics.jsonl to the output directory')
+    parser.add_argument('--url', default=DEFAULT_URL, help='URL of the daemon (default: {})'.format(DEFAULT_URL))
+    parser.add_argument('--stats', action='store_true', help='print the statistics of the daemon and exit')
+    args = parser.parse_args()
+
+    if args.stats:
+        print(json.dumps(get_stats(args.url), indent=2))
+        sys.exit(0)
+    if not args.apk_file and args.from_file is None:
+        parser.error('no APK files given')
+    apk_files = list(iter_apk_paths(iter_paths(args.apk_file, args.from_file)))
+    failed = received = 0
+    try:
+        for record in analyse(apk_files, args.output, args.metrics, args.url):
+            print(json.dumps(record), flush=True)
+            received += 1
+            failed += record.get('status') != 'ok'
+    except HTTPError as e:
+        # e.g. the output directory is in use, or the daemon can't dispatch jobs any more
+        sys.stderr.write('The daemon refused the request: {} {}\n'.format(e.code, e.reason))
+    if received < len(apk_files):
+        # The daemon stopped before answering for every APK
+        sys.stderr.write('No result for {} of {} APKs\n'.format(len(apk_files) - received, len(apk_files)))
+        failed += len(apk_files) - received
+    sys.exit(1 if failed else 0)
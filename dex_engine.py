@@ -0,0 +1,500 @@
+import io
+import sys
+import struct
+import zipfile
+from functools import partial
+from androguard.core.bytecodes import mutf8
+from constant_scanner import crypto_constants_scanner
+from dex_index import index_crypto_constants
+
+# Length in bytes of each instruction by opcode (the low byte of its first code unit),
+# as decoded by androguard's linear sweep for non-odex files: 0xe3 - 0xff are invalid, 2 bytes.
+_FORMAT_LENGTHS = (
+    # 0x00 - 0x0f
+    2, 2, 4, 6, 2, 4, 6, 2, 4, 6, 2, 2, 2, 2, 2, 2,
+    # 0x10 - 0x1f
+    2, 2, 2, 4, 6, 4, 4, 6, 10, 4, 4, 6, 4, 2, 2, 4,
+    # 0x20 - 0x2f
+    4, 2, 4, 4, 6, 6, 6, 2, 2, 4, 6, 6, 6, 4, 4, 4,
+    # 0x30 - 0x3f
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 2, 2,
+) + (
+    (2,) * 4            # 0x40 - 0x43: unused
+    + (4,) * 42         # 0x44 - 0x6d: aget, aput, iget, iput, sget, sput
+    + (6,) * 5          # 0x6e - 0x72: invoke-kind
+    + (2,)              # 0x73: unused
+    + (6,) * 5          # 0x74 - 0x78: invoke-kind/range
+    + (2,) * 23         # 0x79 - 0x8f: unused, unop
+    + (4,) * 32         # 0x90 - 0xaf: binop
+    + (2,) * 32         # 0xb0 - 0xcf: binop/2addr
+    + (4,) * 19         # 0xd0 - 0xe2: binop/lit16, binop/lit8
+    + (2,) * 29         # 0xe3 - 0xff: invalid
+)
+assert len(_FORMAT_LENGTHS) == 256
+
+# Jumbo opcodes (0xNNff) androguard still decodes: 0x00ff - 0x26ff
+_EXTENDED_LENGTHS = dict(
+    [(op << 8 | 0xff, 8) for op in (0x00, 0x01, 0x03) + tuple(range(0x14, 0x22))]
+    + [(op << 8 | 0xff, 10) for op in (0x02, 0x04) + tuple(range(0x06, 0x14)) + (0x05,) + tuple(range(0x22, 0x27))]
+)
+
+# packed-switch, sparse-switch and fill-array-data payloads
+_PAYLOAD_IDENTS = frozenset((0x0100, 0x0200, 0x0300))
+
+CONST_STRING, CONST_STRING_JUMBO, CONST_CLASS, NEW_INSTANCE = 0x1a, 0x1b, 0x1c, 0x22
+INVOKE_OPS = frozenset(range(0x6e, 0x73)) | frozenset(range(0x74, 0x79))
+_REF_OPS = INVOKE_OPS | {CONST_STRING, CONST_STRING_JUMBO, CONST_CLASS, NEW_INSTANCE}
+
+
+def _read_uleb128(buff, off):
+    result = shift = 0
+    while True:
+        b = buff[off]
+        off += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, off
+        shift += 7
+
+
+def _payload_length(insns, idx, ident):
+    """ Return the length of the payload at idx the way androguard decodes it.
+        Raise ValueError where androguard fails to decode it.
+    """
+    available = len(insns) - idx
+    if available < (4 if ident == 0x0200 else 8):
+        raise ValueError('Invalid payload 0x{:x} at 0x{:x}'.format(ident, idx))
+    if ident == 0x0100:     # packed-switch-payload, androguard reads at most available - 16 targets
+        size, = struct.unpack_from('<H', insns, idx + 2)
+        read = size if size * 4 <= available else available - 16
+        if read > 0 and 8 + read * 4 > available:
+            raise ValueError('Invalid payload 0x{:x} at 0x{:x}'.format(ident, idx))
+        return 8 + size * 4
+    if ident == 0x0200:     # sparse-switch-payload
+        size, = struct.unpack_from('<H', insns, idx + 2)
+        if 4 + size * 8 > available:
+            raise ValueError('Invalid payload 0x{:x} at 0x{:x}'.format(ident, idx))
+        return 4 + size * 8
+    # fill-array-data-payload
+    width, size = struct.unpack_from('<HI', insns, idx + 2)
+    return ((size * width + 1) // 2 + 4) * 2
+
+
+def iter_references(insns):
+    """ Decode insns linearly like androguard, yield (opcode, index) of the instructions
+        that reference strings, types and methods (const-string, const-class, new-instance, invoke-*).
+    """
+    max_idx = len(insns)
+    idx = 0
+    while idx < max_idx:
+        op = insns[idx]
+        if (op == 0x00 or op == 0xff) and idx + 2 < max_idx:
+            ident = insns[idx] | insns[idx + 1] << 8
+            if ident in _PAYLOAD_IDENTS:
+                idx += _payload_length(insns, idx, ident)
+                continue
+            if ident in _EXTENDED_LENGTHS:
+                if idx + _EXTENDED_LENGTHS[ident] > max_idx:
+                    raise ValueError('Invalid instruction 0x{:x} at 0x{:x}'.format(ident, idx))
+                idx += _EXTENDED_LENGTHS[ident]
+                continue
+
+        length = _FORMAT_LENGTHS[op]
+        if idx + length > max_idx:
+            return      # androguard decodes the rest as one unresolved instruction
+        if op in _REF_OPS:
+            if op == CONST_STRING_JUMBO:
+                yield op, struct.unpack_from('<I', insns, idx + 2)[0]
+            else:
+                yield op, struct.unpack_from('<H', insns, idx + 2)[0]
+        idx += length
+
+
+class DexMethod:
+    """ A method defined in a DEX file (an encoded_method), providing the parts of androguard's
+        EncodedMethod interface used by analyse_apk.py and dex_index.py.
+    """
+    def __init__(self, dex, method_idx, code_off):
+        self.dex = dex
+        self.method_idx = method_idx
+        self.code_off = code_off
+        self.class_name, self.name, self.descriptor = dex.get_method_info(method_idx)
+
+    def get_name(self):
+        return self.name
+
+    def get_class_name(self):
+        return self.class_name
+
+    def get_descriptor(self):
+        return self.descriptor
+
+    def get_code_off(self):
+        return self.code_off
+
+    def get_code(self):
+        return self if self.code_off else None
+
+    def get_bc(self):
+        return self
+
+    def get_raw(self):
+        """ Return the instructions of the method. """
+        return self.dex.get_insns(self.code_off)
+
+    def __repr__(self):
+        return '<DexMethod {}->{}{}>'.format(self.class_name, self.name, self.descriptor)
+
+
+class DexClass:
+    def __init__(self, name, methods):
+        self.name = name
+        self.methods = methods
+
+
+class DexFile:
+    """ A minimal DEX parser: only the header, string_ids, type_ids, proto_ids, method_ids,
+        class_defs, class_data and code_items are read, strings are decoded on demand.
+
+        Accessible attributes:
+            classes: list[DexClass]
+                The classes defined in the DEX, in the order of class_defs.
+
+        release() drops the buffer and the tables, keeping only the classes and their methods,
+        reload(buff) loads them again from the same DEX.
+    """
+    def __init__(self, buff):
+        self.reload(buff)
+        class_defs_size, class_defs_off = struct.unpack_from('<II', buff, 0x60)
+        self.classes = []
+        for i in range(class_defs_size):
+            class_idx, _, _, _, _, _, class_data_off, _ = struct.unpack_from('<8I', buff, class_defs_off + i * 32)
+            self.classes.append(DexClass(self.get_type(class_idx), self._read_class_data(class_data_off)))
+
+    def reload(self, buff):
+        if buff[:4] != b'dex\n':
+            raise ValueError('Not a DEX file (odex is not supported)')
+        self.buff = buff
+        (string_ids_size, string_ids_off, type_ids_size, type_ids_off,
+         proto_ids_size, proto_ids_off, _, _,
+         method_ids_size, method_ids_off) = struct.unpack_from('<10I', buff, 0x38)
+
+        self._string_offs = struct.unpack_from('<{}I'.format(string_ids_size), buff, string_ids_off)
+        self._strings = {}
+        self._type_ids = struct.unpack_from('<{}I'.format(type_ids_size), buff, type_ids_off)
+        self._protos = [struct.unpack_from('<III', buff, proto_ids_off + i * 12) for i in range(proto_ids_size)]
+        self._descriptors = {}
+        self._method_ids = [struct.unpack_from('<HHI', buff, method_ids_off + i * 8) for i in range(method_ids_size)]
+
+    def release(self):
+        self.buff = None
+        self._string_offs = self._type_ids = self._protos = self._method_ids = None
+        self._strings = {}
+        self._descriptors = {}
+
+    def _read_class_data(self, off):
+        if not off:
+            return []
+        buff = self.buff
+        static_fields, off = _read_uleb128(buff, off)
+        instance_fields, off = _read_uleb128(buff, off)
+        direct_methods, off = _read_uleb128(buff, off)
+        virtual_methods, off = _read_uleb128(buff, off)
+        for _ in range(2 * (static_fields + instance_fields)):
+            _, off = _read_uleb128(buff, off)
+
+        methods = []
+        for count in (direct_methods, virtual_methods):
+            method_idx = 0
+            for _ in range(count):
+                diff, off = _read_uleb128(buff, off)
+                _, off = _read_uleb128(buff, off)       # access_flags
+                code_off, off = _read_uleb128(buff, off)
+                method_idx += diff
+                methods.append(DexMethod(self, method_idx, code_off))
+        return methods
+
+    def get_string(self, idx):
+        try:
+            return self._strings[idx]
+        except KeyError:
+            pass
+        if idx >= len(self._string_offs):
+            return 'AG:IS: invalid string'
+        utf16_size, off = _read_uleb128(self.buff, self._string_offs[idx])
+        data = self.buff[off:self.buff.index(b'\x00', off)]
+        if data.isascii():
+            s = data.decode('ascii')
+        else:
+            s = mutf8.decode(data)
+        if len(s) != utf16_size:
+            raise ValueError('UTF16 Length does not match!')
+        if not data.isascii():
+            s = mutf8.patch_string(s)
+        self._strings[idx] = s
+        return s
+
+    def get_type(self, idx):
+        if idx >= len(self._type_ids):
+            return 'AG:ITI: invalid type'
+        return self.get_string(self._type_ids[idx])
+
+    def get_descriptor(self, proto_idx):
+        try:
+            return self._descriptors[proto_idx]
+        except KeyError:
+            pass
+        _, return_type_idx, parameters_off = self._protos[proto_idx]
+        params = []
+        if parameters_off:
+            size, = struct.unpack_from('<I', self.buff, parameters_off)
+            for type_idx in struct.unpack_from('<{}H'.format(size), self.buff, parameters_off + 4):
+                params.append(self.get_type(type_idx))
+        descriptor = '({}){}'.format(' '.join(params), self.get_type(return_type_idx))
+        self._descriptors[proto_idx] = descriptor
+        return descriptor
+
+    def get_method_info(self, method_idx):
+        """ Return (class name, method name, descriptor) of a method_id. """
+        if method_idx >= len(self._method_ids):
+            return 'AG:IMI:invalid_class_name;', 'AG:IMI:invalid_name', '()AG:IMI:invalid_proto'
+        class_idx, proto_idx, name_idx = self._method_ids[method_idx]
+        return self.get_type(class_idx), self.get_string(name_idx), self.get_descriptor(proto_idx)
+
+    def get_insns(self, code_off):
+        insns_size, = struct.unpack_from('<I', self.buff, code_off + 12)
+        return self.buff[code_off + 16:code_off + 16 + insns_size * 2]
+
+    # androguard DalvikVMFormat interface used by dex_index.py
+    def get_buff(self):
+        return self.buff
+
+    def get_methods(self):
+        return [meth for c in self.classes for meth in c.methods]
+
+
+class ExternalMethod:
+    """ A method referenced but not defined in the DEX files. """
+    def __init__(self, class_name, name, descriptor):
+        self.class_name = class_name
+        self.name = name
+        self.descriptor = descriptor
+
+    def get_name(self):
+        return self.name
+
+
+class DexMethodAnalysis:
+    def __init__(self, method):
+        self.method = method
+
+    @property
+    def name(self):
+        return self.method.name
+
+    def is_external(self):
+        return isinstance(self.method, ExternalMethod)
+
+    def get_method(self):
+        return self.method
+
+
+class DexClassAnalysis:
+    """ Like androguard's ClassAnalysis: a class has the methods that call or are called by other methods. """
+    def __init__(self, name, external=False):
+        self.name = name
+        self.external = external
+        self._methods = {}
+        self._fake_methods = {}
+
+    def is_external(self):
+        return self.external
+
+    def add_method(self, method):
+        if method not in self._methods:
+            self._methods[method] = DexMethodAnalysis(method)
+
+    def get_fake_method(self, name, descriptor):
+        key = name + descriptor
+        if key not in self._fake_methods:
+            self._fake_methods[key] = ExternalMethod(self.name, name, descriptor)
+        return self._fake_methods[key]
+
+    def get_methods(self):
+        return list(self._methods.values())
+
+
+class DexStringAnalysis:
+    def __init__(self, value):
+        self.value = value
+        self.xreffrom = set()
+
+    def get_orig_value(self):
+        return self.value
+
+    def get_value(self):
+        return self.value
+
+    def get_xref_from(self):
+        return self.xreffrom
+
+
+class DexAnalysis:
+    """ The classes, methods and string cross references androguard's Analysis would build
+        for the DEX files, restricted to what analyse_apk.py uses:
+        class names, the methods involved in calls, and the methods using each const-string.
+
+        Like androguard, all DEX files must be added before the cross references of any
+        are created, since calls are resolved to the methods defined in any of them.
+    """
+    def __init__(self, dex_files=()):
+        self.vms = []
+        self.classes = {}
+        self.strings = {}
+        self._defined = {}
+        for dex in dex_files:
+            self.add(dex)
+        for dex in dex_files:
+            self.create_xref(dex)
+
+    def add(self, dex):
+        self.vms.append(dex)
+        dex_defined = {}
+        for c in dex.classes:
+            self.classes[c.name] = DexClassAnalysis(c.name)
+            for meth in c.methods:
+                dex_defined[meth.class_name + meth.name + meth.descriptor] = meth
+        # Like DalvikVMFormat.get_method_descriptor: the first DEX defining the method wins
+        for key, meth in dex_defined.items():
+            self._defined.setdefault(key, meth)
+
+    def create_xref(self, dex):
+        for c in dex.classes:
+            self._create_xref(dex, c)
+
+    def _create_xref(self, dex, current_class):
+        cur_cls_name = current_class.name
+        cur_cls = self.classes[cur_cls_name]
+        for current_method in current_class.methods:
+            if not current_method.code_off:
+                continue
+            for op, idx in iter_references(current_method.get_raw()):
+                if op in INVOKE_OPS:
+                    method_info = dex.get_method_info(idx)
+                    class_info = method_info[0]
+                    method_item = self._defined.get(''.join(method_info))
+                    if method_item is None:
+                        if class_info not in self.classes:
+                            self.classes[class_info] = DexClassAnalysis(class_info, external=True)
+                        method_item = self.classes[class_info].get_fake_method(method_info[1], method_info[2])
+                    cur_cls.add_method(current_method)
+                    self.classes[class_info].add_method(method_item)
+                elif op == CONST_STRING or op == CONST_STRING_JUMBO:
+                    value = dex.get_string(idx)
+                    if value not in self.strings:
+                        self.strings[value] = DexStringAnalysis(value)
+                    self.strings[value].xreffrom.add((cur_cls, current_method))
+                else:   # const-class, new-instance
+                    type_info = dex.get_type(idx)
+                    if type_info != cur_cls_name and type_info not in self.classes:
+                        self.classes[type_info] = DexClassAnalysis(type_info, external=True)
+
+    def get_classes(self):
+        return self.classes.values()
+
+    def get_methods(self):
+        for c in self.classes.values():
+            for m in c.get_methods():
+                yield m
+
+    def get_strings(self):
+        return self.strings.values()
+
+
+def AnalyzeDex(filename, nested_dex=()):
+    """ Drop-in replacement of androguard.misc.AnalyzeAPK using the minimal DEX parser.
+        Return the APK, the list of DexFile and the DexAnalysis.
+        nested_dex (NestedPayloads of scan_nested, see containers.py) are added to the DEX files of the APK.
+    """
+    from androguard.core.bytecodes.apk import APK
+
+    a = APK(filename)
+    d = [DexFile(a.get_file(name)) for name in a.get_dex_names()]
+    d += [DexFile(payload.data) for payload in nested_dex]
+    return a, d, DexAnalysis(d)
+
+
+def _open_apk(filename):
+    """ androguard's APK of filename, reading its entries from the file as they are needed,
+        where APK(filename) reads the whole archive into memory first.
+    """
+    from androguard.core.bytecodes.apk import APK
+
+    empty = io.BytesIO()
+    zipfile.ZipFile(empty, 'w').close()
+    a = APK(empty.getvalue(), raw=True, skip_analysis=True)
+    a.filename = filename
+    a.zip = zipfile.ZipFile(filename)
+    a._apk_analysis()       # The manifest, as APK(filename) parses it
+    return a
+
+
+def AnalyzeDexStreaming(filename, scanner=crypto_constants_scanner, nested_dex=()):
+    """ Like AnalyzeDex, but only one DEX file is loaded at a time, so the peak memory is bounded
+        by the largest DEX instead of all of them. The bytecode isn't available afterwards,
+        so crypto constants are indexed while each DEX is loaded, see dex_index.py.
+        Return the APK, the list of released DexFile, the DexAnalysis and the constants index.
+
+        Calls are resolved across all DEX files as androguard does, so the DEX files are read twice:
+        first to collect the classes and methods they define, then to create the cross references.
+        nested_dex (NestedPayloads of scan_nested, see containers.py) are added, they are in memory already.
+        The APK itself isn't loaded into memory, its DEX files are read from the file when they are needed.
+    """
+    a = _open_apk(filename)
+    dx = DexAnalysis()
+    sources = [partial(a.get_file, name) for name in a.get_dex_names()]
+    sources += [partial(bytes, payload.data) for payload in nested_dex]
+    for source in sources:
+        dex = DexFile(source())
+        dex.release()
+        dx.add(dex)
+
+    constants_index = {}
+    for source, dex in zip(sources, dx.vms):
+        dex.reload(source())
+        dx.create_xref(dex)
+        constants_index.update(index_crypto_constants([dex], scanner))
+        dex.release()
+    return a, dx.vms, dx, constants_index
+
+
+# tests: check that both engines, and the dex engine streaming, produce the same results for a generated APK
+# with several DEX files and non-ASCII strings, and for the APKs given as arguments
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from analyse_apk import AnalyseApkCrypto
+    from write_result import get_result_rows
+    from synthetic_apk import SyntheticApkSpec, build_apk
+
+    directory = tempfile.TemporaryDirectory()
+    generated = os.path.join(directory.name, 'multidex.apk')
+    build_apk(generated, SyntheticApkSpec(classes=60, strings=3, abis=(), planted_constants=8, planted_names=8,
+                                          dex_files=3, non_ascii=True))
+
+    failed = False
+    for filename in [generated] + sys.argv[1:]:
+        results = {}
+        for mode, options in (('androguard', {}), ('dex', {'engine': 'dex'}), ('streaming', {'streaming': True})):
+            rows = get_result_rows(AnalyseApkCrypto(filename, **options), 0)
+            # Strings and the classes added by them come from sets, their order isn't defined
+            results[mode] = (sorted(map(repr, rows.java)), rows.overview)
+        mismatched = [mode for mode in results if results[mode] != results['androguard']]
+        if not mismatched:
+            print('{}: OK'.format(filename))
+        else:
+            failed = True
+            print('{}: MISMATCH'.format(filename))
+            for mode in ['androguard'] + mismatched:
+                print('  {}: {}'.format(mode, results[mode]))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,55 @@
+import struct
+from bisect import bisect_right
+from collections import defaultdict
+from constant_scanner import crypto_constants_scanner
+
+
+class DexCodeIndex:
+    """ Map offsets in a DEX file to the method whose code contains them,
+        by binary search over the code_item intervals sorted by offset.
+
+        Accessible attributes:
+            intervals: list[tuple[int, int, EncodedMethod]]
+                (start, end, method) of the instructions of every method with code,
+                sorted by start. Offsets are relative to the start of the DEX file.
+    """
+    def __init__(self, vm):
+        buff = vm.get_buff()
+        self.intervals = []
+        for meth in vm.get_methods():
+            code_off = meth.get_code_off()
+            if not code_off:
+                continue
+            # code_item: registers_size, ins_size, outs_size, tries_size (ushort),
+            # debug_info_off, insns_size (uint, in 16-bit code units), insns
+            insns_size, = struct.unpack_from('<I', buff, code_off + 12)
+            self.intervals.append((code_off + 16, code_off + 16 + insns_size * 2, meth))
+        self.intervals.sort(key=lambda interval: interval[0])
+        self._starts = [interval[0] for interval in self.intervals]
+
+    def find_method(self, start, end):
+        """ Return the method whose instructions contain the bytes [start, end), or None.
+        """
+        i = bisect_right(self._starts, start) - 1
+        if i >= 0 and end <= self.intervals[i][1]:
+            return self.intervals[i][2]
+        return None
+
+
+def index_crypto_constants(vms, scanner=crypto_constants_scanner):
+    """ Scan each DEX buffer once for all crypto constants and map the hits back to their methods.
+        Return a dict, whose keys are EncodedMethod objects containing constants,
+        values are the names of the constants found in the method, in the order of the table.
+        The code index of a DEX is only built if the DEX contains a constant.
+    """
+    results = defaultdict(set)
+    for vm in vms:
+        hits = scanner.find_all(vm.get_buff())
+        if not hits:
+            continue
+        index = DexCodeIndex(vm)
+        for offset, name, length in hits:
+            meth = index.find_method(offset, offset + length)
+            if meth is not None:
+                results[meth].add(name)
+    return {meth: [name for name in scanner.names if name in names] for meth, names in results.items()}
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from ruleset import ruleset_fingerprint
+from sqlite_store import SqliteStore
+from analyse_elf import ApkElfAnalyseResult
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Check the cache size every this many insertions
+EVICT_INTERVAL = 64
+
+
+class ElfResultCache(SqliteStore):
+    """ A persistent cache of ELF analyse results, keyed by the content hash of the ELF
+        and the ruleset fingerprint, so a library seen before costs one hash and one lookup.
+        Stored in an SQLite database, which can be shared by several processes.
+        When it grows larger than max_size bytes, least recently used results are evicted.
+
+        Accessible attributes:
+            hits: int
+                Number of lookups found in the cache by this process.
+
+            misses: int
+                Number of lookups not found in the cache by this process.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS elf_results (key TEXT PRIMARY KEY, payload TEXT, size INTEGER, last_used REAL)',
+        'CREATE INDEX IF NOT EXISTS elf_results_last_used ON elf_results (last_used)',
+    )
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        super().__init__(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._fingerprint = ruleset_fingerprint()
+        self._puts = 0
+
+    def key(self, stream):
+        """ Return the cache key of the ELF in a BufferStream, hashing it in place. """
+        h = hashlib.sha256(self._fingerprint.encode())
+        view = memoryview(stream.buffer)
+        try:
+            h.update(view[stream.offset:stream.offset + stream.size])
+        finally:
+            view.release()
+        return h.hexdigest()
+
+    def get(self, key, elf_name):
+        """ Return the cached ApkElfAnalyseResult for key with elf_name, or None on a miss. """
+        db = self._connect()
+        row = db.execute('SELECT payload FROM elf_results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with db:
+            db.execute('UPDATE elf_results SET last_used = ? WHERE key = ?', (time.time(), key))
+        symbols, constants = json.loads(row[0])
+        return ApkElfAnalyseResult(os.path.split(elf_name)[1], symbols, constants)
+
+    def put(self, key, result):
+        payload = json.dumps((result.symbol_table_with_crypto_name, result.crypto_constants_results))
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO elf_results VALUES (?, ?, ?, ?)',
+                (key, payload, len(payload), time.time()))
+        self._puts += 1
+        if self._puts % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """ Remove least recently used results until the cache is within 90% of max_size. """
+        db = self._connect()
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM elf_results').fetchone()[0]
+        if total <= self.max_size:
+            return
+        target = total - self.max_size * 0.9
+        evicted = []
+        for key, size in db.execute('SELECT key, size FROM elf_results ORDER BY last_used'):
+            if target <= 0:
+                break
+            evicted.append((key,))
+            target -= size
+        with db:
+            db.executemany('DELETE FROM elf_results WHERE key = ?', evicted)
+        logger.debug('ELF cache: evicted {} results'.format(len(evicted)))
+
+    def log_stats(self):
+        logger.debug('ELF cache: {} hits, {} misses'.format(self.hits, self.misses))
@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import zlib
+import pickle
+import hashlib
+import logging
+from typing import NamedTuple
+from elftools.common.exceptions import ELFError
+from analyse_elf import AnalyseElf, ApkElfAnalyseResult, BufferStream, is_packer_lib, get_abi
+from analyse_apk import MethodCryptoAnalysis
+from constant_scanner import crypto_constants_scanner
+from constants import crypto_constants
+from crypto_names import crypto_names, match_crypto_name
+from result_cache import file_sha256
+from stage_metrics import StageMetrics
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Bump when what is extracted changes, extracts of other versions are extracted again
+FEATURES_VERSION = 1
+
+
+class ApkFeatures(NamedTuple):
+    """ Everything the rules look at in the DEX files of an APK, in the order the analysis visits it.
+        The ELF files are stored apart, see ElfFeatures.
+
+        classes: list of (class name, list of (method name, bytecode)), all classes of the analysis,
+            external ones included. bytecode is None for external methods and for methods without code.
+        strings: list of (string, list of (class name, method name) of the methods using it).
+        elf: list of (path in the APK, SHA-256 of the ELF) of the ELF files, in the order of the APK.
+        app_name is None if it couldn't be read.
+    """
+    package: str
+    app_name: str
+    classes: list
+    strings: list
+    elf: list
+    pack_elf: list
+
+    def load(self):
+        """ Return (a, d, dx) standing for the APK, DEX and Analysis objects of androguard, see AnalyseApkCrypto. """
+        classes = {}
+        for class_name, methods in self.classes:
+            classes[class_name] = _ExtractedClass(class_name, [_ExtractedMethod(*meth) for meth in methods])
+        strings = []
+        for value, xrefs in self.strings:
+            strings.append(_ExtractedString(value, [
+                (classes.get(class_name) or _ExtractedClass(class_name, []), _ExtractedMethod(method_name, None))
+                for class_name, method_name in xrefs]))
+        return _ExtractedApk(self.package, self.app_name), None, _ExtractedAnalysis(classes, strings)
+
+
+class ElfFeatures(NamedTuple):
+    """ Everything the rules look at in an ELF file: its symbol names, in table order,
+        and the bytes of its sections searched for crypto constants.
+    """
+    symbols: list
+    sections: list
+
+
+class _ExtractedApk:
+    def __init__(self, package, app_name):
+        self.package = package
+        self.app_name = app_name
+        self.zip = None     # ELF files are analysed from their features
+
+    def get_package(self):
+        return self.package
+
+    def get_app_name(self):
+        if self.app_name is None:
+            raise ValueError('no app name in the extract')
+        return self.app_name
+
+
+class _ExtractedMethod:
+    """ A method of an extract, with the parts of androguard's MethodClassAnalysis used by analyse_apk.py. """
+    def __init__(self, name, bytecode):
+        self.name = name
+        self.bytecode = bytecode
+
+    def is_external(self):
+        return False
+
+    def get_method(self):
+        return self
+
+    def get_code(self):
+        return self if self.bytecode is not None else None
+
+    def get_bc(self):
+        return self
+
+    def get_raw(self):
+        return self.bytecode
+
+
+class _ExtractedClass:
+    def __init__(self, name, methods):
+        self.name = name
+        self.methods = methods
+
+    def get_methods(self):
+        return self.methods
+
+
+class _ExtractedString:
+    def __init__(self, value, xrefs):
+        self.value = value
+        self.xrefs = xrefs
+
+    def get_orig_value(self):
+        return self.value
+
+    def get_xref_from(self):
+        return self.xrefs
+
+
+class _ExtractedAnalysis:
+    def __init__(self, classes, strings):
+        self.classes = classes
+        self.strings = strings
+
+    def get_classes(self):
+        return self.classes.values()
+
+    def get_methods(self):
+        for c in self.classes.values():
+            for m in c.get_methods():
+                yield m
+
+    def get_strings(self):
+        return self.strings
+
+
+def _dumps(value):
+    return zlib.compress(pickle.dumps(value, protocol=4))
+
+
+def _loads(payload):
+    return pickle.loads(zlib.decompress(payload))
+
+
+class FeatureStore(SqliteStore):
+    """ A persistent store of the features of APKs (ApkFeatures) keyed by the SHA-256 of the APK,
+        and of their ELF files (ElfFeatures) keyed by the SHA-256 of the ELF, so a library bundled
+        by many APKs is stored once. Features don't depend on the rules, so the APKs of the store
+        can be analysed again under new rules without androguard, see reevaluate.py.
+        Features are stored as compressed pickles in an SQLite database, which can be shared by
+        several processes. Only open stores written by this program: pickles can run code.
+
+        Accessible attributes:
+            hits: int
+                Number of APKs found in the store by this process.
+
+            misses: int
+                Number of APKs not found in the store by this process.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS apk_features '
+        '(sha256 TEXT PRIMARY KEY, version INTEGER, apk TEXT, payload BLOB, created REAL)',
+        'CREATE TABLE IF NOT EXISTS elf_features (sha256 TEXT PRIMARY KEY, version INTEGER, payload BLOB)',
+    )
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sha256):
+        """ Return the ApkFeatures of the APK with the digest sha256, or None if it isn't in the store. """
+        row = self._connect().execute('SELECT payload FROM apk_features WHERE sha256 = ? AND version = ?',
+            (sha256, FEATURES_VERSION)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ApkFeatures(*_loads(row[0]))
+
+    def put(self, sha256, apk_file, features: ApkFeatures):
+        """ Store the features of an APK, once the features of its ELF files are stored. """
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO apk_features VALUES (?, ?, ?, ?, ?)',
+                (sha256, FEATURES_VERSION, apk_file, _dumps(tuple(features)), time.time()))
+
+    def has_elf(self, sha256):
+        return self._connect().execute('SELECT 1 FROM elf_features WHERE sha256 = ? AND version = ?',
+            (sha256, FEATURES_VERSION)).fetchone() is not None
+
+    def get_elf(self, sha256):
+        """ Return the ElfFeatures of the ELF with the digest sha256, raise KeyError if it isn't in the store. """
+        row = self._connect().execute('SELECT payload FROM elf_features WHERE sha256 = ? AND version = ?',
+            (sha256, FEATURES_VERSION)).fetchone()
+        if row is None:
+            raise KeyError(sha256)
+        return ElfFeatures(*_loads(row[0]))
+
+    def put_elf(self, sha256, features: ElfFeatures):
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO elf_features VALUES (?, ?, ?)',
+                (sha256, FEATURES_VERSION, _dumps(tuple(features))))
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM apk_features WHERE version = ?',
+            (FEATURES_VERSION,)).fetchone()[0]
+
+    def iter_apks(self):
+        """ Yield (SHA-256, APK file, ApkFeatures) of every APK in the store, in the order they were stored.
+            The APK file is the path the APK was extracted from.
+        """
+        # A second connection, so the store can be read while the rows are fetched
+        db = self._open()
+        try:
+            for sha256, apk_file, payload in db.execute('SELECT sha256, apk, payload FROM apk_features '
+                    'WHERE version = ? ORDER BY rowid', (FEATURES_VERSION,)):
+                yield sha256, apk_file, ApkFeatures(*_loads(payload))
+        finally:
+            db.close()
+
+
+def extract_elf_features(apk_zip, store):
+    """ Store the features of the ELF files in an APK that aren't in the store yet.
+        Return (list of (path in the APK, SHA-256), list of packer ELF names), as in analyse_apk_elf.
+    """
+    elf = []
+    pack_elf = []
+    for info in apk_zip.infolist():
+        name = info.filename
+        if not (name.startswith('lib') and name.endswith('.so')):
+            continue
+        data = apk_zip.read(info)
+        sha256 = hashlib.sha256(data).hexdigest()
+        if not store.has_elf(sha256):
+            try:
+                elf_file = AnalyseElf(BufferStream(data), name, analyse=False)
+            except ELFError:
+                logger.warning('Ignoring {}: not an ELF'.format(name))
+                continue
+            store.put_elf(sha256, ElfFeatures(elf_file.symbol_table, elf_file.get_constant_sections()))
+        elf.append((name, sha256))
+        if is_packer_lib(name):
+            pack_elf.append(os.path.split(name)[1])
+    return elf, pack_elf
+
+
+def extract_apk_features(filename, store, engine='androguard', metrics=None):
+    """ Load an APK with engine ('androguard' or 'dex', see AnalyseApkCrypto), store the features
+        of its ELF files and return its ApkFeatures.
+    """
+    metrics = metrics if metrics is not None else StageMetrics()
+    with metrics.stage('dex'):
+        if engine == 'dex':
+            from dex_engine import AnalyzeDex
+            a, d, dx = AnalyzeDex(filename)
+        else:
+            from androguard.misc import AnalyzeAPK
+            a, d, dx = AnalyzeAPK(filename)
+    with metrics.stage('extract'):
+        try:
+            app_name = a.get_app_name()
+        except:
+            app_name = None
+        classes = [(c.name, [(meth.name, MethodCryptoAnalysis.get_bytecode(meth)) for meth in c.get_methods()])
+                   for c in dx.get_classes()]
+        strings = [(s_ana.get_orig_value(), [(c.name, meth.name) for c, meth in s_ana.get_xref_from()])
+                   for s_ana in dx.get_strings()]
+        elf, pack_elf = extract_elf_features(a.zip, store)
+    return ApkFeatures(a.get_package(), app_name, classes, strings, elf, pack_elf)
+
+
+def analyse_elf_features(elf_name, features: ElfFeatures):
+    """ Return the ApkElfAnalyseResult of an ELF from its features, as AnalyseElf does. """
+    symbol_table_with_crypto_name = {crypto_name: [] for crypto_name in crypto_names}
+    matched = {}
+    for symbol in features.symbols:
+        if symbol not in matched:
+            matched[symbol] = match_crypto_name(symbol)
+        if matched[symbol] is not None:
+            symbol_table_with_crypto_name[matched[symbol]].append(symbol)
+    found = []
+    for data in features.sections:
+        found += crypto_constants_scanner.scan(data, 0, len(data), skip=found)
+    constants_result = {name: name in found for name in crypto_constants}
+    return ApkElfAnalyseResult(os.path.split(elf_name)[1], symbol_table_with_crypto_name, constants_result,
+                               (get_abi(elf_name),))
+
+
+def analyse_features(apk_file, features: ApkFeatures, store, metrics=None, known_libraries=None):
+    """ Analyse an APK from its features under the current rules, return the AnalyseApkCrypto. """
+    from analyse_apk import AnalyseApkCrypto
+
+    metrics = metrics if metrics is not None else StageMetrics()
+    with metrics.stage('elf'):
+        elf_results = [analyse_elf_features(name, store.get_elf(sha256)) for name, sha256 in features.elf]
+    return AnalyseApkCrypto(apk_file, metrics=metrics, elf_results=(elf_results, features.pack_elf),
+                            known_libraries=known_libraries, features=features)
+
+
+def extract_and_analyse(apk_file, store, apk_sha256=None, engine='androguard', metrics=None, known_libraries=None):
+    """ Analyse an APK from its features in store, extracting them first if they aren't there.
+        apk_sha256 is the digest of the APK if it's known already. Return the AnalyseApkCrypto.
+    """
+    sha256 = apk_sha256 or file_sha256(apk_file)
+    features = store.get(sha256)
+    if features is None:
+        features = extract_apk_features(apk_file, store, engine, metrics)
+        store.put(sha256, apk_file, features)
+    else:
+        logger.debug('Using the stored features of {}'.format(apk_file))
+    return analyse_features(apk_file, features, store, metrics, known_libraries)
+
+
+# tests: check that the analysis of the extracts of the APKs given as arguments matches the direct analysis
+if __name__ == '__main__':
+    import tempfile
+    from analyse_apk import AnalyseApkCrypto
+    from write_result import get_result_rows
+
+    if len(sys.argv) < 2:
+        sys.stderr.write('Need an argument\n')
+        sys.exit(1)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        store = FeatureStore(os.path.join(directory, 'features.db'))
+        for filename in sys.argv[1:]:
+            expected = get_result_rows(AnalyseApkCrypto(filename), 0)
+            rows = get_result_rows(extract_and_analyse(filename, store), 0)
+            # Strings and the classes added by them come from sets, their order isn't defined
+            if (sorted(map(repr, rows.java)), rows.elf, rows.overview) == \
+                    (sorted(map(repr, expected.java)), expected.elf, expected.overview):
+                print('{}: OK'.format(filename))
+            else:
+                failed = True
+                print('{}: MISMATCH\n  direct: {}\n  extract: {}'.format(filename, expected, rows))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,89 @@
+import sys
+import hashlib
+import logging
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Packages of libraries bundled by most apps, none of which implements SM ciphers.
+# Libraries that do (like Bouncy Castle or Spongy Castle) must never be listed here.
+DEFAULT_KNOWN_LIBRARIES = (
+    'android', 'androidx', 'java', 'javax', 'kotlin', 'kotlinx', 'dalvik',
+    'com.google.android', 'com.google.gson', 'com.google.protobuf', 'com.google.firebase',
+    'com.google.common', 'com.google.zxing', 'com.google.crypto.tink',
+    'okhttp3', 'okio', 'retrofit2', 'com.squareup', 'io.reactivex', 'rx',
+    'org.jetbrains', 'org.intellij', 'com.facebook', 'com.bumptech.glide', 'dagger',
+)
+
+
+def _package_segments(package):
+    """ Return the segments of a package written as 'com.google' or 'com/google'. """
+    return [segment for segment in package.replace('/', '.').split('.') if segment]
+
+
+class PackageTrie:
+    """ A trie of Java package prefixes, to tell whether a class belongs to one of them.
+        Packages are matched segment by segment, so 'com.google' contains com.google.gson.Gson
+        but not com.googlex.Foo.
+
+        Accessible attributes:
+            prefixes: list[str]
+                The package prefixes in the trie, in dotted form.
+    """
+    def __init__(self, prefixes=()):
+        self.prefixes = []
+        self._root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        segments = _package_segments(prefix)
+        if not segments:
+            return
+        node = self._root
+        for segment in segments:
+            node = node.setdefault(segment, {})
+        node[None] = True
+        self.prefixes.append('.'.join(segments))
+
+    def match(self, class_name):
+        """ Return the shortest prefix containing the package of class_name (a type descriptor
+            like 'Lcom/google/gson/Gson;'), or None if there is none.
+        """
+        segments = class_name.lstrip('[')
+        if segments.startswith('L') and segments.endswith(';'):
+            segments = segments[1:-1]
+        segments = segments.split('/')[:-1]     # The last one is the class
+        node = self._root
+        for depth, segment in enumerate(segments):
+            node = node.get(segment)
+            if node is None:
+                return None
+            if None in node:
+                return '.'.join(segments[:depth + 1])
+        return None
+
+    def fingerprint(self):
+        """ Return a short hash of the prefixes, identifying the classes skipped with this trie. """
+        return hashlib.sha256('\n'.join(sorted(set(self.prefixes))).encode()).hexdigest()[:16]
+
+
+def load_known_libraries(path):
+    """ Return a PackageTrie of the packages listed in the file at path, one per line.
+        Blank lines and lines starting with '#' are ignored.
+    """
+    with open(path) as f:
+        prefixes = [line.strip() for line in f]
+    return PackageTrie(line for line in prefixes if line and not line.startswith('#'))
+
+
+# tests: print the known library of each class name given as an argument
+if __name__ == '__main__':
+    trie = PackageTrie(DEFAULT_KNOWN_LIBRARIES)
+    assert trie.match('Lcom/google/gson/Gson;') == 'com.google.gson'
+    assert trie.match('Lcom/google/gsonx/Gson;') is None
+    assert trie.match('Landroidx/core/app/ActivityCompat$1;') == 'androidx'
+    assert trie.match('[Ljava/lang/String;') == 'java'
+    assert trie.match('Lorg/bouncycastle/crypto/engines/SM4Engine;') is None
+    assert trie.match('Landroid;') is None
+    for name in sys.argv[1:]:
+        print(name, trie.match(name))
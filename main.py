@@ -1,99 +1,412 @@
 import os
-import csv
+import cProfile
 import argparse
 import logging
 from time import time
-from zipfile import BadZipFile
+from functools import partial
+from zipfile import ZipFile, BadZipFile
 from timeout import timeout
-from analyse_elf import analyse_apk_elf_with_filename
-from constants import crypto_constants
-from crypto_names import crypto_names
+from worker_pool import WorkerPool, TaskTimeout, MemoryExceeded
+from stage_metrics import StageMetrics
+from elf_cache import ElfResultCache
+from result_cache import ApkResultCache, file_sha256
+from extracts import FeatureStore, extract_and_analyse
+from analyse_elf import analyse_apk_elf_with_filename, DEFAULT_ABI_PRIORITY
+from triage import triage_apk, parse_triage_policy, DEFAULT_TRIAGE_POLICY, TRIAGE_CONDITIONS
+from containers import NestedLimits
+from budgets import Deadline, parse_stage_budgets, BUDGET_STAGES
+from corpus import iter_paths, iter_apk_paths, largest_first, parse_shard, shard_paths
+from prefetch import Prefetcher, PrefetchedApk
+from manifest import RunManifest
+from known_libraries import PackageTrie, DEFAULT_KNOWN_LIBRARIES, load_known_libraries
 from colored_logger import file_formatter, terminal_formatter
 from write_result import *
 
+TIMEOUT = 1000
 
-@timeout(1000)
-def analyse_and_write_result(apk_file, csv_java, csv_elf, csv_overview):
-    time_start = time()
-    ana = AnalyseApkCrypto(apk_file)
-    time_consumed = int(time() - time_start)
-    write_result(ana, time_consumed, csv_java, csv_elf, csv_overview)
-    return time_consumed
+logger = logging.getLogger('AndroidCryptoDetection')
+
+
+def analyse_apk_rows(apk_file, elf_only=False, elf_cache=None, result_cache=None, triage=None,
+                     profile_slow=None, profile_dir=None, apk_sha256=None, feature_store=None, **apk_options):
+    """ Analyse an APK, return (ApkResultRows, seconds consumed).
+        In ELF-only mode, file name is used instead of package name.
+        If triage (a set of triage conditions, see triage.py) is given, the Java analysis only runs
+        if the cheap scans call for it, otherwise file name is used as in ELF-only mode.
+        apk_sha256 is the digest of the APK if it's known already, otherwise it's computed here, in the worker,
+        and returned in the rows for the run manifest.
+        If feature_store (a FeatureStore, see extracts.py) is given, the features of the APK are stored in it
+        and analysed, or analysed from it if they were stored before.
+        apk_options are passed to AnalyseApkCrypto.
+        If profile_slow is set, the analysis runs under cProfile, and the profile is saved
+        to profile_dir if the analysis takes longer than profile_slow seconds, named by the APK file
+        and the start of its digest, so APKs with the same file name don't overwrite each other's profile.
+    """
+    if profile_slow is None:
+        return _analyse_apk_rows(apk_file, elf_only, elf_cache, result_cache, triage, apk_sha256, feature_store,
+                                 **apk_options)
 
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        rows, time_consumed = _analyse_apk_rows(apk_file, elf_only, elf_cache, result_cache, triage, apk_sha256,
+                                                feature_store, **apk_options)
+    finally:
+        profiler.disable()
+    if rows.metrics['wall'] > profile_slow:
+        profile_file = os.path.join(profile_dir, '{}.{}.prof'.format(os.path.split(apk_file)[1], rows.sha256[:12]))
+        profiler.dump_stats(profile_file)
+        logger.info('Analyse of {} took {:.1f} seconds, profile saved to {}'.format(
+            apk_file, rows.metrics['wall'], profile_file))
+    return rows, time_consumed
 
-@timeout(1000)
-def analyse_and_write_result_elf_only(apk_file, csv_elf):
+
+def _analyse_apk_rows(apk_file, elf_only, elf_cache, result_cache, triage, apk_sha256, feature_store, **apk_options):
     time_start = time()
-    results = analyse_apk_elf_with_filename(apk_file)
-    time_consumed = int(time() - time_start)
-    for result in results:
-        csv_elf.writerow(['', os.path.split(apk_file)[1], result.elf_name] 
-        + list(result.symbol_table_with_crypto_name.values())
-        + list(result.crypto_constants_results.values()))
-    return time_consumed
+    metrics = StageMetrics()
+    abis = apk_options.get('abi_priority') is not None
+    if apk_sha256 is None:
+        apk_sha256 = file_sha256(apk_file)
+    key = None
+    if result_cache is not None:
+        if elf_only:
+            mode = 'elf'
+        elif triage is not None:
+            mode = 'triage-' + ','.join(sorted(triage))
+        else:
+            mode = 'full'
+        if apk_options.get('known_libraries') is not None and not elf_only:
+            mode += '-known-' + apk_options['known_libraries'].fingerprint()
+        if apk_options.get('nested') is not None:
+            mode += '-nested-' + ','.join(map(str, apk_options['nested']))
+        if abis:
+            mode += '-abis-' + ','.join(apk_options['abi_priority'])
+        with metrics.stage('result_cache'):
+            key = result_cache.key(apk_file, mode, apk_sha256)
+            rows = result_cache.get(key)
+        if rows is not None:
+            logger.debug('Using cached result of {}'.format(apk_file))
+            return rows._replace(metrics=metrics.to_dict(), sha256=apk_sha256), int(time() - time_start)
+
+    file_name = os.path.split(apk_file)[1]
+    elf_deadline = Deadline((apk_options.get('budgets') or {}).get('elf'))
+    if elf_only:
+        with metrics.stage('elf'):
+            results = analyse_apk_elf_with_filename(apk_file, elf_cache, elf_deadline, apk_options.get('nested'),
+                                                    apk_options.get('abi_priority'))[0]
+        if elf_deadline.hit:
+            metrics.partial.append('elf')
+            logger.warning('The elf stage of {} ran out of its time budget, keeping the results so far'.format(apk_file))
+        time_consumed = int(time() - time_start)
+        rows = ApkResultRows([], get_elf_rows('', file_name, results, abis), None, metrics.to_dict())
+    elif feature_store is not None:
+        ana = extract_and_analyse(apk_file, feature_store, apk_sha256, apk_options.get('engine', 'androguard'),
+                                  metrics, apk_options.get('known_libraries'))
+        time_consumed = int(time() - time_start)
+        rows = get_result_rows(ana, time_consumed, abis)
+    else:
+        verdict = None
+        if triage is not None:
+            with metrics.stage('triage'):
+                with ZipFile(apk_file) as apk_zip:
+                    verdict = triage_apk(apk_zip, triage, elf_cache, elf_deadline, apk_options.get('nested'),
+                                         apk_options.get('abi_priority'))
+            if elf_deadline.hit:
+                metrics.partial.append('elf')
+                logger.warning('The elf stage of {} ran out of its time budget, keeping the results so far'.format(
+                    apk_file))
+            logger.debug('Triage of {}: {}'.format(apk_file, verdict.reason))
+
+        if verdict is not None and not verdict.escalate:
+            time_consumed = int(time() - time_start)
+            overview = ('', file_name, time_consumed, '', '', len(verdict.elf_results), verdict.pack_elf,
+                        ','.join(metrics.partial))
+            rows = ApkResultRows([], get_elf_rows('', file_name, verdict.elf_results, abis), overview,
+                                 metrics.to_dict())
+        else:
+            # androguard takes a while to import, so it's only imported when it's needed
+            from analyse_apk import AnalyseApkCrypto
+
+            elf_results = (verdict.elf_results, verdict.pack_elf) if verdict is not None else None
+            nested_scan = verdict.nested_scan if verdict is not None else None
+            ana = AnalyseApkCrypto(apk_file, elf_cache, metrics=metrics, elf_results=elf_results,
+                                   nested_scan=nested_scan, **apk_options)
+            time_consumed = int(time() - time_start)
+            rows = get_result_rows(ana, time_consumed, abis)
+
+    rows = rows._replace(sha256=apk_sha256)
+    # Partial results depend on the load of the machine, they're analysed again next time
+    if key is not None and not metrics.partial:
+        result_cache.put(key, rows)
+    return rows, time_consumed
+
+
+def analyse_prefetched_rows(apk, **kwargs):
+    """ analyse_apk_rows for an APK read ahead (a PrefetchedApk), raising the error that made it unreadable. """
+    if apk.error is not None:
+        raise apk.error
+    return analyse_apk_rows(apk.path, apk_sha256=apk.sha256, **kwargs)
+
+
+@timeout(TIMEOUT)
+def analyse_and_write_result(task, apk, results):
+    rows, time_consumed = task(apk)
+    results.write_rows(rows)
+    return rows, time_consumed
+
+
+def write_error(results, apk_file, error):
+    """ Log why the analysis of an APK failed, record it in results (ResultFiles) if given, return its status. """
+    if isinstance(error, (KeyboardInterrupt, TaskTimeout)):     # timed out
+        logger.error('Analyse of {} timed out'.format(apk_file))
+        status = 'timed out'
+    elif isinstance(error, MemoryExceeded):
+        logger.error('Analyse of {} exceeded the memory limit: {}'.format(apk_file, error))
+        status = 'memory exceeded'
+    elif isinstance(error, BadZipFile):
+        logger.warning('Ignoring {}: not an APK file'.format(apk_file))
+        status = 'not an APK file'
+    else:       # Unexpected exceptions raised by androguard
+        logger.critical(error)
+        status = 'error'
+    if results is not None:
+        if status in ('timed out', 'memory exceeded'):
+            results.write_status(apk_file, status)
+        results.write_metrics(apk_file, status)
+    return status
+
+
+def iter_apk_files(apk_files):
+    for apk_file in apk_files:
+        logger.info('Analysing {}'.format(apk_file.path if isinstance(apk_file, PrefetchedApk) else apk_file))
+        yield apk_file
+
+
+def add_analysis_arguments(parser):
+    """ Add the options of the analysis and of the worker processes, shared with daemon.py. """
+    nested_defaults = NestedLimits()
+    parser.add_argument('--elf-only', action='store_true', help='only analyse elf files in APK')
+    parser.add_argument('--triage', action='store_true',
+        help='scan packer libraries, ELF files and raw DEX files first, and run the Java analysis by --triage-policy')
+    parser.add_argument('--triage-policy', default=DEFAULT_TRIAGE_POLICY, metavar='CONDITIONS',
+        help='comma separated conditions to run the Java analysis in triage mode: {} (default: {})'.format(
+            ', '.join(TRIAGE_CONDITIONS), DEFAULT_TRIAGE_POLICY))
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+        help='analyse APKs in JOBS worker processes, each killed and replaced after {} seconds'.format(TIMEOUT))
+    parser.add_argument('--max-rss', type=float, metavar='MB',
+        help='kill a worker using more than MB megabytes of memory during an APK, requires --jobs')
+    parser.add_argument('--recycle-rss', type=float, metavar='MB',
+        help='replace a worker using more than MB megabytes of memory after an APK (default: 75%% of --max-rss)')
+    parser.add_argument('--elf-cache', metavar='PATH',
+        help='cache ELF results in an SQLite database at PATH, shared across APKs and runs')
+    parser.add_argument('--elf-cache-size', type=int, default=256, metavar='MB',
+        help='evict least recently used ELF results when the cache exceeds MB megabytes (default: 256)')
+    parser.add_argument('--result-cache', metavar='PATH',
+        help='cache the results of whole APKs in an SQLite database at PATH and skip APKs analysed before')
+    parser.add_argument('--dex-index', action='store_true',
+        help='scan each DEX file once for crypto constants instead of the bytecode of every method')
+    parser.add_argument('--engine', choices=('androguard', 'dex'), default='androguard',
+        help='parse DEX files with androguard, or with a minimal parser that builds only what is analysed (default: androguard)')
+    parser.add_argument('--stream-dex', action='store_true',
+        help='load one DEX file at a time with the dex engine, bounding memory by the largest DEX')
+    parser.add_argument('--skip-known-libs', action='store_true',
+        help='skip the classes of widely bundled libraries (androidx, kotlin, okhttp3, ...) in the Java analysis')
+    parser.add_argument('--known-libs', metavar='PATH',
+        help='skip the classes in the packages listed in PATH, one per line, instead of the built-in list')
+    parser.add_argument('--stage-budgets', metavar='STAGE=SECONDS,...',
+        help='stop the stages {} of an APK after SECONDS each, keeping their results so far and flagging them '
+             'as partial in result_overview.csv'.format(', '.join(BUDGET_STAGES)))
+    parser.add_argument('--nested-depth', type=int, metavar='N',
+        help='also analyse the DEX and ELF files elsewhere in APKs (e.g. assets/) and in the jar, apk, zip and aar '
+             'archives nested up to N levels deep in them (default: off)')
+    parser.add_argument('--nested-max-mb', type=float, default=nested_defaults.max_entry_size // (1024 * 1024),
+        metavar='MB', help='skip nested archives, DEX and ELF files larger than MB megabytes uncompressed '
+                           '(default: %(default)s)')
+    parser.add_argument('--nested-max-entries', type=int, default=nested_defaults.max_entries, metavar='N',
+        help='stop searching the nested archives of an APK after N entries (default: %(default)s)')
+    parser.add_argument('--dedup-abis', action='store_true',
+        help='analyse one copy of a library shipped for several ABIs, chosen by --abi-priority, and the other '
+             'copies only if their exported symbols differ')
+    parser.add_argument('--abi-priority', default=','.join(DEFAULT_ABI_PRIORITY), metavar='ABIS',
+        help='comma separated ABIs whose copy of a library is analysed first with --dedup-abis (default: %(default)s)')
+    parser.add_argument('--extract', metavar='PATH',
+        help='store the features the rules look at in an SQLite database at PATH, to analyse them again '
+             'under new rules with reevaluate.py; APKs stored before are analysed from it')
+    parser.add_argument('--profile-slow', type=float, metavar='SECONDS',
+        help='profile the analysis and save the cProfile dump of APKs taking longer than SECONDS to profiles/')
+
+
+def get_analyse_options(parser, args, path):
+    """ Check the options added by add_analysis_arguments, return the keyword arguments of analyse_apk_rows.
+        Profiles are saved under the directory path.
+    """
+    if args.triage and args.elf_only:
+        parser.error('--triage and --elf-only are exclusive')
+    if args.extract and (args.elf_only or args.triage or args.dex_index or args.stream_dex or args.stage_budgets
+                         or args.result_cache or args.nested_depth is not None or args.dedup_abis):
+        parser.error('--extract stores the features of whole APKs, it can\'t be combined with --elf-only, '
+                     '--triage, --dex-index, --stream-dex, --stage-budgets, --result-cache, --nested-depth '
+                     'or --dedup-abis')
+    if args.nested_depth is not None and args.nested_depth < 0:
+        parser.error('--nested-depth must not be negative')
+    try:
+        triage_policy = parse_triage_policy(args.triage_policy)
+    except ValueError as e:
+        parser.error(str(e))
+    budgets = None
+    if args.stage_budgets:
+        try:
+            budgets = parse_stage_budgets(args.stage_budgets)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.max_rss and not args.recycle_rss:
+        args.recycle_rss = args.max_rss * 0.75
+
+    analyse_options = {'elf_only': args.elf_only}
+    if args.triage:
+        analyse_options['triage'] = triage_policy
+    if args.dex_index:
+        analyse_options['dex_index'] = True
+    if args.engine != 'androguard':
+        analyse_options['engine'] = args.engine
+    if args.stream_dex:
+        analyse_options['streaming'] = True
+    if budgets:
+        analyse_options['budgets'] = budgets
+    if args.dedup_abis:
+        analyse_options['abi_priority'] = tuple(filter(None, (abi.strip() for abi in args.abi_priority.split(','))))
+    if args.nested_depth is not None:
+        analyse_options['nested'] = NestedLimits(args.nested_depth, args.nested_max_entries,
+                                                 int(args.nested_max_mb * 1024 * 1024))
+    if args.known_libs:
+        analyse_options['known_libraries'] = load_known_libraries(args.known_libs)
+    elif args.skip_known_libs:
+        analyse_options['known_libraries'] = PackageTrie(DEFAULT_KNOWN_LIBRARIES)
+    if args.elf_cache:
+        analyse_options['elf_cache'] = ElfResultCache(args.elf_cache, args.elf_cache_size * 1024 * 1024)
+    if args.result_cache:
+        analyse_options['result_cache'] = ApkResultCache(args.result_cache)
+        analyse_options['result_cache'].purge()
+    if args.extract:
+        analyse_options['feature_store'] = FeatureStore(args.extract)
+    if args.profile_slow is not None:
+        analyse_options['profile_slow'] = args.profile_slow
+        analyse_options['profile_dir'] = os.path.join(path, 'profiles')
+        os.makedirs(analyse_options['profile_dir'], exist_ok=True)
+    return analyse_options
+
+
+def setup_logger(path=None):
+    """ Log to the terminal, and to analyse_log.log in the directory path if given. """
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler()
+    handler.setFormatter(terminal_formatter)
+    logger.addHandler(handler)
+    if path is not None:
+        handler = logging.FileHandler(os.path.join(path, 'analyse_log.log'))
+        handler.setFormatter(file_formatter)
+        logger.addHandler(handler)
 
 
 if __name__ == '__main__':
     # Parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--elf-only', action='store_true', help='only analyse elf files in APK')
-    parser.add_argument('apk_file', nargs='+', help='APK files to be analysed')
+    parser.add_argument('apk_file', nargs='*', help='APK files, or directories searched recursively for APK files')
+    parser.add_argument('--from-file', metavar='PATH',
+        help='also analyse the APK files or directories listed in PATH, one per line, - for standard input')
     parser.add_argument('-o', '--output', default='./', help='a directory to save output file')
+    add_analysis_arguments(parser)
+    parser.add_argument('--metrics', action='store_true',
+        help='write wall time, CPU time and memory of each stage of every APK to metrics.jsonl')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='K',
+        help='read up to K APKs ahead of the analysis in a background thread (default: 0, off)')
+    parser.add_argument('--prefetch-mb', type=float, default=1024, metavar='MB',
+        help='read at most MB megabytes of APKs ahead with --prefetch (default: 1024)')
+    parser.add_argument('--resume', action='store_true',
+        help='resume the run interrupted in the output directory, skipping the APKs it completed')
+    parser.add_argument('--shard', metavar='i/N',
+        help='only analyse the i-th of N disjoint shards of the APKs, see merge_results.py')
+    parser.add_argument('--shard-by', choices=('path', 'content'), default='path',
+        help='assign APKs to shards by a hash of their path, or of their content (default: path)')
     args = parser.parse_args()
+    if (args.max_rss or args.recycle_rss) and not args.jobs:
+        parser.error('--max-rss and --recycle-rss require --jobs')
+    if not args.apk_file and args.from_file is None:
+        parser.error('no APK files given')
+    if args.prefetch < 0:
+        parser.error('--prefetch must not be negative')
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
 
     path = args.output
     if not os.path.isdir(path):
         os.mkdir(path)
+    setup_logger(path)
+    analyse_options = get_analyse_options(parser, args, path)
 
-    # Setup the logger
-    logger = logging.getLogger('AndroidCryptoDetection')
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler()
-    handler.setFormatter(terminal_formatter)
-    logger.addHandler(handler)
-    handler = logging.FileHandler(os.path.join(path, 'analyse_log.log'))
-    handler.setFormatter(file_formatter)
-    logger.addHandler(handler)
-
-    # Open CSV files
     if args.elf_only:
         logger.warning('ELF-only mode, file name will be used instead of package name')
-    else:
-        f_java = open(os.path.join(path, 'result_java.csv'), 'w', newline='')
-        csv_java = csv.writer(f_java)
-        csv_java.writerow(('App Name', 'Package Name', 'Crypto Name', 'Class', 'Method', 'Strings', 'Constants'))
-    f_elf = open(os.path.join(path, 'result_elf.csv'), 'w', newline='')
-    csv_elf = csv.writer(f_elf)
-    csv_elf.writerow(['App Name', 'Package Name', 'ELF Name'] + crypto_names + list(crypto_constants.keys()))
-    f_overview = open(os.path.join(path, 'result_overview.csv'), 'w', newline='')
-    csv_overview = csv.writer(f_overview)
-    csv_overview.writerow(('App Name', 'Package Name', 'Time Consumed/s', 'Class count', 'Method count', 'ELF count', 'Pack ELF'))
+    manifest = RunManifest(path, args.elf_only, abis=args.dedup_abis)
+    resumed = False
+    if args.resume:
+        try:
+            resumed = manifest.resume()
+        except ValueError as e:
+            parser.error(str(e))
+    results = ResultFiles(path, args.elf_only, args.metrics, append=resumed, abis=args.dedup_abis)
+    manifest.start(results)
 
     # Run the analysis
-    for apk_file in args.apk_file:
-        if os.path.isdir(apk_file):
-            continue
-        logger.info('Analysing {}'.format(apk_file))
+    apk_files = iter_apk_paths(iter_paths(args.apk_file, args.from_file))
+    if shard is not None:
+        logger.info('Analysing shard {}/{} of the APKs by {}'.format(*shard, args.shard_by))
+        apk_files = shard_paths(apk_files, *shard, args.shard_by)
+    if resumed:
+        apk_files = manifest.skip_done(apk_files)
+    if args.jobs:
+        apk_files = largest_first(apk_files)
+    prefetcher = None
+    if args.prefetch:
+        # APKs are read into the page cache and hashed, the workers still open them by name
+        prefetcher = Prefetcher(apk_files, args.prefetch, int(args.prefetch_mb * 1024 * 1024))
+        apk_files = prefetcher
+        task = partial(analyse_prefetched_rows, **analyse_options)
+    else:
+        task = partial(analyse_apk_rows, **analyse_options)
+    if args.jobs:
+        pool = WorkerPool(task, args.jobs, TIMEOUT, args.max_rss, args.recycle_rss)
+        outcomes = pool.imap(iter_apk_files(apk_files), prefetcher.ready if prefetcher is not None else None)
+    else:
+        pool = None
+        outcomes = ((apk_file, None, None) for apk_file in iter_apk_files(apk_files))
 
+    for item, result, error in outcomes:
+        apk_file, sha256 = (item.path, item.sha256) if isinstance(item, PrefetchedApk) else (item, None)
         try:
-            if args.elf_only:
-                time_consumed = analyse_and_write_result_elf_only(apk_file, csv_elf)
-            else:   # Analyse both Java and native
-                time_consumed = analyse_and_write_result(apk_file, csv_java, csv_elf, csv_overview)
-        except KeyboardInterrupt:   # timed out
-            logger.error('Analyse of {} timed out'.format(apk_file))
-            csv_overview.writerow(('', os.path.split(apk_file)[1], 'timed out', '', '', ''))
-            continue
-        except BadZipFile:
-            logger.warning('Ignoring {}: not an APK file'.format(apk_file))
-            continue
-        except Exception as e:      # Handle unexpected exceptions raised by androguard
-            logger.critical(e)
+            if error is not None:
+                raise error
+            if result is not None:    # Analysed by a worker
+                rows, time_consumed = result
+                results.write_rows(rows)
+            else:
+                rows, time_consumed = analyse_and_write_result(task, item, results)
+        except (KeyboardInterrupt, Exception) as e:
+            manifest.record(apk_file, write_error(results, apk_file, e), sha256=sha256)
             continue
 
+        results.write_metrics(apk_file, 'ok', rows.metrics)
+        manifest.record(apk_file, 'ok', rows.metrics, rows.sha256 or sha256)
         logger.debug('Analyse of {} consumed {} seconds'.format(apk_file, time_consumed))
 
-    if not args.elf_only:
-        f_java.close()
-    f_elf.close()
-    f_overview.close()
+    if pool is not None:
+        pool.close()
+    if prefetcher is not None:
+        logger.info('Waited {:.1f} seconds in total for APKs to be read ahead'.format(prefetcher.stalled))
+    if resumed:
+        logger.info('Skipped {} APKs completed before the run was resumed'.format(manifest.skipped))
+    manifest.close()
+    results.close()
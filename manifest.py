@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import logging
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+MANIFEST_NAME = 'manifest.jsonl'
+MANIFEST_VERSION = 1
+
+# The result files are flushed and a checkpoint is written after this many APKs,
+# or this many seconds after the last checkpoint, whichever comes first
+CHECKPOINT_APKS = 20
+CHECKPOINT_SECONDS = 60
+
+
+def read_manifest(file):
+    """ Read the manifest file of a run. Return (header, done, offsets, end, pending): the records of the
+        APKs before the last checkpoint, the file sizes of the checkpoint, the position of the end of
+        the checkpoint in the manifest, and the records written after it. A line cut short by a crash
+        ends the manifest. offsets is None if there is no checkpoint.
+    """
+    header = None
+    done = []
+    offsets = None
+    pending = []
+    end = pos = 0
+    with open(file, 'rb') as f:
+        for line in f:
+            pos += len(line)
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if header is None:
+                header = record
+            elif 'checkpoint' in record:
+                done.extend(pending)
+                pending = []
+                offsets = record['checkpoint']
+                end = pos
+            else:
+                pending.append(record)
+    return header, done, offsets, end, pending
+
+
+class RunManifest:
+    """ manifest.jsonl in the output directory path: an append-only record of the status, SHA-256,
+        stage durations and number of rows in each result file of every APK of a run, so an interrupted
+        run can be resumed, and the rows of each APK told apart when runs are merged (see merge_results.py).
+        Records are written in batches, each followed by a checkpoint holding the sizes of the result
+        files once the rows of the batch are on disk. Resuming cuts the result files back to the last
+        checkpoint, so rows written after it aren't duplicated when their APKs are analysed again.
+
+        Accessible attributes:
+            done: dict
+                The record of every APK completed before the last checkpoint, by absolute path.
+
+            skipped: int
+                Number of APKs skipped by skip_done.
+    """
+    def __init__(self, path, elf_only=False, checkpoint_apks=CHECKPOINT_APKS, abis=False):
+        self.path = path
+        self.checkpoint_apks = checkpoint_apks
+        self.file = os.path.join(path, MANIFEST_NAME)
+        self.elf_only = elf_only
+        self.abis = abis
+        self.done = {}
+        self.skipped = 0
+        self._resumed = False
+        self._pending = []
+        self._last_checkpoint = time.monotonic()
+        self._results = None
+        self._counts = None
+        self._f = None
+
+    def resume(self):
+        """ Read the manifest of a previous run, and cut it and the result files back to its last checkpoint.
+            Return False if there is no manifest to resume, raise ValueError if the run had other options.
+        """
+        try:
+            header, done, offsets, end, pending = read_manifest(self.file)
+        except FileNotFoundError:
+            logger.warning('No run to resume in {}, starting a new one'.format(self.path))
+            return False
+        if header is None or offsets is None or header.get('manifest') != MANIFEST_VERSION:
+            logger.warning('No run to resume in {}, starting a new one'.format(self.path))
+            return False
+        if header.get('elf_only', False) != self.elf_only:
+            raise ValueError('the run in {} was {}in ELF-only mode'.format(
+                self.path, '' if header.get('elf_only') else 'not '))
+        if header.get('abis', False) != self.abis:
+            raise ValueError('the run in {} was {}with --dedup-abis'.format(
+                self.path, '' if header.get('abis') else 'not '))
+
+        os.truncate(self.file, end)
+        for name, size in offsets.items():
+            file = os.path.join(self.path, name)
+            if os.path.exists(file) and os.path.getsize(file) > size:
+                os.truncate(file, size)
+        self.done = {os.path.abspath(record['apk']): record for record in done}
+        if pending:
+            logger.info('{} APKs done after the last checkpoint will be analysed again'.format(len(pending)))
+        self._resumed = True
+        return True
+
+    def is_done(self, apk_file):
+        return os.path.abspath(apk_file) in self.done
+
+    def skip_done(self, apk_files):
+        """ Yield the APK files not completed by the resumed run. """
+        for apk_file in apk_files:
+            if self.is_done(apk_file):
+                self.skipped += 1
+            else:
+                yield apk_file
+
+    def start(self, results):
+        """ Start recording the APKs whose rows are written to results (ResultFiles). """
+        self._results = results
+        self._counts = dict(results.counts)
+        if self._resumed:
+            self._f = open(self.file, 'a')
+        else:
+            self._f = open(self.file, 'w')
+            self._f.write(json.dumps({'manifest': MANIFEST_VERSION, 'elf_only': self.elf_only,
+                                      'abis': self.abis}) + '\n')
+        self.checkpoint()
+
+    def record(self, apk_file, status, metrics=None, sha256=None):
+        """ Record an APK once its rows are written to the result files. sha256 is the digest of the APK,
+            computed by the worker that analysed it, or None if it's unknown, e.g. the APK failed.
+            A checkpoint is written when the batch is full.
+        """
+        record = {'apk': apk_file, 'status': status, 'sha256': sha256}
+        if metrics:
+            record['wall'] = metrics['wall']
+            record['stages'] = {name: stage['wall'] for name, stage in metrics['stages'].items()}
+            if metrics.get('partial'):
+                record['partial'] = metrics['partial']
+        self.append(record)
+
+    def append(self, record):
+        """ Record an APK given as a manifest record, with at least 'apk', 'status' and 'sha256',
+            once its rows are written to the result files. Its row counts are added to the record.
+        """
+        counts = self._results.counts
+        record['rows'] = {name: count - self._counts.get(name, 0) for name, count in counts.items()}
+        self._counts = dict(counts)
+        self._pending.append(record)
+        if len(self._pending) >= self.checkpoint_apks or time.monotonic() - self._last_checkpoint > CHECKPOINT_SECONDS:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Flush the result files, then record the pending APKs and the sizes of the files. """
+        self._results.flush()
+        lines = [json.dumps(record) for record in self._pending]
+        lines.append(json.dumps({'checkpoint': self._results.offsets(), 'time': round(time.time(), 1)}))
+        self._f.write('\n'.join(lines) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        for record in self._pending:
+            self.done[os.path.abspath(record['apk'])] = record
+        self._pending = []
+        self._last_checkpoint = time.monotonic()
+
+    def close(self):
+        if self._f is not None:
+            self.checkpoint()
+            self._f.close()
+            self._f = None
+
+
+# tests: print the APKs completed in the run in the directory given as an argument, without changing it
+if __name__ == '__main__':
+    header, done, offsets, end, pending = read_manifest(os.path.join(sys.argv[1], MANIFEST_NAME))
+    print(header)
+    for record in done:
+        print(record['status'], record['sha256'], record['apk'])
+    print('checkpoint', offsets, '{} APKs after it'.format(len(pending)))
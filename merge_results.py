@@ -0,0 +1,179 @@
+import os
+import re
+import csv
+import json
+import heapq
+import logging
+import argparse
+from collections import Counter
+from manifest import MANIFEST_NAME, MANIFEST_VERSION, RunManifest, read_manifest
+from write_result import ApkResultRows, ResultFiles
+from colored_logger import terminal_formatter
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+RESULT_FILES = ('result_java.csv', 'result_elf.csv', 'result_overview.csv')
+
+# Checkpoints of the merged manifest are only needed to read it, not to resume the merge
+MERGE_CHECKPOINT_APKS = 10000
+
+# A log entry starts with the time stamp of file_formatter, the other lines belong to the entry before
+_LOG_ENTRY = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} ')
+
+
+def read_shard_header(shard):
+    """ Return the header of the manifest of the run in the directory shard, raise ValueError if there's none. """
+    try:
+        header = read_manifest(os.path.join(shard, MANIFEST_NAME))[0]
+    except FileNotFoundError:
+        raise ValueError('no {} in {}, it was not written by main.py'.format(MANIFEST_NAME, shard))
+    if header is None or header.get('manifest') != MANIFEST_VERSION:
+        raise ValueError('{} in {} is not a manifest this version can read'.format(MANIFEST_NAME, shard))
+    return header
+
+
+def iter_shard_apks(shard):
+    """ Yield (record, rows) for every APK completed in the run in the directory shard, in order:
+        its manifest record, and its rows in each result file, by file name. The rows of each APK are
+        told apart with the row counts of the manifest, and rows after the last checkpoint are left out.
+    """
+    header, done, offsets, end, pending = read_manifest(os.path.join(shard, MANIFEST_NAME))
+    if pending:
+        logger.warning('Leaving out {} APKs of {} after its last checkpoint, resume it with --resume to '
+            'include them'.format(len(pending), shard))
+    files = {}
+    readers = {}
+    try:
+        for name in RESULT_FILES:
+            if name == 'result_java.csv' and header.get('elf_only'):
+                continue
+            files[name] = open(os.path.join(shard, name), newline='')
+            readers[name] = csv.reader(files[name])
+            next(readers[name], None)       # The header
+        for record in done:
+            if 'rows' not in record:
+                raise ValueError('{} in {} has no row counts, it was written by an older version'.format(
+                    MANIFEST_NAME, shard))
+            rows = {}
+            for name, count in record['rows'].items():
+                rows[name] = [row for _, row in zip(range(count), readers[name])]
+                if len(rows[name]) != count:
+                    raise ValueError('{} in {} is shorter than its manifest'.format(name, shard))
+            yield record, rows
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def merge_runs(shards, output):
+    """ Merge the result files of the runs in the directories shards into the directory output,
+        with a manifest of the merged APKs. An APK analysed in several shards (the same SHA-256)
+        is only kept from the first one. Return the corpus-wide totals as a dict.
+    """
+    elf_only = {read_shard_header(shard).get('elf_only', False) for shard in shards}
+    if len(elf_only) > 1:
+        raise ValueError('some runs are in ELF-only mode and some are not')
+    elf_only = elf_only.pop()
+    abis = {read_shard_header(shard).get('abis', False) for shard in shards}
+    if len(abis) > 1:
+        raise ValueError('some runs are with --dedup-abis and some are not')
+    abis = abis.pop()
+
+    results = ResultFiles(output, elf_only, abis=abis)
+    manifest = RunManifest(output, elf_only, MERGE_CHECKPOINT_APKS, abis)
+    manifest.start(results)
+    seen = set()
+    status = Counter()
+    totals = Counter()
+    for shard in shards:
+        shard_apks = 0
+        for record, rows in iter_shard_apks(shard):
+            totals['apks'] += 1
+            key = record['sha256'] or record['apk']
+            if key in seen:
+                totals['duplicates'] += 1
+                continue
+            seen.add(key)
+            shard_apks += 1
+
+            overview = rows.get('result_overview.csv', [])
+            results.write_rows(ApkResultRows(rows.get('result_java.csv', []), rows.get('result_elf.csv', []),
+                                             overview[0] if overview else None))
+            manifest.append(dict(record, shard=shard))
+            status[record['status']] += 1
+            totals['java_hits'] += bool(rows.get('result_java.csv'))
+            totals['elf_hits'] += bool(rows.get('result_elf.csv'))
+            if record['status'] == 'ok' and overview and len(overview[0]) > 6:
+                totals['packed'] += overview[0][6] not in ('', '[]')
+            totals['wall'] += record.get('wall', 0)
+        logger.info('Merged {} APKs of {}'.format(shard_apks, shard))
+    manifest.close()
+    results.close()
+
+    return {
+        'shards': len(shards),
+        'apks': totals['apks'],
+        'unique_apks': len(seen),
+        'duplicates': totals['duplicates'],
+        'status': dict(status),
+        'apks_with_java_hits': totals['java_hits'],
+        'apks_with_elf_hits': totals['elf_hits'],
+        'packed_apks': totals['packed'],
+        'analysis_hours': round(totals['wall'] / 3600, 2),
+        'rows': dict(results.counts),
+    }
+
+
+def _iter_log_entries(shard):
+    """ Yield the entries of analyse_log.log in the directory shard, tagged with the shard. """
+    try:
+        f = open(os.path.join(shard, 'analyse_log.log'), errors='replace')
+    except FileNotFoundError:
+        return
+    tag = '[{}] '.format(os.path.basename(os.path.normpath(shard)))
+    entry = None
+    with f:
+        for line in f:
+            if _LOG_ENTRY.match(line):
+                if entry is not None:
+                    yield entry
+                entry = line[:24] + tag + line[24:]
+            elif entry is not None:
+                entry += line
+            else:
+                entry = line
+    if entry is not None:
+        yield entry
+
+
+def merge_logs(shards, output):
+    """ Merge the analyse logs of the runs in shards into one in the directory output, sorted by time,
+        each entry tagged with the directory of its shard.
+    """
+    with open(os.path.join(output, 'analyse_log.log'), 'w') as f:
+        for entry in heapq.merge(*(_iter_log_entries(shard) for shard in shards), key=lambda entry: entry[:23]):
+            f.write(entry if entry.endswith('\n') else entry + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the output directories of main.py runs, e.g. the '
+        'shards of a corpus analysed with --shard, into one, and print corpus-wide totals')
+    parser.add_argument('shard', nargs='+', help='output directories of the runs')
+    parser.add_argument('-o', '--output', required=True, help='a directory to save the merged output files')
+    args = parser.parse_args()
+    if any(os.path.realpath(shard) == os.path.realpath(args.output) for shard in args.shard):
+        parser.error('the output directory must not be one of the runs')
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(terminal_formatter)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        totals = merge_runs(args.shard, args.output)
+    except ValueError as e:
+        parser.error(str(e))
+    merge_logs(args.shard, args.output)
+    with open(os.path.join(args.output, 'totals.json'), 'w') as f:
+        json.dump(totals, f, indent=2)
+    print(json.dumps(totals, indent=2))
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import queue
+import hashlib
+import logging
+import threading
+import zipfile
+from typing import NamedTuple
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Waits for an APK to be read longer than this many seconds are logged
+STALL_LOG_THRESHOLD = 0.1
+
+
+class PrefetchedApk(NamedTuple):
+    """ An APK read ahead of the analysis.
+
+        path: the APK file, size: its size in bytes, sha256: its hex digest, None if it couldn't be read.
+        error: the OSError or BadZipFile that makes it unreadable, or None.
+    """
+    path: str
+    size: int
+    sha256: str
+    error: Exception
+
+
+def read_apk(path):
+    """ Read the whole APK at path, so it's in the page cache when it's analysed, hashing it on the way,
+        and check that its zip central directory can be read. Return a PrefetchedApk.
+    """
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+                size += len(chunk)
+        with zipfile.ZipFile(path):
+            pass
+    except (OSError, zipfile.BadZipFile) as e:
+        return PrefetchedApk(path, size, None, e)
+    return PrefetchedApk(path, size, h.hexdigest(), None)
+
+
+class Prefetcher:
+    """ Iterate over the APK files of paths as PrefetchedApk, in order, reading them ahead in a
+        background thread while the previous ones are analysed. At most depth APKs, and at most budget
+        bytes of them (but always one), are read ahead and not consumed yet, so they stay in the page cache.
+        paths is consumed by the background thread too, so walking directories doesn't stall the analysis.
+
+        Accessible attributes:
+            stalled: float
+                Seconds spent waiting for an APK to be read, i.e. with the analysis idle.
+    """
+    def __init__(self, paths, depth, budget):
+        self.depth = depth
+        self.budget = budget
+        self.stalled = 0.0
+        self._paths = paths
+        self._queue = queue.Queue()
+        self._next = None           # (apk, size) taken from the queue by ready() and not consumed yet
+        self._ahead = 0             # APKs read and not consumed yet,
+        self._ahead_bytes = 0       # and their size
+        self._room = threading.Condition()
+        self._done = False
+        self._thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self):
+        try:
+            for path in self._paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = 0
+                with self._room:
+                    while self._ahead and (self._ahead >= self.depth or self._ahead_bytes + size > self.budget):
+                        self._room.wait()
+                    self._ahead += 1
+                    self._ahead_bytes += size
+                self._queue.put((read_apk(path), size))
+        except BaseException as e:
+            # Raised again to the consumer, e.g. a list of paths that can't be opened
+            self._queue.put((e, 0))
+        self._queue.put((None, 0))
+
+    def __iter__(self):
+        return self
+
+    def _get(self, timeout=None):
+        start = time.monotonic()
+        try:
+            if self._next is None:
+                self._next = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        waited = time.monotonic() - start
+        self.stalled += waited
+        return waited
+
+    def ready(self, timeout=None):
+        """ Return whether next() won't block, waiting at most timeout seconds (None: until it won't). """
+        if not self._done:
+            self._get(timeout)
+        return self._done or self._next is not None
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        waited = self._get()
+        apk, size = self._next
+        self._next = None
+        if apk is None:
+            self._done = True
+            raise StopIteration
+        if isinstance(apk, BaseException):
+            self._done = True
+            raise apk
+        with self._room:
+            self._ahead -= 1
+            self._ahead_bytes -= size
+            self._room.notify()
+        if waited > STALL_LOG_THRESHOLD:
+            logger.debug('Waited {:.2f} seconds for {} to be read'.format(waited, apk.path))
+        return apk
+
+
+# tests: read ahead the files given as arguments, printing how long the consumer waited
+if __name__ == '__main__':
+    prefetcher = Prefetcher(sys.argv[1:], 4, 256 * 1024 * 1024)
+    for apk in prefetcher:
+        print(apk.path, apk.size, apk.sha256, apk.error)
+    print('stalled {:.3f} seconds'.format(prefetcher.stalled))
@@ -0,0 +1,71 @@
+import os
+import logging
+import argparse
+from time import time
+from extracts import FeatureStore, analyse_features
+from manifest import RunManifest
+from stage_metrics import StageMetrics
+from known_libraries import PackageTrie, DEFAULT_KNOWN_LIBRARIES, load_known_libraries
+from write_result import ResultFiles, get_result_rows
+from main import setup_logger
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+
+def reevaluate(store, results, manifest, known_libraries=None):
+    """ Analyse every APK of store (a FeatureStore) under the current rules, writing its rows
+        to results (ResultFiles) and recording it in manifest (a started RunManifest).
+        Return the number of APKs analysed.
+    """
+    count = 0
+    for sha256, apk_file, features in store.iter_apks():
+        logger.info('Re-evaluating {}'.format(apk_file))
+        time_start = time()
+        metrics = StageMetrics()
+        try:
+            ana = analyse_features(apk_file, features, store, metrics, known_libraries)
+        except KeyError as e:
+            logger.error('Ignoring {}: the features of an ELF file are missing from the store: {}'.format(apk_file, e))
+            continue
+        rows = get_result_rows(ana, int(time() - time_start))
+        results.write_rows(rows)
+        results.write_metrics(apk_file, 'ok', rows.metrics)
+        manifest.record(apk_file, 'ok', rows.metrics, sha256)
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyse the APKs stored by main.py --extract again under '
+        'the current rules, writing the same output files as main.py without loading the APKs')
+    parser.add_argument('extracts', help='the SQLite database written by main.py --extract')
+    parser.add_argument('-o', '--output', default='./', help='a directory to save output file')
+    parser.add_argument('--skip-known-libs', action='store_true',
+        help='skip the classes of widely bundled libraries (androidx, kotlin, okhttp3, ...) in the Java analysis')
+    parser.add_argument('--known-libs', metavar='PATH',
+        help='skip the classes in the packages listed in PATH, one per line, instead of the built-in list')
+    parser.add_argument('--metrics', action='store_true',
+        help='write wall time, CPU time and memory of each stage of every APK to metrics.jsonl')
+    args = parser.parse_args()
+    if not os.path.isfile(args.extracts):
+        parser.error('no extracts at {}'.format(args.extracts))
+
+    path = args.output
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    setup_logger(path)
+    known_libraries = None
+    if args.known_libs:
+        known_libraries = load_known_libraries(args.known_libs)
+    elif args.skip_known_libs:
+        known_libraries = PackageTrie(DEFAULT_KNOWN_LIBRARIES)
+
+    store = FeatureStore(args.extracts)
+    results = ResultFiles(path, metrics=args.metrics)
+    manifest = RunManifest(path)
+    manifest.start(results)
+    time_start = time()
+    count = reevaluate(store, results, manifest, known_libraries)
+    manifest.close()
+    results.close()
+    logger.info('Re-evaluated {} APKs in {:.1f} seconds'.format(count, time() - time_start))
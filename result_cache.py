@@ -0,0 +1,72 @@
+import json
+import time
+import zlib
+import hashlib
+import logging
+from ruleset import ruleset_fingerprint
+from sqlite_store import SqliteStore
+from write_result import ApkResultRows, csv_cell
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ApkResultCache(SqliteStore):
+    """ A persistent cache of the CSV rows of analysed APKs, keyed by the SHA-256 of the APK,
+        the analysis mode and the ruleset fingerprint, so an unchanged APK isn't analysed again.
+        Rows are stored as compressed JSON in an SQLite database, which can be shared by several processes.
+        Results cached under other rules are never returned, and are removed by purge().
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS apk_results (key TEXT PRIMARY KEY, ruleset TEXT, payload BLOB, created REAL)',
+    )
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+        self._fingerprint = ruleset_fingerprint()
+
+    def key(self, apk_file, mode='full', sha256=None):
+        """ Return the cache key of an APK analysed in mode, e.g. 'full' or 'elf'.
+            sha256 is the digest of the APK if it's known already, otherwise the APK is read to compute it.
+        """
+        return '{}:{}'.format(sha256 or file_sha256(apk_file), mode)
+
+    def get(self, key):
+        """ Return the cached ApkResultRows for key, or None on a miss. """
+        row = self._connect().execute('SELECT payload FROM apk_results WHERE key = ? AND ruleset = ?',
+            (key, self._fingerprint)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        java, elf, overview = json.loads(zlib.decompress(row[0]))
+        return ApkResultRows(java, elf, overview)
+
+    def put(self, key, rows: ApkResultRows):
+        payload = (
+            [[csv_cell(cell) for cell in row] for row in rows.java],
+            [[csv_cell(cell) for cell in row] for row in rows.elf],
+            None if rows.overview is None else [csv_cell(cell) for cell in rows.overview],
+        )
+        payload = zlib.compress(json.dumps(payload).encode())
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO apk_results VALUES (?, ?, ?, ?)',
+                (key, self._fingerprint, payload, time.time()))
+
+    def purge(self):
+        """ Remove results cached under other rules. """
+        db = self._connect()
+        with db:
+            count = db.execute('DELETE FROM apk_results WHERE ruleset != ?', (self._fingerprint,)).rowcount
+        if count:
+            logger.info('APK cache: removed {} results of outdated rules'.format(count))
@@ -0,0 +1,24 @@
+import hashlib
+import constants
+import crypto_names
+
+# Bump when the analysis itself changes in a way that changes results
+# for the same rules, to invalidate results cached by earlier versions.
+ANALYSIS_VERSION = 4
+
+
+def ruleset_fingerprint():
+    """ Return a hex digest identifying the rules results depend on:
+        the crypto names, the crypto constants, the source of the modules defining them
+        and ANALYSIS_VERSION. Any change of these invalidates cached results.
+    """
+    h = hashlib.sha256()
+    h.update('version {}\n'.format(ANALYSIS_VERSION).encode())
+    for name in crypto_names.crypto_names:
+        h.update('name {}\n'.format(name).encode())
+    for name, value in constants.crypto_constants.items():
+        h.update('constant {} {}\n'.format(name, value.hex()).encode())
+    for module in (constants, crypto_names):
+        with open(module.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
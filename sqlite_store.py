@@ -0,0 +1,35 @@
+import os
+import sqlite3
+
+
+class SqliteStore:
+    """ Base of the caches and stores kept in an SQLite database at path, which can be shared by
+        several processes. Subclasses list the statements creating their tables and indexes in SCHEMA,
+        they run when a process first connects.
+    """
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
+
+    def _connect(self):
+        # A connection can't be shared with forked worker processes, each opens its own
+        if self._db is None or self._pid != os.getpid():
+            self._db = self._open()
+            self._db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def _open(self):
+        """ Return a new connection to the database. """
+        return sqlite3.connect(self.path, timeout=60)
@@ -0,0 +1,73 @@
+import os
+import time
+import resource
+from contextlib import contextmanager
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_mb(pid='self'):
+    """ Return the resident set size of a process (this one by default) in MB, or None if it can't be read. """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / (1024 * 1024)
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    """ Return the peak resident set size of this process in MB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageMetrics:
+    """ Wall time, CPU time and memory of the stages of analysing one APK.
+
+        Accessible attributes:
+            stages: dict[str, dict]
+                The keys are stage names in the order they ran, the values are dictionaries with
+                'wall' and 'cpu' seconds, and 'rss_mb' and 'peak_rss_mb' at the end of the stage.
+                The peak RSS is the peak of the process, which may have analysed other APKs before.
+
+            counts: dict[str, int]
+                Counts of what was analysed or skipped, e.g. 'known_classes'.
+
+            partial: list[str]
+                Stages cut short by their time budget, see budgets.py.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.partial = []
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.stages[name] = {
+                'wall': round(time.perf_counter() - wall_start, 4),
+                'cpu': round(time.process_time() - cpu_start, 4),
+                'rss_mb': _round(current_rss_mb()),
+                'peak_rss_mb': _round(peak_rss_mb()),
+            }
+
+    def to_dict(self):
+        """ Return the stages, their totals and the counts as a JSON serializable dict. """
+        result = {
+            'wall': round(sum(s['wall'] for s in self.stages.values()), 4),
+            'cpu': round(sum(s['cpu'] for s in self.stages.values()), 4),
+            'peak_rss_mb': _round(peak_rss_mb()),
+            'stages': self.stages,
+        }
+        if self.counts:
+            result['counts'] = self.counts
+        if self.partial:
+            result['partial'] = self.partial
+        return result
+
+
+def _round(mb):
+    return None if mb is None else round(mb, 1)
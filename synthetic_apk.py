@@ -0,0 +1,337 @@
+import os
+import sys
+import zlib
+import random
+import struct
+import hashlib
+import zipfile
+from typing import NamedTuple
+from constants import crypto_constants
+
+# ELF class and machine of the native libraries of each ABI
+ABIS = {
+    'arm64-v8a': (64, 183),
+    'armeabi-v7a': (32, 40),
+    'x86': (32, 3),
+    'x86_64': (64, 62),
+}
+
+# Words of the generated identifiers and strings. None contains a crypto name, and since they are
+# joined with separators, no name can appear across two of them.
+_WORDS = ('alpha', 'buffer', 'cache', 'delta', 'event', 'frame', 'group', 'handle', 'index', 'label',
+          'model', 'node', 'option', 'parser', 'query', 'record', 'value', 'widget', 'view', 'token')
+
+# Names planted in strings, class names and symbols, matched by crypto_names.py
+_PLANTED_NAMES = ('SM4/ECB/PKCS5Padding', 'Sm2Signer', 'sm3_update', 'SMS4_encrypt')
+
+# Strings added with non_ascii, taking two and three bytes in MUTF-8, a surrogate pair and a NUL,
+# with crypto names matched after case folding or next to non-ASCII characters
+_NON_ASCII_STRINGS = ('clé ключ', '密钥 value', 'token \U0001f511', 'nul\0byte', 'ſm3_hash', 'SM4加密', 'ｓｍ２')
+
+
+class SyntheticApkSpec(NamedTuple):
+    """ The shape of a synthetic APK, see build_apk.
+
+        classes, methods, strings: classes in classes.dex, methods per class, strings per method.
+        abis, native_libs, native_lib_kb, symbols: ABIs with native libraries, libraries per ABI,
+        approximate size of each library in KB, and dynamic symbols per library.
+        planted_constants, planted_names: number of methods, and of libraries, in which crypto constants
+        (from constants.py) and crypto names are planted.
+        seed: the seed of the random content, the same spec always gives the same APK.
+        dex_files: the classes are split across this many DEX files, classes.dex, classes2.dex, ...
+        non_ascii: whether every method also loads one of a few non-ASCII strings.
+        shared_libs: whether every ABI ships the same libraries, byte for byte, under the same names,
+        instead of its own libraries.
+    """
+    classes: int = 200
+    methods: int = 5
+    strings: int = 2
+    abis: tuple = ('arm64-v8a', 'armeabi-v7a')
+    native_libs: int = 2
+    native_lib_kb: int = 256
+    symbols: int = 500
+    planted_constants: int = 2
+    planted_names: int = 2
+    seed: int = 0
+    dex_files: int = 1
+    non_ascii: bool = False
+    shared_libs: bool = False
+
+
+def _uleb128(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if not n:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _mutf8(s):
+    """ Encode s in the modified UTF-8 of DEX files: UTF-16 code units, NUL as two bytes. """
+    out = bytearray()
+    utf16 = s.encode('utf-16-le', 'surrogatepass')
+    for unit in struct.unpack('<{}H'.format(len(utf16) // 2), utf16):
+        if 0 < unit < 0x80:
+            out.append(unit)
+        elif unit < 0x800:
+            out += bytes((0xc0 | unit >> 6, 0x80 | unit & 0x3f))
+        else:
+            out += bytes((0xe0 | unit >> 12, 0x80 | (unit >> 6) & 0x3f, 0x80 | unit & 0x3f))
+    return bytes(out)
+
+
+def build_dex(classes):
+    """ Return a DEX file with classes, a list of (descriptor, methods), each method being
+        (name, strings, constants): its code loads every string with const-string, and holds every
+        constant (bytes) in a fill-array-data payload, like a static array initializer.
+        Method names must be unique within a class. Every method is a public static void method.
+    """
+    strings = {'V', 'Ljava/lang/Object;'}
+    for descriptor, methods in classes:
+        strings.add(descriptor)
+        for name, method_strings, _ in methods:
+            strings.add(name)
+            strings.update(method_strings)
+    strings = sorted(strings, key=lambda s: s.encode('utf-16-be', 'surrogatepass'))
+    string_idx = {s: i for i, s in enumerate(strings)}
+    types = sorted({'V', 'Ljava/lang/Object;'} | {descriptor for descriptor, _ in classes}, key=string_idx.get)
+    type_idx = {t: i for i, t in enumerate(types)}
+    methods = sorted(((type_idx[descriptor], string_idx[name], descriptor, name, method_strings, constants)
+                      for descriptor, class_methods in classes
+                      for name, method_strings, constants in class_methods), key=lambda m: m[:2])
+    method_idx = {(m[2], m[3]): i for i, m in enumerate(methods)}
+
+    string_ids_off = 0x70
+    type_ids_off = string_ids_off + 4 * len(strings)
+    proto_ids_off = type_ids_off + 4 * len(types)
+    method_ids_off = proto_ids_off + 12
+    class_defs_off = method_ids_off + 8 * len(methods)
+    data_off = class_defs_off + 32 * len(classes)
+    data = bytearray()
+
+    def align4():
+        data.extend(bytes(-(data_off + len(data)) % 4))
+
+    align4()
+    code_start = data_off + len(data)
+    code_offs = {}
+    for _, _, descriptor, name, method_strings, constants in methods:
+        align4()
+        insns = bytearray(struct.pack('<BBHH', 0x71, 0, method_idx[(descriptor, name)], 0))     # invoke-static
+        for s in method_strings:
+            insns += struct.pack('<BBH', 0x1a, 0, string_idx[s])        # const-string
+        payloads = []
+        for constant in constants:
+            payloads.append((len(insns), constant))
+            insns += struct.pack('<BBi', 0x26, 0, 0)                    # fill-array-data
+        insns += struct.pack('<BB', 0x0e, 0)                            # return-void
+        insns += bytes(len(insns) % 4)                                  # nop, payloads are 4-byte aligned
+        for pos, constant in payloads:
+            struct.pack_into('<i', insns, pos + 2, (len(insns) - pos) // 2)
+            payload = struct.pack('<HHI', 0x0300, 1, len(constant)) + constant
+            insns += payload + bytes(-len(payload) % 4)
+        code_offs[(descriptor, name)] = data_off + len(data)
+        data += struct.pack('<HHHHII', 1, 0, 0, 0, 0, len(insns) // 2) + insns
+
+    class_data_start = data_off + len(data)
+    class_data_offs = {}
+    for descriptor, class_methods in classes:
+        class_data_offs[descriptor] = data_off + len(data)
+        indices = sorted(method_idx[(descriptor, name)] for name, _, _ in class_methods)
+        data += _uleb128(0) + _uleb128(0) + _uleb128(len(indices)) + _uleb128(0)
+        previous = 0
+        for index in indices:
+            data += _uleb128(index - previous) + _uleb128(0x9) + _uleb128(code_offs[methods[index][2:4]])
+            previous = index
+
+    string_data_start = data_off + len(data)
+    string_data_offs = []
+    for s in strings:
+        string_data_offs.append(data_off + len(data))
+        data += _uleb128(len(s.encode('utf-16-le', 'surrogatepass')) // 2) + _mutf8(s) + b'\0'
+    align4()
+    map_off = data_off + len(data)
+    items = [(0x0000, 1, 0), (0x0001, len(strings), string_ids_off), (0x0002, len(types), type_ids_off),
+             (0x0003, 1, proto_ids_off), (0x0005, len(methods), method_ids_off),
+             (0x0006, len(classes), class_defs_off), (0x2001, len(methods), code_start),
+             (0x2000, len(classes), class_data_start), (0x2002, len(strings), string_data_start),
+             (0x1000, 1, map_off)]
+    items = [item for item in items if item[1]]
+    data += struct.pack('<I', len(items))
+    for item_type, count, offset in items:
+        data += struct.pack('<HHII', item_type, 0, count, offset)
+
+    body = bytearray()
+    for offset in string_data_offs:
+        body += struct.pack('<I', offset)
+    for t in types:
+        body += struct.pack('<I', string_idx[t])
+    body += struct.pack('<III', string_idx['V'], type_idx['V'], 0)      # The proto ()V
+    for class_index, name_index, _, _, _, _ in methods:
+        body += struct.pack('<HHI', class_index, 0, name_index)
+    for descriptor, _ in classes:
+        body += struct.pack('<8I', type_idx[descriptor], 1, type_idx['Ljava/lang/Object;'], 0, 0xffffffff, 0,
+                            class_data_offs[descriptor], 0)
+
+    header = bytearray(b'dex\n035\0' + bytes(24))
+    header += struct.pack('<6I', 0x70 + len(body) + len(data), 0x70, 0x12345678, 0, 0, map_off)
+    header += struct.pack('<14I', len(strings), string_ids_off, len(types), type_ids_off, 1, proto_ids_off,
+                          0, 0, len(methods), method_ids_off, len(classes), class_defs_off, len(data), data_off)
+    dex = header + body + data
+    dex[12:32] = hashlib.sha1(dex[32:]).digest()
+    dex[8:12] = struct.pack('<I', zlib.adler32(dex[12:]))
+    return bytes(dex)
+
+
+def build_elf(symbols, rodata, text_size=0, elf_class=64, machine=183):
+    """ Return a shared library (ELF file) exporting the function names symbols, with the bytes
+        rodata in .rodata and text_size bytes of zeros in .text. There are no program headers.
+    """
+    is64 = elf_class == 64
+    symbol_format = struct.Struct('<IBBHQQ' if is64 else '<IIIBBH')
+    section_format = struct.Struct('<IIQQQQIIQQ' if is64 else '<10I')
+    header_format = struct.Struct('<16sHHIQQQIHHHHHH' if is64 else '<16sHHIIIIIHHHHHH')
+
+    dynstr = bytearray(b'\0')
+    dynsym = bytearray(symbol_format.size)      # The null symbol
+    for i, name in enumerate(symbols):
+        name_offset = len(dynstr)
+        dynstr += name.encode() + b'\0'
+        if is64:
+            dynsym += symbol_format.pack(name_offset, 0x12, 0, 4, 16 * i, 16)     # Global function in .text
+        else:
+            dynsym += symbol_format.pack(name_offset, 16 * i, 16, 0x12, 0, 4)
+    section_names = ['', '.dynsym', '.dynstr', '.rodata', '.text', '.shstrtab']
+    shstrtab = b'\0'.join(name.encode() for name in section_names) + b'\0'
+    # (type, flags, content, link, info, entry size) of each section after the null one
+    sections = [(11, 2, bytes(dynsym), 2, 1, symbol_format.size), (3, 2, bytes(dynstr), 0, 0, 0),
+                (1, 2, rodata, 0, 0, 0), (1, 6, bytes(text_size), 0, 0, 0), (3, 0, shstrtab, 0, 0, 0)]
+
+    body = bytearray()
+    headers = bytearray(section_format.size)
+    offset = header_format.size
+    for index, (section_type, flags, content, link, info, entry_size) in enumerate(sections, 1):
+        offset += -offset % 8
+        body += bytes(offset - header_format.size - len(body)) + content
+        name = shstrtab.index(section_names[index].encode() + b'\0')
+        headers += section_format.pack(name, section_type, flags, offset, offset, len(content), link, info, 8,
+                                       entry_size)
+        offset += len(content)
+    offset += -offset % 8
+    body += bytes(offset - header_format.size - len(body))
+    ident = b'\x7fELF' + bytes((2 if is64 else 1, 1, 1)) + bytes(9)
+    header = header_format.pack(ident, 3, machine, 1, 0, 0, offset, 0, header_format.size, 0, 0,
+                                section_format.size, len(sections) + 1, len(sections))
+    return header + body + headers
+
+
+def build_manifest(package):
+    """ Return a binary AndroidManifest.xml declaring package, with no components. """
+    def chunk(chunk_type, header, body=b''):
+        return struct.pack('<HHI', chunk_type, 8 + len(header), 8 + len(header) + len(body)) + header + body
+
+    pool_strings = ['manifest', 'package', package]
+    offsets = bytearray()
+    data = bytearray()
+    for s in pool_strings:
+        offsets += struct.pack('<I', len(data))
+        data += struct.pack('<H', len(s)) + s.encode('utf-16-le') + b'\0\0'
+    data += bytes(-len(data) % 4)
+    string_pool = chunk(0x0001, struct.pack('<5I', len(pool_strings), 0, 0, 28 + len(offsets), 0),
+                        bytes(offsets) + bytes(data))
+    node = struct.pack('<II', 1, 0xffffffff)        # Line number, no comment
+    attribute = struct.pack('<IIIHBBI', 0xffffffff, 1, 2, 8, 0, 0x03, 2)   # package="<string 2>"
+    start = chunk(0x0102, node, struct.pack('<IIHHHHHH', 0xffffffff, 0, 20, 20, 1, 0, 0, 0) + attribute)
+    end = chunk(0x0103, node, struct.pack('<II', 0xffffffff, 0))
+    return chunk(0x0003, b'', string_pool + start + end)
+
+
+def _randbytes(rng, n):
+    # Same bytes as rng.randbytes(n), which needs Python 3.9
+    return rng.getrandbits(n * 8).to_bytes(n, 'little') if n else b''
+
+
+def _identifier(rng, separator='_'):
+    return separator.join(rng.choice(_WORDS) for _ in range(3))
+
+
+def build_apk(path, spec=SyntheticApkSpec(), package='com.example.synthetic'):
+    """ Write a synthetic APK with the shape of spec (a SyntheticApkSpec) to path. Constants are planted in
+        spec.planted_constants methods and in as many libraries, and crypto names in spec.planted_names
+        strings and as many libraries, so the analysis finds something in every stage.
+        Return the size of the APK in bytes.
+    """
+    rng = random.Random(spec.seed)
+    constants = list(crypto_constants.values())
+    total_methods = spec.classes * spec.methods
+    constant_methods = set(rng.sample(range(total_methods), min(spec.planted_constants, total_methods)))
+    name_methods = set(rng.sample(range(total_methods), min(spec.planted_names, total_methods)))
+
+    classes = []
+    for i in range(spec.classes):
+        descriptor = 'L{}/{}{};'.format(package.replace('.', '/'), _identifier(rng, '').capitalize(), i)
+        methods = []
+        for j in range(spec.methods):
+            n = i * spec.methods + j
+            strings = [_identifier(rng, ' ') for _ in range(spec.strings)]
+            if n in name_methods:
+                strings.append(_PLANTED_NAMES[n % len(_PLANTED_NAMES)])
+            if spec.non_ascii:
+                strings.append(_NON_ASCII_STRINGS[n % len(_NON_ASCII_STRINGS)])
+            method_constants = [constants[n % len(constants)]] if n in constant_methods else []
+            methods.append(('{}{}'.format(_identifier(rng, ''), j), strings, method_constants))
+        classes.append((descriptor, methods))
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as apk:
+        apk.writestr('AndroidManifest.xml', build_manifest(package))
+        per_dex = -(-len(classes) // spec.dex_files)
+        for k in range(spec.dex_files):
+            dex = build_dex(classes[k * per_dex:(k + 1) * per_dex])
+            apk.writestr('classes{}.dex'.format(k + 1 if k else ''), dex)
+        libraries = None
+        lib_index = 0
+        for abi in spec.abis:
+            if spec.shared_libs and libraries is not None:
+                for name, elf in libraries:
+                    apk.writestr('lib/{}/{}'.format(abi, name), elf)
+                continue
+            libraries = []
+            elf_class, machine = ABIS[abi]
+            for k in range(spec.native_libs):
+                symbols = ['Java_{}_{}'.format(_identifier(rng), s) for s in range(spec.symbols)]
+                rodata = bytearray(_randbytes(rng, spec.native_lib_kb * 1024 // 4))
+                if k < spec.planted_names:
+                    symbols.append(_PLANTED_NAMES[lib_index % len(_PLANTED_NAMES)].replace('/', '_'))
+                if k < spec.planted_constants:
+                    constant = constants[lib_index % len(constants)]
+                    position = rng.randrange(len(rodata) - len(constant) + 1)
+                    rodata[position:position + len(constant)] = constant
+                # Code is highly compressible compared to data, like zeros
+                text_size = spec.native_lib_kb * 1024 - len(rodata)
+                libraries.append(('lib{}.so'.format(_identifier(rng, '')),
+                                  build_elf(symbols, bytes(rodata), text_size, elf_class, machine)))
+                apk.writestr('lib/{}/{}'.format(abi, libraries[-1][0]), libraries[-1][1])
+                lib_index += 1
+    return os.path.getsize(path)
+
+
+def generate_corpus(directory, count, spec=SyntheticApkSpec()):
+    """ Write count synthetic APKs to directory, with the shape of spec and different seeds,
+        return their paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'synthetic{}.apk'.format(i))
+        build_apk(path, spec._replace(seed=spec.seed + i), 'com.example.synthetic{}'.format(i))
+        paths.append(path)
+    return paths
+
+
+# tests: write a synthetic APK to the path given as an argument
+if __name__ == '__main__':
+    size = build_apk(sys.argv[1] if len(sys.argv) > 1 else 'synthetic.apk')
+    print('{} bytes'.format(size))
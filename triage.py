@@ -0,0 +1,95 @@
+import zipfile
+import logging
+from typing import NamedTuple
+from analyse_elf import analyse_apk_elf, is_packer_lib
+from constant_scanner import crypto_constants_scanner
+from crypto_names import iter_crypto_name_positions
+from containers import scan_nested, dex_name_regex
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Conditions of a triage policy, an APK is escalated to the full Java analysis if any of them holds:
+#   always:   every APK
+#   dex-hits: a DEX file contains a crypto name or a crypto constant
+#   elf-hits: an ELF file contains a crypto symbol or a crypto constant
+# Packed APKs are only escalated if the policy also contains 'packed', since their DEX is a stub.
+TRIAGE_CONDITIONS = ('always', 'dex-hits', 'elf-hits', 'packed')
+DEFAULT_TRIAGE_POLICY = 'dex-hits'
+
+
+class TriageResult(NamedTuple):
+    """ Result of the cheap scans of an APK.
+
+        packer_libs: packer libraries found in the central directory.
+        dex_hits: whether a DEX file contains a crypto name or a crypto constant, None if not scanned.
+        elf_results, pack_elf: as returned by analyse_apk_elf.
+        escalate: whether the APK needs the full Java analysis, and reason: why.
+        nested_scan: the NestedScan of the DEX files nested in the APK for the Java analysis,
+            None if nested archives aren't searched. Its ELF files are in elf_results already.
+    """
+    packer_libs: list
+    dex_hits: bool
+    elf_results: list
+    pack_elf: list
+    escalate: bool
+    reason: str
+    nested_scan: object = None
+
+
+def parse_triage_policy(policy):
+    """ Return the set of conditions of a comma separated policy, raise ValueError if one is unknown. """
+    conditions = set(filter(None, (c.strip() for c in policy.split(','))))
+    unknown = conditions.difference(TRIAGE_CONDITIONS)
+    if unknown:
+        raise ValueError('unknown triage conditions: {}'.format(', '.join(sorted(unknown))))
+    return frozenset(conditions)
+
+
+def _dex_has_crypto_hits(dex):
+    return next(iter_crypto_name_positions(dex), None) is not None or bool(crypto_constants_scanner.scan(dex))
+
+
+def dex_has_crypto_hits(apk_zip: zipfile.ZipFile, nested_dex=()):
+    """ Return whether a DEX file of the APK contains a crypto name or a crypto constant anywhere.
+        Names and constants are found by the Java analysis in the string pool and the bytecode,
+        so if this returns False, the Java analysis has no results.
+        nested_dex (NestedPayloads of scan_nested, see containers.py) are scanned too.
+    """
+    for name in apk_zip.namelist():
+        if dex_name_regex.match(name) and _dex_has_crypto_hits(apk_zip.read(name)):
+            return True
+    return any(_dex_has_crypto_hits(payload.data) for payload in nested_dex)
+
+
+def triage_apk(apk_zip: zipfile.ZipFile, policy, elf_cache=None, elf_deadline=None, nested=None, abi_priority=None):
+    """ Run the cheap scans of an APK: packer libraries in the central directory,
+        the ELF analysis and a raw scan of the DEX files, and decide by policy (a set of
+        TRIAGE_CONDITIONS) whether the full Java analysis is needed. Return a TriageResult.
+        elf_deadline (a Deadline) bounds the ELF analysis, nested (a NestedLimits) adds the DEX and
+        ELF files nested in the APK, and abi_priority deduplicates the copies of libraries, see analyse_apk_elf.
+    """
+    packer_libs = [name for name in apk_zip.namelist()
+        if name.startswith('lib') and name.endswith('.so') and is_packer_lib(name)]
+    # The nested archives are walked once, for both the ELF analysis and the DEX scan
+    nested_scan = scan_nested(apk_zip, nested) if nested is not None else None
+    nested_elf, nested_dex = (nested_scan.elf, nested_scan.dex) if nested_scan is not None else ((), ())
+    elf_results, pack_elf = analyse_apk_elf(apk_zip, elf_cache, elf_deadline, nested_elf, abi_priority)
+    if nested_scan is not None:
+        nested_scan = nested_scan._replace(elf=[])
+
+    dex_hits = None
+    if packer_libs and 'packed' not in policy:
+        escalate, reason = False, 'packed by {}'.format(', '.join(packer_libs))
+    elif 'always' in policy:
+        escalate, reason = True, 'always'
+    else:
+        escalate, reason = False, 'no crypto hits'
+        if 'elf-hits' in policy and any(
+                any(r.symbol_table_with_crypto_name.values()) or any(r.crypto_constants_results.values())
+                for r in elf_results):
+            escalate, reason = True, 'crypto in ELF'
+        if not escalate and 'dex-hits' in policy:
+            dex_hits = dex_has_crypto_hits(apk_zip, nested_dex)
+            if dex_hits:
+                escalate, reason = True, 'crypto in DEX'
+    return TriageResult(packer_libs, dex_hits, elf_results, pack_elf, escalate, reason, nested_scan)
@@ -0,0 +1,222 @@
+import time
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from stage_metrics import current_rss_mb
+
+logger = logging.getLogger('AndroidCryptoDetection')
+
+# Seconds between samples of the memory of busy workers
+RSS_SAMPLE_INTERVAL = 0.5
+
+# Seconds imap waits for the next item between polls of the busy workers, when it can tell next() would block
+ITEM_WAIT_INTERVAL = 0.1
+
+
+class TaskTimeout(Exception):
+    """ Raised (as a result) when a task exceeds its wall-clock limit and the worker is killed. """
+
+
+class MemoryExceeded(Exception):
+    """ Raised (as a result) when a worker exceeds its memory limit during a task and is killed. """
+
+
+class WorkerDied(Exception):
+    """ Raised (as a result) when a worker exits without returning a result, e.g. on a crash in C code. """
+
+
+def _worker_main(fn, conn):
+    """ Worker loop: receive (index, item), run fn(item), send back (index, result, error). """
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+        index, item = task
+        try:
+            conn.send((index, fn(item), None))
+        except Exception as e:
+            try:
+                conn.send((index, None, e))
+            except Exception:
+                # The exception itself can't be pickled
+                conn.send((index, None, RuntimeError(repr(e))))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, fn):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(fn, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None        # (index, item) being processed
+        self.deadline = None
+
+    def submit(self, index, item, task_timeout):
+        self.task = (index, item)
+        self.deadline = time.monotonic() + task_timeout
+        self.conn.send(self.task)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """ A pool of worker processes running fn on items, each task with a hard wall-clock limit.
+
+        A worker whose task exceeds task_timeout seconds is killed and replaced by a new one,
+        so a task stuck in C code (e.g. in androguard) can't block the pool.
+        If max_rss (MB) is set, the memory of busy workers is sampled, and a worker exceeding it
+        is killed and replaced the same way. If recycle_rss (MB) is set, a worker using more
+        memory than that after a task is replaced, so memory leaked by a task is given back.
+
+        Usage:
+            with WorkerPool(fn, jobs, task_timeout) as pool:
+                for item, result, error in pool.imap(items):
+                    ...
+            `error` is None on success, otherwise the exception raised by fn,
+            a TaskTimeout, a MemoryExceeded or a WorkerDied.
+        Tasks can also be run one by one with submit() and poll(), e.g. as they arrive.
+    """
+    def __init__(self, fn, jobs, task_timeout, max_rss=None, recycle_rss=None):
+        self.fn = fn
+        self.task_timeout = task_timeout
+        self.max_rss = max_rss
+        self.recycle_rss = recycle_rss
+        self._workers = [_Worker(fn) for _ in range(jobs)]
+
+    def _replace(self, worker, kill=True):
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+        self._workers[self._workers.index(worker)] = _Worker(self.fn)
+
+    def has_idle_worker(self):
+        return any(w.task is None for w in self._workers)
+
+    def busy_count(self):
+        return sum(w.task is not None for w in self._workers)
+
+    def submit(self, index, item):
+        """ Run fn(item) on an idle worker, its outcome is returned by poll() with index. """
+        worker = next(w for w in self._workers if w.task is None)
+        try:
+            worker.submit(index, item, self.task_timeout)
+        except OSError:
+            # The worker died while idle, e.g. killed by the OOM killer, the task goes to its replacement
+            logger.warning('Worker {} died while idle (exit code {}), replacing it'.format(
+                worker.process.pid, worker.process.exitcode))
+            slot = self._workers.index(worker)
+            self._replace(worker)
+            self._workers[slot].submit(index, item, self.task_timeout)
+
+    def poll(self, timeout=None, wake=()):
+        """ Wait for busy workers, at most timeout seconds (None: until the next outcome or deadline),
+            or until one of the wake objects (connections or sockets) is ready.
+            Return a list of (index, item, result, error) of the tasks done.
+        """
+        busy = [w for w in self._workers if w.task is not None]
+        if not busy:
+            return []
+        outcomes = []
+        wait_for = max(0, min(w.deadline for w in busy) - time.monotonic())
+        if timeout is not None:
+            wait_for = min(wait_for, timeout)
+        if self.max_rss is not None:
+            wait_for = min(wait_for, RSS_SAMPLE_INTERVAL)
+        ready = wait([w.conn for w in busy] + list(wake), timeout=wait_for)
+        for worker in busy:
+            index, item = worker.task
+            if worker.conn in ready:
+                try:
+                    _, result, error = worker.conn.recv()
+                except (EOFError, OSError):
+                    logger.error('Worker {} died while analysing {}'.format(worker.process.pid, item))
+                    outcomes.append((index, item, None, WorkerDied('exit code {}'.format(worker.process.exitcode))))
+                    self._replace(worker)
+                    continue
+                outcomes.append((index, item, result, error))
+                worker.task = None
+                if self.recycle_rss is not None:
+                    rss = current_rss_mb(worker.process.pid)
+                    if rss is not None and rss > self.recycle_rss:
+                        logger.debug('Recycling worker {} using {:.0f} MB'.format(worker.process.pid, rss))
+                        self._replace(worker, kill=False)
+            elif time.monotonic() >= worker.deadline:
+                outcomes.append((index, item, None, TaskTimeout('{} seconds'.format(self.task_timeout))))
+                self._replace(worker)
+            elif self.max_rss is not None:
+                rss = current_rss_mb(worker.process.pid)
+                if rss is not None and rss > self.max_rss:
+                    outcomes.append((index, item, None, MemoryExceeded('{:.0f} MB'.format(rss))))
+                    self._replace(worker)
+        return outcomes
+
+    def imap(self, items, ready=None):
+        """ Run fn over items, yield (item, result, error) in the order of items.
+            ready(timeout), if given, returns whether next(items) won't block, waiting at most timeout seconds,
+            e.g. Prefetcher.ready. While it would block, the busy workers are polled, so their limits are
+            enforced and their results yielded.
+        """
+        items = iter(items)
+        exhausted = False
+        submitted = 0
+        next_index = 0
+        done = {}
+
+        while True:
+            waiting = False     # For the next item, the busy workers are then polled without blocking
+            while not exhausted and self.has_idle_worker():
+                if ready is not None and (self.busy_count() or next_index in done) and not ready(ITEM_WAIT_INTERVAL):
+                    waiting = True
+                    break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.submit(submitted, item)
+                submitted += 1
+
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+
+            if not self.busy_count():
+                if exhausted:
+                    break
+                continue
+
+            for index, item, result, error in self.poll(0 if waiting else None):
+                done[index] = (item, result, error)
+
+    def close(self):
+        for worker in self._workers:
+            if worker.task is None:
+                worker.stop()
+            else:
+                worker.kill()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
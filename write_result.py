@@ -1,23 +1,147 @@
-from analyse_apk import AnalyseApkCrypto
+import os
+import csv
+import json
+from typing import NamedTuple, TYPE_CHECKING
+from constants import crypto_constants
+from crypto_names import crypto_names
 
+if TYPE_CHECKING:
+    from analyse_apk import AnalyseApkCrypto
 
-def write_result(ana: AnalyseApkCrypto, time_consumed, csv_java, csv_elf, csv_overview):
+
+class ApkResultRows(NamedTuple):
+    """ CSV rows of one analysed APK, picklable so they can be sent back from worker processes.
+        metrics holds the StageMetrics of the analysis as a dict, and sha256 the digest of the APK
+        for the run manifest, they aren't written to the CSV files.
+    """
+    java: list
+    elf: list
+    overview: tuple
+    metrics: dict = None
+    sha256: str = None
+
+
+def csv_cell(value):
+    """ Return value the way csv.writer writes it, e.g. to store rows or send them as JSON. """
+    return '' if value is None else value if isinstance(value, (str, int, float)) else str(value)
+
+
+def get_elf_rows(app_name, package_name, elf_analyse_result, abis=False):
+    """ The rows of result_elf.csv, with the ABIs column if abis is True (with --dedup-abis). """
+    return [[app_name, package_name, result.elf_name]
+        + list(result.symbol_table_with_crypto_name.values())
+        + list(result.crypto_constants_results.values())
+        + ([','.join(result.abis)] if abis else [])
+        for result in elf_analyse_result]
+
+
+def get_result_rows(ana: 'AnalyseApkCrypto', time_consumed, abis=False):
+    java_rows = []
     for class_info in ana.classes_with_crypto.values():
         if class_info.crypto_name_matched:
-            csv_java.writerow((ana.app_name, ana.package_name, 
+            java_rows.append((ana.app_name, ana.package_name,
                 class_info.matched, class_info.name, '', '', ''))
         for method_info in class_info.method_info.values():
-            csv_java.writerow((
-                ana.app_name, ana.package_name, 
-                method_info.matched, class_info.name, method_info.name, 
-                method_info.strings if method_info.strings else '', 
+            java_rows.append((
+                ana.app_name, ana.package_name,
+                method_info.matched, class_info.name, method_info.name,
+                method_info.strings if method_info.strings else '',
                 method_info.crypto_constants_results)
             )
-    
-    for result in ana.elf_analyse_result:
-        csv_elf.writerow([ana.app_name, ana.package_name, result.elf_name] 
-        + list(result.symbol_table_with_crypto_name.values())
-        + list(result.crypto_constants_results.values()))
-    
-    csv_overview.writerow((ana.app_name, ana.package_name, time_consumed, 
-        ana.class_cnt, ana.method_cnt, ana.elf_cnt, ana.pack_elf))
+
+    elf_rows = get_elf_rows(ana.app_name, ana.package_name, ana.elf_analyse_result, abis)
+
+    overview_row = (ana.app_name, ana.package_name, time_consumed,
+        ana.class_cnt, ana.method_cnt, ana.elf_cnt, ana.pack_elf, ','.join(ana.partial))
+    return ApkResultRows(java_rows, elf_rows, overview_row, ana.metrics.to_dict())
+
+
+def write_result_rows(rows: ApkResultRows, csv_java, csv_elf, csv_overview):
+    if rows.java:
+        csv_java.writerows(rows.java)
+    csv_elf.writerows(rows.elf)
+    if rows.overview is not None:
+        csv_overview.writerow(rows.overview)
+
+
+def write_result(ana: 'AnalyseApkCrypto', time_consumed, csv_java, csv_elf, csv_overview):
+    write_result_rows(get_result_rows(ana, time_consumed), csv_java, csv_elf, csv_overview)
+
+
+class ResultFiles:
+    """ The result CSV files in the directory path, with their headers,
+        and metrics.jsonl if metrics is True. In ELF-only mode there is no Java result.
+        result_elf.csv has the ABIs column if abis is True, see get_elf_rows.
+        If append is True, rows are appended to the files left by a previous run, see manifest.py.
+
+        Accessible attributes:
+            csv_java, csv_elf, csv_overview: csv.writer
+                Writers of result_java.csv (None in ELF-only mode), result_elf.csv and result_overview.csv.
+
+            counts: dict
+                Number of rows written to each CSV file by this object, by file name.
+    """
+    def __init__(self, path, elf_only=False, metrics=False, append=False, abis=False):
+        self._files = []
+        self._mode = 'a' if append else 'w'
+        self.counts = {}
+        if elf_only:
+            self.csv_java = None
+        else:
+            self.csv_java = self._open_csv(path, 'result_java.csv',
+                ('App Name', 'Package Name', 'Crypto Name', 'Class', 'Method', 'Strings', 'Constants'))
+        self.csv_elf = self._open_csv(path, 'result_elf.csv',
+            ['App Name', 'Package Name', 'ELF Name'] + crypto_names + list(crypto_constants.keys())
+            + (['ABIs'] if abis else []))
+        self.csv_overview = self._open_csv(path, 'result_overview.csv',
+            ('App Name', 'Package Name', 'Time Consumed/s', 'Class count', 'Method count', 'ELF count', 'Pack ELF',
+             'Partial'))
+        self._f_metrics = self._open(path, 'metrics.jsonl') if metrics else None
+
+    def _open(self, path, name, **kwargs):
+        f = open(os.path.join(path, name), self._mode, **kwargs)
+        self._files.append(f)
+        return f
+
+    def _open_csv(self, path, name, header):
+        f = self._open(path, name, newline='')
+        writer = csv.writer(f)
+        self.counts[name] = 0
+        if f.tell() == 0:       # Not appending to rows written before
+            writer.writerow(header)
+        return writer
+
+    def write_rows(self, rows: ApkResultRows):
+        write_result_rows(rows, self.csv_java, self.csv_elf, self.csv_overview)
+        if self.csv_java is not None:
+            self.counts['result_java.csv'] += len(rows.java)
+        self.counts['result_elf.csv'] += len(rows.elf)
+        self.counts['result_overview.csv'] += rows.overview is not None
+
+    def write_status(self, apk_file, status):
+        """ Write the overview row of an APK that couldn't be analysed, e.g. 'timed out'. """
+        self.csv_overview.writerow(('', os.path.split(apk_file)[1], status, '', '', ''))
+        self.counts['result_overview.csv'] += 1
+
+    def write_metrics(self, apk_file, status, metrics=None):
+        """ Write a line of stage metrics of an APK to metrics.jsonl, if there is one. """
+        if self._f_metrics is None:
+            return
+        record = {'apk': apk_file, 'status': status}
+        record.update(metrics or {})
+        self._f_metrics.write(json.dumps(record) + '\n')
+
+    def flush(self):
+        """ Write the rows buffered so far to disk. """
+        for f in self._files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def offsets(self):
+        """ Return the size of each file written so far by name, flushed or not. """
+        return {os.path.basename(f.name): f.tell() for f in self._files}
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []